@@ -12,14 +12,20 @@ from pathlib import Path
 from pathlib import Path
 from yaml import safe_load as load_yaml
 
-from src.agat import run_agat, get_longest_isoform, split_annotation
+from src.agat import check_longest_isoform, run_agat
 from src.busco import run_busco
-from src.error_check import correct_fasta_length
+from src.cache import read_manifest, set_analysis_state, DONE, FAILED, PENDING, RUNNING
+from src.metrics import clear_metrics, write_metrics_report
 from src.detenga import run_detenga
 from src.dependencies import check_dependencies
-from src.gffread import run_gffread, reformat_annotation
+from src.compression import decompress_input
+from src.fasta import index_assembly
+from src.gff import get_longest_isoform, normalize_annotation
+from src.gffread import run_gffread
+from src.sequences import deduplicate_sequences, extract_sequences
 from src.omark import run_omark
-from src.psauron import run_psauron
+from src.psauron import SHARD_MEMORY, get_max_psauron_shards, run_psauron
+from src.scheduler import run_dag
 from src.seqtk import reformat_fasta_file
 from src.YAML import report_yaml_file
 from src.homology import run_protein_homology
@@ -37,6 +43,15 @@ HEADER = "-"*5
 AVAILABLE_ANALYSIS = ["AGAT", "BUSCO", "PSAURON",
                       "DETENGA", "OMARK", "PROTHOMOLOGY"]
 VERSION = "v1.15.0"
+ANALYSIS_NAMES = {"AGAT": "AGAT on the GFF file", "BUSCO": "BUSCO",
+                  "PSAURON": "PSAURON", "OMARK": "OMARK",
+                  "DETENGA": "DeTEnGA", "PROTHOMOLOGY": "Protein homology"}
+#Tools able to use more than one thread
+MULTITHREAD_ANALYSIS = ["BUSCO", "PSAURON", "OMARK", "DETENGA", "PROTHOMOLOGY"]
+#Approximate peak memory (GB) of each step, used by batch mode to avoid
+#oversubscribing nodes. They can be changed with the YAML Memory field
+MEMORY_REQUIREMENTS = {"PREPROCESS": 4, "AGAT": 8, "BUSCO": 8, "PSAURON": SHARD_MEMORY,
+                       "OMARK": 16, "DETENGA": 16, "PROTHOMOLOGY": 16}
 
 
 def parse_arguments():
@@ -91,11 +106,26 @@ def create_basedir_fpath():
     return basedir
 
 
+def load_config(yaml_fpath):
+    with open(Path(yaml_fpath)) as yaml_fhand:
+        return load_yaml(yaml_fhand)
+
+
+def prepare_config(yaml):
+    if not yaml.get("Basedir", ""):
+        yaml["Basedir"] = create_basedir_fpath()
+    #Some steps change the working directory, so paths must be absolute
+    yaml["Basedir"] = Path(yaml["Basedir"]).absolute()
+    yaml.setdefault("disable_busco_filter", False)
+    config_report = report_yaml_file(yaml)
+    #subs whitespaces with _ in ID∫
+    yaml["ID"] = "_".join(yaml["ID"].split())
+    return config_report
+
+
 def get_arguments():
     parser = parse_arguments()
-    yaml = parser.yaml
-    with open(Path(parser.yaml)) as yaml_fhand:
-        yaml = load_yaml(yaml_fhand)
+    yaml = load_config(parser.yaml)
 
     if parser.species:
         yaml["ID"] = parser.species
@@ -107,20 +137,19 @@ def get_arguments():
         yaml["OMARK_taxid"] = parser.taxid
     if parser.outbase:
         yaml["Basedir"] = parser.outbase
-    elif not yaml.get("Basedir", ""):
-        basedir = create_basedir_fpath()
-        yaml["Basedir"] = basedir
     yaml["disable_busco_filter"] = parser.disable_busco_filter
-    config_report = report_yaml_file(yaml)
-    #subs whitespaces with _ in ID∫
-    yaml["ID"] = "_".join(yaml["ID"].split())
-    binary = sys.argv[0]
-    command_used = f"{binary} -i {parser.yaml} -s {yaml['ID']} "
+    config_report = prepare_config(yaml)
+    command_used = get_command_used(sys.argv[0], parser.yaml, yaml)
+    return yaml, config_report, command_used
+
+
+def get_command_used(binary, yaml_fpath, yaml):
+    command_used = f"{binary} -i {yaml_fpath} -s {yaml['ID']} "
     command_used += f"-t {yaml['OMARK_taxid']} "
     command_used += f"-g {yaml['Assembly']} "
     command_used += f"-a {yaml['Annotation']} "
     command_used += f"-o {yaml['Basedir']}"
-    return yaml, config_report, command_used
+    return command_used
 
 
 def emit_msg(string, log_fhand):
@@ -135,18 +164,76 @@ def emit_msg(string, log_fhand):
     log_fhand.flush()
 
 
-def main():
-    sys.tracebacklimit = 0
-    if '--version' in sys.argv or "-v" in sys.argv:
-        print(VERSION)
-        sys.exit(0)
-    arguments, config_report, command_used = get_arguments()
+def get_memory_requirement(arguments, step):
+    memory = arguments.get("Memory") or {}
+    if step in memory:
+        return memory[step]
+    #BUSCO lineages run at the same time
+    if step == "BUSCO":
+        return MEMORY_REQUIREMENTS[step] * max(1, len(arguments.get("BUSCO_lineages") or []))
+    #PSAURON shards run at the same time, each one with its own model
+    if step == "PSAURON":
+        return MEMORY_REQUIREMENTS[step] * get_max_psauron_shards(arguments)
+    return MEMORY_REQUIREMENTS[step]
+
+
+def build_analysis_steps(arguments, gffread):
+    #All analysis depend only on the sequences extracted by gffread,
+    #so they can run at the same time
+    if not arguments["disable_busco_filter"]:
+        busco_sequences = gffread["proteins_longest_busco"]["outfile"]
+    else:
+        busco_sequences = gffread["proteins_longest_isoform"]["outfile"]
+    #Searches whose results are counted by protein run on unique sequences
+    proteins = gffread.get("proteins_unique", gffread["proteins"])
+    longest_proteins = gffread.get("proteins_longest_isoform_unique", gffread["proteins_longest_isoform"])
+    inputs = {"AGAT": (run_agat, []),
+              "BUSCO": (run_busco, [busco_sequences]),
+              "PSAURON": (run_psauron, [gffread["cds"]["outfile"]]),
+              "OMARK": (run_omark, [longest_proteins["outfile"], longest_proteins.get("representatives")]),
+              "DETENGA": (run_detenga, [gffread["proteins"]["outfile"], gffread["mrna"]["outfile"]]),
+              "PROTHOMOLOGY": (run_protein_homology, [proteins["outfile"], proteins.get("representatives")])}
+    steps = {}
+    for analysis in arguments["Analysis"]:
+        function, args = inputs[analysis]
+        steps[analysis] = {"function": function, "args": args, "depends": [],
+                           "multithread": analysis in MULTITHREAD_ANALYSIS,
+                           "memory": get_memory_requirement(arguments, analysis)}
+    return steps
+
+
+def get_analysis_state(report):
+    #PSAURON returns a single report, the rest one report per run
+    if "status" in report:
+        report = {"": report}
+    if any("Failed" in values["status"] for values in report.values()):
+        return FAILED
+    return DONE
+
+
+def log_analysis_report(analysis, report, elapsed, log_fhand):
+    emit_msg(HEADER + "{} finished".format(ANALYSIS_NAMES[analysis]) + HEADER + "\n", log_fhand)
+    if "status" in report:
+        report = {analysis: report}
+    for name, values in report.items():
+        status = values["status"]
+        if values["command"]:
+            emit_msg("#{} command used: \n\t{}\n".format(name, values["command"]), log_fhand)
+        if "Failed" in status:
+            emit_msg(BULLET_FIX + status + "\n", log_fhand)
+        else:
+            emit_msg(BULLET_OK + status + "\n", log_fhand)
+    emit_msg("Time consumed Running {}: {}s\n".format(ANALYSIS_NAMES[analysis], round(elapsed, 2)), log_fhand)
+
+
+def start_run(arguments, config_report, command_used):
     basedir = Path(arguments["Basedir"])
     if not basedir.exists():
         basedir.mkdir(parents=True, exist_ok=True)
 
     log_fpath = basedir / "GAQET.log.txt" 
     log_fhand = open(log_fpath, "w")
+    clear_metrics(arguments)
     error_msg = "GAQET has failed, {} for details".format(log_fpath.resolve())
     
     start = time.ctime()
@@ -169,22 +256,17 @@ def main():
         emit_msg(msg, log_fhand)
         raise RuntimeError(msg)
     emit_msg("#Results will be stored at {}\n".format(basedir.resolve()), log_fhand)
-   
-    #Run analysis
-    overall_start = time.time()
-    start_time = time.time()
-    emit_msg(HEADER + "Reformatting transcript features to mRNA"+ HEADER + "\n", log_fhand)
-    reformatted_annotation = reformat_annotation(arguments)
-    end_time = time.time()
-    emit_msg("#Changed transcript features to mRNA", log_fhand)
-    emit_msg("The following transcripts have been changed:\n {}".format("\n".join(reformatted_annotation["transcripts_to_mRNA"])), log_fhand)
-    arguments["Annotation"] = reformatted_annotation["outfile"]
+    return log_fhand
 
+
+def preprocess(arguments, log_fhand):
     start_time = time.time()
-    emit_msg(HEADER + "Splitting annotation by features"+ HEADER + "\n", log_fhand)
-    mrna_features = split_annotation(arguments)
+    emit_msg(HEADER + "Reformatting transcript features to mRNA and splitting annotation by features"+ HEADER + "\n", log_fhand)
+    mrna_features = normalize_annotation(arguments)
     end_time = time.time()
     status = mrna_features["status"]
+    emit_msg("#Changed transcript features to mRNA", log_fhand)
+    emit_msg("The following transcripts have been changed:\n {}".format("\n".join(mrna_features["transcripts_to_mRNA"])), log_fhand)
     emit_msg("#Separate annotation by type, command used: \n\t{}\n".format(mrna_features["command"]), log_fhand)
     if "Failed" in status:
         emit_msg(BULLET_FIX + status + "\n", log_fhand)
@@ -194,13 +276,38 @@ def main():
     #From now, we are using only mRNA features
     arguments["Annotation"] = mrna_features["outfile"]
 
+    #The assembly is memory-mapped and read by external tools, so
+    #compressed assemblies are decompressed once
+    start_time = time.time()
+    decompressed_assembly = decompress_input(arguments, "Assembly")
+    if decompressed_assembly["command"]:
+        emit_msg(HEADER + "Decompressing Assembly file"+ HEADER + "\n", log_fhand)
+        status = decompressed_assembly["status"]
+        emit_msg("#Decompressing Assembly file, command used: \n\t{}\n".format(decompressed_assembly["command"]), log_fhand)
+        if "Failed" in status:
+            emit_msg(BULLET_FIX + status + "\n", log_fhand)
+        else:
+            emit_msg(BULLET_OK + status + "\n", log_fhand)
+            arguments["Assembly"] = decompressed_assembly["outfile"]
+        emit_msg("Time consumed decompressing Assembly file : {}s\n".format(round(time.time()-start_time,2)), log_fhand)
+
     start_time = time.time()
-    emit_msg(HEADER + "Checking if Assembly file has a correct length format"+ HEADER + "\n", log_fhand)
-    correct_seq_length = correct_fasta_length(arguments)
-    if not correct_seq_length:
+    emit_msg(HEADER + "Indexing Assembly file"+ HEADER + "\n", log_fhand)
+    fasta_index = index_assembly(arguments)
+    end_time = time.time()
+    status = fasta_index["status"]
+    emit_msg("#Indexing Assembly file, command used: \n\t{}\n".format(fasta_index["command"]), log_fhand)
+    if "Failed" in status:
+        emit_msg(BULLET_FIX + status + "\n", log_fhand)
+    else:
+        emit_msg(BULLET_OK + status + "\n", log_fhand)
+    emit_msg("Time consumed indexing Assembly file : {}s\n".format(round(end_time-start_time,2)), log_fhand) 
+    #Tools like gffread need an index, so assemblies with lines of
+    #different lengths are rewritten
+    if not fasta_index["valid"]:
+            start_time = time.time()
             emit_msg(HEADER + "Reformatting Assembly file with seqtk"+ HEADER + "\n", log_fhand)
             reformatted_assembly = reformat_fasta_file(arguments)
-            end_time = time.time()
             status = reformatted_assembly["status"]
             emit_msg("Reformat Assembly file, command used: \n\t{}\n".format(reformatted_assembly["command"]), log_fhand)
             if "Failed" in status:
@@ -208,7 +315,12 @@ def main():
             else:
                 emit_msg(BULLET_OK + status + "\n", log_fhand)
                 arguments["Assembly"] = reformatted_assembly["outfile"]
+                fasta_index = index_assembly(arguments)
+                emit_msg(BULLET_OK + fasta_index["status"] + "\n", log_fhand)
+            end_time = time.time()
             emit_msg("Time consumed reformatting Assembly file : {}s\n".format(round(end_time-start_time,2)), log_fhand) 
+    if fasta_index["valid"]:
+        arguments["Assembly_index"] = fasta_index["outfile"]
 
     start_time = time.time()
     emit_msg(HEADER + "Getting longest isoforms"+ HEADER + "\n", log_fhand)
@@ -220,6 +332,13 @@ def main():
         emit_msg(BULLET_FIX + status + "\n", log_fhand)
     else:
         emit_msg(BULLET_OK + status + "\n", log_fhand)
+    if arguments.get("Longest_isoform_check", False) and "Failed" not in status:
+        check = check_longest_isoform(arguments, longest_isoform["outfile"])
+        emit_msg("#Checking longest isoforms with AGAT, command used: \n\t{}\n".format(check["command"]), log_fhand)
+        if "Failed" in check["status"]:
+            emit_msg(BULLET_FIX + check["status"] + "\n", log_fhand)
+        else:
+            emit_msg(BULLET_OK + check["status"] + "\n", log_fhand)
     emit_msg("Time consumed getting longest isoforms: {}s\n".format(round(end_time-start_time,2)), log_fhand) 
 
 
@@ -228,7 +347,13 @@ def main():
 
     start_time = time.time()
     emit_msg(HEADER + "Extracting CDS and protein sequences" + HEADER + "\n", log_fhand)
-    gffread = run_gffread(arguments)
+    if arguments.get("Sequence_extractor", "native") == "gffread":
+        gffread = run_gffread(arguments)
+    else:
+        gffread = extract_sequences(arguments)
+    for kind in ("proteins", "proteins_longest_isoform"):
+        if "Failed" not in gffread[kind]["status"]:
+            gffread["{}_unique".format(kind)] = deduplicate_sequences(arguments, gffread[kind]["outfile"])
     end_time = time.time()
     for kind, values in gffread.items():
         status =  values["status"]
@@ -238,123 +363,55 @@ def main():
         else:
             emit_msg(BULLET_OK + status + "\n", log_fhand)
     emit_msg("Time consumed extracting CDS and proteins: {}s\n".format(round(end_time-start_time, 2)), log_fhand)
+    return gffread
 
 
-    for analysis in arguments["Analysis"]:
-        if analysis == "AGAT":
-            emit_msg(HEADER + "Running AGAT on the GFF file"+ HEADER + "\n", log_fhand)
-            start_time = time.time()
-            agat = run_agat(arguments)
-            end_time = time.time()
-            for mode, values in agat.items():
-                status = values["status"]
-                emit_msg("#{} command used: \n\t{}\n".format(mode, values["command"]), log_fhand)
-                if "Failed" in status:
-                    emit_msg(BULLET_FIX + status + "\n", log_fhand)
-                else:
-                    emit_msg(BULLET_OK + status + "\n", log_fhand)
-            emit_msg("Time consumed Running AGAT: {}s\n".format(round(end_time-start_time, 2)), log_fhand)       
-
-
-        if analysis == "BUSCO":
-            emit_msg(HEADER + "Running BUSCO"+ HEADER + "\n", log_fhand)
-            start_time = time.time()
-            if not arguments["disable_busco_filter"]:
-                busco_sequences = gffread["proteins_longest_busco"]["outfile"]
-            else:
-                busco_sequences = gffread["proteins_longest_isoform"]["outfile"]
-            busco = run_busco(arguments, busco_sequences)
-            end_time = time.time()
-            for lineage, values in busco.items():
-                status = values["status"]
-                emit_msg("#{} command used: \n\t{}\n".format(lineage, values["command"]), log_fhand)
-                if "Failed" in status:
-                    emit_msg(BULLET_FIX + status + "\n", log_fhand)
-                else:
-                    emit_msg(BULLET_OK + status + "\n", log_fhand)
-            emit_msg("Time consumed Running BUSCO: {}s\n".format(round(end_time-start_time, 2)), log_fhand)  
-
-
-        if analysis == "PSAURON":
-            emit_msg(HEADER + "Running PSAURON"+ HEADER + "\n", log_fhand)
-            start_time = time.time()
-            psauron = run_psauron(arguments, gffread["cds"]["outfile"])
-            end_time = time.time()
-            status = psauron["status"]
-            emit_msg("#PSAURON command used: \n\t{}\n".format(psauron["command"]), log_fhand)
-            if "Failed" in status:
-                emit_msg(BULLET_FIX + status + "\n", log_fhand)
-            else:
-                emit_msg(BULLET_OK + status + "\n", log_fhand)
-            emit_msg("Time consumed Running PSAURON: {}s\n".format(round(end_time-start_time,2)), log_fhand) 
-
-        if analysis == "OMARK":
-            emit_msg(HEADER + "Running OMARK"+ HEADER + "\n", log_fhand)
-            start_time = time.time()
-            omark = run_omark(arguments, gffread["proteins_longest_isoform"]["outfile"])
-            end_time = time.time()
-            for analysis, values in omark.items():
-                status = values["status"]
-                emit_msg("#{} command used: \n\t{}\n".format(analysis, values["command"]), log_fhand)
-                if "Failed" in status:
-                    emit_msg(BULLET_FIX + status + "\n", log_fhand)
-                else:
-                    emit_msg(BULLET_OK + status + "\n", log_fhand)
-            emit_msg("Time consumed Running OMARK: {}s\n".format(round(end_time-start_time,2)), log_fhand) 
+def run_preprocess(arguments):
+    #Used when preprocessing runs in a worker process, like in batch mode
+    with open(Path(arguments["Basedir"]) / "GAQET.log.txt", "a") as log_fhand:
+        gffread = preprocess(arguments, log_fhand)
+    return {"arguments": arguments, "gffread": gffread}
 
-        if analysis == "DETENGA":
-            emit_msg(HEADER + "Running DeTEnGA"+ HEADER + "\n", log_fhand)
-            start_time = time.time()
-            detenga = run_detenga(arguments, gffread["proteins"]["outfile"], gffread["mrna"]["outfile"])
-            end_time = time.time()
-            for analysis, values in detenga.items():
-                status = values["status"]
-                if "Failed" in status:
-                    emit_msg(BULLET_FIX + status + "\n", log_fhand)
-                else:
-                    emit_msg(BULLET_OK + status + "\n", log_fhand)
-            emit_msg("Time consumed Running DeTEnGA: {}s\n".format(round(end_time-start_time, 2)), log_fhand)
-        
 
-        if analysis == "PROTHOMOLOGY":
-            emit_msg(HEADER + "Running Protein homology"+ HEADER + "\n", log_fhand)
-            start_time = time.time()
-            protein_homology = run_protein_homology(arguments, gffread["proteins"]["outfile"])
-            end_time = time.time()
-            for db, values in protein_homology.items():
-                status = values["status"]
-                emit_msg("#{} command used: \n\t{}\n".format(db, values["command"]), log_fhand)
-                if "Failed" in status:
-                    emit_msg(BULLET_FIX + status + "\n", log_fhand)
-                else:
-                    emit_msg(BULLET_OK + status + "\n", log_fhand)
-            emit_msg("Time consumed Running Protein homology: {}s\n".format(round(end_time-start_time, 2)), log_fhand)
+def mark_pending_analysis(arguments, analysis, log_fhand):
+    previous_states = read_manifest(arguments)["analysis"]
+    finished = [name for name in analysis if previous_states.get(name) == DONE]
+    unfinished = [name for name in analysis if name not in finished]
+    if previous_states:
+        emit_msg("#Resuming previous run. Finished analysis: {}. Analysis to run: {}\n".format(", ".join(finished) or "None",
+                                                                                               ", ".join(unfinished) or "None"), log_fhand)
+    for name in analysis:
+        set_analysis_state(arguments, name, PENDING)
 
 
+def collect_results(arguments, reports):
     #Get results from analysis
     results = {}
     for analysis in arguments["Analysis"]:
         if analysis == "AGAT":
+            agat = reports["AGAT"]
             results.update(parse_agat_stats(agat))
             results.update(parse_agat_premature(agat))
             results.update(parse_agat_incomplete(agat))
             intron_threshold = arguments.get("Intron_Threshold", 100)
             results.update(parse_agat_introns(agat, intron_threshold))
         if analysis == "BUSCO":
-            busco_results = busco_stats(busco)
+            busco_results = busco_stats(reports["BUSCO"])
             for lineage, stats in busco_results.items():
                 results["Annotation_BUSCO_{}".format(lineage)] = stats
         if analysis == "OMARK":
-            results.update(omark_stats(omark))
+            results.update(omark_stats(reports["OMARK"]))
         if analysis == "PSAURON":
-            results.update(psauron_stats(psauron))
+            results.update(psauron_stats(reports["PSAURON"]))
         if analysis == "DETENGA":
             results.update(detenga_stats(results["Transcript_Models (N)"], 
-                                         detenga["create_summary"]["outfile"]))
+                                         reports["DETENGA"]["create_summary"]["outfile"]))
         if analysis == "PROTHOMOLOGY":
-            results.update(protein_homology_stats(protein_homology, results["Transcript_Models (N)"]))
+            results.update(protein_homology_stats(reports["PROTHOMOLOGY"], results["Transcript_Models (N)"]))
+    return results
 
 
+def write_stats(arguments, results):
     outfile = Path(arguments["Basedir"]) / "{}_GAQET.stats.tsv".format(arguments["ID"])
     with open(outfile, "w") as out_fhand:
         header = ["Species", "NCBI_TaxID", "Assembly_Version", "Annotation_Version"] + [stats for stats in results]
@@ -362,9 +419,43 @@ def main():
         row = [arguments["ID"], str(arguments["OMARK_taxid"]), Path(arguments["Assembly"]).name, Path(arguments["Annotation"]).name]
         row += [str(value) for stats, value in results.items()]
         out_fhand.write("{}\n".format("\t".join(row)))
+    return outfile
+
+
+def main():
+    sys.tracebacklimit = 0
+    if '--version' in sys.argv or "-v" in sys.argv:
+        print(VERSION)
+        sys.exit(0)
+    arguments, config_report, command_used = get_arguments()
+    log_fhand = start_run(arguments, config_report, command_used)
+
+    #Run analysis
+    overall_start = time.time()
+    gffread = preprocess(arguments, log_fhand)
+    analysis_times = {"PREPROCESS": time.time() - overall_start}
+
+    analysis_steps = build_analysis_steps(arguments, gffread)
+    mark_pending_analysis(arguments, analysis_steps, log_fhand)
+
+    def on_launch(analysis, threads):
+        set_analysis_state(arguments, analysis, RUNNING)
+        emit_msg(HEADER + "Running {} ({} threads)".format(ANALYSIS_NAMES[analysis], threads) + HEADER + "\n", log_fhand)
+
+    def on_finish(analysis, report, elapsed):
+        set_analysis_state(arguments, analysis, get_analysis_state(report))
+        log_analysis_report(analysis, report, elapsed, log_fhand)
+        analysis_times[analysis] = elapsed
+
+    reports = run_dag(analysis_steps, arguments, arguments["Threads"],
+                      on_launch=on_launch, on_finish=on_finish)
+
+    results = collect_results(arguments, reports)
+    write_stats(arguments, results)
+    write_metrics_report(arguments, VERSION, analysis_times)
     overall_end = time.time()
     emit_msg("GAQET finished successfully at {}, runtime: {} minutes".format(time.ctime(), str((overall_end-overall_start)/60)), log_fhand)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
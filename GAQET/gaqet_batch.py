@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+
+import argparse
+import sys
+import time
+
+from argparse import RawTextHelpFormatter
+from functools import partial
+from pathlib import Path
+from yaml import YAMLError
+
+from GAQET.gaqet import (BULLET_FIX, HEADER, MULTITHREAD_ANALYSIS, VERSION, build_analysis_steps,
+                         collect_results, emit_msg, get_analysis_state, get_command_used,
+                         get_memory_requirement, load_config, log_analysis_report,
+                         mark_pending_analysis, prepare_config, run_preprocess, start_run,
+                         write_stats, ANALYSIS_NAMES)
+from src.cache import set_analysis_state, FAILED, RUNNING
+from src.metrics import write_metrics_report
+from src.scheduler import run_dag
+
+
+PREPROCESS = "PREPROCESS"
+
+
+def parse_arguments():
+    description = '''\t\t\t#####################\n\t\t\t##   GAQET BATCH   ##\n\t\t\t#####################\n
+            Runs GAQET on many annotations sharing a single pool of workers\n
+
+            Needs a file with a GAQET YAML configuration file path per line.'''
+    parser = argparse.ArgumentParser(description=description, formatter_class=RawTextHelpFormatter)
+
+    help_manifest = "(Required) File with a YAML configuration file path per line"
+    parser.add_argument("--manifest", "-i",
+                        help=help_manifest, required=True)
+
+    help_threads = "(Required) Threads shared by all the analysis"
+    parser.add_argument("--threads", "-t", type=int,
+                        help=help_threads, required=True)
+
+    help_memory = "(Optional) Memory (GB) shared by all the analysis. Unlimited by default"
+    parser.add_argument("--memory", "-m", type=float,
+                        help=help_memory, default=0)
+
+    help_step_threads = "(Optional) Minimum threads given to each multithreaded analysis. 4 by default"
+    parser.add_argument("--step_threads", "-p", type=int,
+                        help=help_step_threads, default=4)
+
+    help_outbase = "(Optional) Directory for the combined results. Species without Basedir are stored here. Current directory by default"
+    parser.add_argument("--outbase", "-o", type=str,
+                        help=help_outbase, default="./")
+
+    help_version = "Print version and exit"
+    parser.add_argument("--version", "-v", type=str,
+                        help=help_version, default="")
+
+    if len(sys.argv)==1:
+        parser.print_help()
+        exit()
+    return parser.parse_args()
+
+
+def read_batch_manifest(fpath):
+    yaml_fpaths = []
+    with open(fpath) as fhand:
+        for line in fhand:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            yaml_fpaths.append(Path(line))
+    return yaml_fpaths
+
+
+def prepare_analysis(preprocess_step, analysis, reports):
+    #Analysis inputs are only known once the annotation has been preprocessed
+    preprocessed = reports[preprocess_step]
+    step = build_analysis_steps(preprocessed["arguments"], preprocessed["gffread"])[analysis]
+    return {"function": step["function"], "config": preprocessed["arguments"],
+            "args": step["args"]}
+
+
+def build_batch_steps(species):
+    steps = {}
+    for species_id, values in species.items():
+        arguments = values["arguments"]
+        preprocess_step = "{}:{}".format(species_id, PREPROCESS)
+        steps[preprocess_step] = {"function": run_preprocess, "config": arguments,
+                                  "depends": [], "multithread": False,
+                                  "memory": get_memory_requirement(arguments, PREPROCESS)}
+        for analysis in arguments["Analysis"]:
+            steps["{}:{}".format(species_id, analysis)] = {"prepare": partial(prepare_analysis, preprocess_step, analysis),
+                                                           "depends": [preprocess_step],
+                                                           "multithread": analysis in MULTITHREAD_ANALYSIS,
+                                                           "memory": get_memory_requirement(arguments, analysis)}
+    return steps
+
+
+def write_combined_stats(stats_fpaths, outfile):
+    header = []
+    rows = []
+    for stats_fpath in stats_fpaths:
+        with open(stats_fpath) as fhand:
+            columns = fhand.readline().rstrip("\n").split("\t")
+            values = fhand.readline().rstrip("\n").split("\t")
+        header += [column for column in columns if column not in header]
+        rows.append(dict(zip(columns, values)))
+    with open(outfile, "w") as out_fhand:
+        out_fhand.write("{}\n".format("\t".join(header)))
+        for row in rows:
+            out_fhand.write("{}\n".format("\t".join([row.get(column, "NA") for column in header])))
+    return outfile
+
+
+def main():
+    sys.tracebacklimit = 0
+    if '--version' in sys.argv or "-v" in sys.argv:
+        print(VERSION)
+        sys.exit(0)
+    parser = parse_arguments()
+    outbase = Path(parser.outbase).absolute()
+    if not outbase.exists():
+        outbase.mkdir(parents=True, exist_ok=True)
+    batch_log_fhand = open(outbase / "GAQET_batch.log.txt", "w")
+    header = "\t\t\t#####################\n\t\t\t##   GAQET BATCH   ##\n\t\t\t#####################\n\n" + VERSION + "\n" + time.ctime() + "\n"
+    emit_msg(header, batch_log_fhand)
+
+    species = {}
+    for yaml_fpath in read_batch_manifest(parser.manifest):
+        #A broken YAML only skips its own species, AttributeError comes
+        #from documents which are not a mapping
+        try:
+            arguments = load_config(yaml_fpath)
+            if arguments.get("ID") and not arguments.get("Basedir"):
+                arguments["Basedir"] = outbase / "_".join(arguments["ID"].split())
+            config_report = prepare_config(arguments)
+        except (AttributeError, KeyError, OSError, YAMLError) as error:
+            emit_msg(BULLET_FIX + "{} skipped: {}: {}\n".format(yaml_fpath, type(error).__name__, error), batch_log_fhand)
+            continue
+        if arguments["ID"] in species:
+            emit_msg(BULLET_FIX + "{} skipped, ID {} is duplicated\n".format(yaml_fpath, arguments["ID"]), batch_log_fhand)
+            continue
+        command_used = get_command_used("GAQET", yaml_fpath, arguments)
+        try:
+            log_fhand = start_run(arguments, config_report, command_used)
+        except RuntimeError as error:
+            emit_msg(BULLET_FIX + "{} skipped: {}\n".format(arguments["ID"], error), batch_log_fhand)
+            continue
+        #Preprocessing is logged by the workers, so the log is appended from now on
+        log_fhand.close()
+        #ValueError comes from a corrupted run manifest
+        try:
+            log_fhand = open(Path(arguments["Basedir"]) / "GAQET.log.txt", "a")
+            mark_pending_analysis(arguments, arguments["Analysis"], log_fhand)
+        except (KeyError, OSError, ValueError) as error:
+            if not log_fhand.closed:
+                log_fhand.close()
+            emit_msg(BULLET_FIX + "{} skipped: {}: {}\n".format(arguments["ID"], type(error).__name__, error), batch_log_fhand)
+            continue
+        species[arguments["ID"]] = {"arguments": arguments, "log": log_fhand, "reports": {},
+                                    "times": {}, "failed": []}
+
+    overall_start = time.time()
+
+    def finish_species(species_id):
+        values = species[species_id]
+        if values["failed"]:
+            #Stats of the analysis that crashed are left as NA
+            finished = dict(values["arguments"], Analysis=[analysis for analysis in values["arguments"]["Analysis"]
+                                                           if analysis in values["reports"]])
+            try:
+                results = collect_results(finished, values["reports"])
+            except (KeyError, OSError, ValueError):
+                results = {}
+        else:
+            results = collect_results(values["arguments"], values["reports"])
+        values["stats"] = write_stats(values["arguments"], results)
+        write_metrics_report(values["arguments"], VERSION, values["times"])
+        if values["failed"]:
+            emit_msg("GAQET finished with failed analysis ({}) at {}".format(", ".join(values["failed"]), time.ctime()), values["log"])
+            emit_msg(BULLET_FIX + "{}: analysis finished, {} failed\n".format(species_id, ", ".join(values["failed"])), batch_log_fhand)
+        else:
+            emit_msg("GAQET finished successfully at {}".format(time.ctime()), values["log"])
+            emit_msg("{}: all analysis finished\n".format(species_id), batch_log_fhand)
+        values["log"].close()
+
+    def is_finished(values):
+        return len(values["reports"]) + len(values["failed"]) == len(values["arguments"]["Analysis"])
+
+    def on_launch(step, threads):
+        species_id, analysis = step.rsplit(":", 1)
+        values = species[species_id]
+        if analysis == PREPROCESS:
+            emit_msg(HEADER + "{}: preprocessing annotation".format(species_id) + HEADER + "\n", batch_log_fhand)
+        else:
+            set_analysis_state(values["arguments"], analysis, RUNNING)
+            emit_msg(HEADER + "Running {} ({} threads)".format(ANALYSIS_NAMES[analysis], threads) + HEADER + "\n", values["log"])
+
+    def on_finish(step, report, elapsed):
+        species_id, analysis = step.rsplit(":", 1)
+        values = species[species_id]
+        values["times"][analysis] = elapsed
+        if analysis == PREPROCESS:
+            values["arguments"] = report["arguments"]
+            emit_msg("{}: preprocessing finished in {}s\n".format(species_id, round(elapsed, 2)), batch_log_fhand)
+        else:
+            set_analysis_state(values["arguments"], analysis, get_analysis_state(report))
+            log_analysis_report(analysis, report, elapsed, values["log"])
+            values["reports"][analysis] = report
+        if is_finished(values):
+            finish_species(species_id)
+
+    def on_error(step, error, skipped):
+        #A crashed step fails its analysis, or all of them if it is the
+        #preprocessing, and the other species go on
+        species_id, analysis = step.rsplit(":", 1)
+        values = species[species_id]
+        emit_msg(BULLET_FIX + "{}: {} Failed: \n {}\n".format(species_id, analysis, error), batch_log_fhand)
+        emit_msg(BULLET_FIX + "{} Failed: \n {}\n".format(analysis, error), values["log"])
+        for failed_step in [step] + skipped:
+            failed_analysis = failed_step.rsplit(":", 1)[1]
+            if failed_analysis == PREPROCESS:
+                continue
+            set_analysis_state(values["arguments"], failed_analysis, FAILED)
+            values["failed"].append(failed_analysis)
+        if is_finished(values):
+            finish_species(species_id)
+
+    memory = parser.memory if parser.memory > 0 else None
+    run_dag(build_batch_steps(species), {}, parser.threads, on_launch=on_launch,
+            on_finish=on_finish, memory=memory, min_threads=parser.step_threads,
+            on_error=on_error)
+
+    stats_fpaths = [values["stats"] for values in species.values() if "stats" in values]
+    combined_outfile = write_combined_stats(stats_fpaths, outbase / "GAQET_batch.stats.tsv")
+    overall_end = time.time()
+    emit_msg("Combined results stored at {}".format(combined_outfile), batch_log_fhand)
+    emit_msg("GAQET batch finished successfully at {}, runtime: {} minutes".format(time.ctime(), str((overall_end-overall_start)/60)), batch_log_fhand)
+
+
+if __name__ == "__main__":
+    main()
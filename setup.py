@@ -9,6 +9,7 @@ setup(
         entry_points={
                      'console_scripts': [
                                          'GAQET=GAQET.gaqet:main',
+                                         'GAQET_BATCH=GAQET.gaqet_batch:main',
                                          'GAQET_PLOT=GAQET.gaqet_plot:main'
                                                                 ],},
         author='Victor Garcia-Carpintero Burgos',
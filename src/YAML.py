@@ -5,6 +5,10 @@ from pathlib import Path
 
 from importlib.resources import files
 
+from src.agat import STATS_ENGINES
+from src.homology import DIAMOND_SENSITIVITIES, HOMOLOGY_MODES
+from src.sequences import SEQUENCE_EXTRACTORS
+
 
 BUSCO_LINEAGES = Path(files('GAQET').joinpath("docs/busco_lineages.txt"))
 BULLET_OK = "\t✓\t"
@@ -118,11 +122,29 @@ def check_prothomology_dbs(yaml):
             for tag, path in db.items():
                 if not Path(path).is_file():
                     errors.append(BULLET_FIX + "Protein database for tag {} doesn't exists".format(tag))
+    if yaml.get("Homology_mode", "presence") not in HOMOLOGY_MODES:
+        errors.append(BULLET_FIX + "Homology_mode {} is not valid. Available options are {}".format(yaml["Homology_mode"], ",".join(HOMOLOGY_MODES)))
+    if yaml.get("Homology_sensitivity") and yaml["Homology_sensitivity"] not in DIAMOND_SENSITIVITIES:
+        errors.append(BULLET_FIX + "Homology_sensitivity {} is not valid. Available options are {}".format(yaml["Homology_sensitivity"], ",".join(DIAMOND_SENSITIVITIES)))
     if len(errors) == 0:
         errors = [BULLET_OK +  "All protein databases are valid"]
     return errors
     
 
+def check_stats_engine(yaml):
+    stats_engine = yaml.get("Stats_engine", "native")
+    if stats_engine not in STATS_ENGINES:
+        return [BULLET_FIX + "Stats_engine {} is not valid. Available options are {}".format(stats_engine, ",".join(STATS_ENGINES))]
+    return [BULLET_OK + "Stats_engine {} is valid".format(stats_engine)]
+
+
+def check_sequence_extractor(yaml):
+    sequence_extractor = yaml.get("Sequence_extractor", "native")
+    if sequence_extractor not in SEQUENCE_EXTRACTORS:
+        return [BULLET_FIX + "Sequence_extractor {} is not valid. Available options are {}".format(sequence_extractor, ",".join(SEQUENCE_EXTRACTORS))]
+    return [BULLET_OK + "Sequence_extractor {} is valid".format(sequence_extractor)]
+
+
 def check_OMARK_db(yaml):
     errors = []
     not_defined = False
@@ -162,9 +184,14 @@ def report_yaml_file(yaml):
     report = []
     report += [HEADER + "Checking if all required inputs are present" + HEADER]
     report += check_required_inputs(yaml)
+    report += [HEADER + "Checking if the sequence extractor is valid" + HEADER]
+    report += check_sequence_extractor(yaml)
     report += [HEADER + "Checking if all analysis are valid" + HEADER]
     report += check_available_analysis(yaml)
     if yaml["Analysis"]:
+        if "AGAT" in yaml["Analysis"]:
+            report += [HEADER + "Checking if the stats engine is valid" + HEADER]
+            report += check_stats_engine(yaml)
         if "BUSCO" in yaml["Analysis"]:
             report += [HEADER + "Checking if BUSCO lineages are valid" + HEADER]
             report += check_busco_lineages(yaml)
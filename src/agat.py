@@ -1,134 +1,117 @@
 import subprocess
 from pathlib import Path
 
+from src.agat_parsers import parse_agat_stats
+from src.cds_checks import run_cds_checks
+from src.cache import fail_step, record_step, run_atomic, start_step, step_done
+from src.gff import get_gff_transcript_ids
+from src.gff_stats import run_annotation_stats, run_intron_stats
 
-def get_longest_isoform(config):
-    report = {}
-    outdir = Path(config["Basedir"]) / "input_sequences"
-    if not outdir.exists():
-        outdir.mkdir(parents=True, exist_ok=True)
-    outfile = outdir / "{}.longest_isoform.gff3".format(Path(config["Assembly"]).stem)
+
+STATS_ENGINES = ["native", "agat", "both"]
+
+
+def get_agat_longest_isoform(config, outfile):
+    #Reference implementation of src.gff.get_longest_isoform
     cmd = "agat_sp_keep_longest_isoform.pl --gff {} -o {}".format(Path(config["Annotation"]), outfile)
-    if outfile.exists():
+    inputs = [config["Annotation"]]
+    if step_done(config, outfile, cmd, inputs):
         msg = "Longest isoform from annotation file selected already"
     else:
-        run_ = subprocess.run(cmd, shell=True, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL)   
+        start_step(config, outfile, cmd)
+        run_ = run_atomic(cmd, outfile, config, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL)   
         if run_.returncode == 0:
+            record_step(config, outfile, cmd, inputs)
             msg = "AGAT longest isoform run successfully"
         else:
+            fail_step(config, outfile, cmd)
             msg = "AGAT longest isoform Failed: \n {}".format(run_.stdout)
     report = {"command": cmd, "status": msg, 
               "outfile": outfile}
     return report
-    
 
-def split_annotation(config):
-    report = {}
-    outdir = Path(config["Basedir"]) / "input_sequences"
-    outfile = outdir / "mrna.gff"
-    cmd = "agat_sp_separate_by_record_type.pl  --gff {} -o {}".format(config["Annotation"],
-                                                                      outdir)
-    if outfile.exists():
-        msg = "Annotation splitting by feature type done already"
+
+def check_longest_isoform(config, outfile):
+    #AGAT is run as reference, both selections must contain the same transcripts
+    agat_outfile = outfile.parent / "{}.agat.gff3".format(outfile.stem)
+    report = get_agat_longest_isoform(config, agat_outfile)
+    if "Failed" in report["status"]:
+        return report
+    native = get_gff_transcript_ids(outfile)
+    agat = get_gff_transcript_ids(agat_outfile)
+    if native == agat:
+        report["status"] += ", AGAT selected the same {} transcripts".format(len(native))
     else:
-        run_ = subprocess.run(cmd, shell=True, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL)   
-        if run_.returncode == 0:
-            msg = "AGAT separate by type run successfully"
-        else:
-            msg = "AGAT separate by type Failed: \n {}".format(run_.stdout)
-    report = {"command": cmd, "status": msg, 
-              "outfile": outfile}
+        report["status"] += ", check Failed: {} transcripts only selected natively, {} only selected by AGAT".format(len(native - agat),
+                                                                                                                    len(agat - native))
     return report
 
 
+def compare_stats(native_report, agat_report):
+    native = parse_agat_stats({"Annotation stats": native_report})
+    agat = parse_agat_stats({"AGAT stats": agat_report})
+    differences = ["{} ({} vs {})".format(key, native[key], agat[key]) for key in native
+                   if native[key] != agat[key]]
+    if differences:
+        msg = "Native stats differ from AGAT stats in: {}".format(", ".join(differences))
+    else:
+        msg = "Native stats match AGAT stats"
+    return {"command": "", "status": msg}
+    
+
 def run_agat(config):
     report = {}
     outdir = Path(config["Basedir"]) / "AGAT_run"
     if not outdir.exists():
         outdir.mkdir(parents=True, exist_ok=True)
     annot = config["Annotation"]
-    assembly = config["Assembly"]
 
-    #Running AGAT STATS
-    stats_outfile = outdir / "{}.01_agat_stats.txt".format(config["ID"])
-    cmd = "agat_sp_statistics.pl --gff {} -o {}".format(annot, stats_outfile)
+    #Annotation stats are computed natively, AGAT stats are run as
+    #fallback or as a reference if asked in the YAML Stats_engine
+    stats_engine = config.get("Stats_engine", "native")
+    native_failed = False
+    if stats_engine != "agat":
+        native_outfile = outdir / "{}.01_annotation_stats.tsv".format(config["ID"])
+        report["Annotation stats"] = run_annotation_stats(config, native_outfile)
+        native_failed = "Failed" in report["Annotation stats"]["status"]
+        if native_failed:
+            report["Annotation stats"]["status"] = report["Annotation stats"]["status"].replace("Failed", "failed, running AGAT stats instead")
+
+    if stats_engine != "native" or native_failed:
+        #Running AGAT STATS
+        stats_outfile = outdir / "{}.01_agat_stats.txt".format(config["ID"])
+        cmd = "agat_sp_statistics.pl --gff {} -o {}".format(annot, stats_outfile)
+
+        inputs = [annot]
+        if step_done(config, stats_outfile, cmd, inputs):
+            msg = "AGAT stats already done"
 
-    if stats_outfile.is_file():
-        msg = "AGAT stats already done"
-
-    else:
-        run_ = subprocess.run(cmd, shell=True, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL)
-        #Is process has gone well
-        if run_.returncode == 0:
-            msg = "AGAT stats run successfully"
-        #But if not
         else:
-            msg = "AGAT stats Failed: \n {}".format(run_.stdout)
-    
-    report["AGAT stats"] = {"command": cmd, "status": msg, 
-                            "outfile": stats_outfile}
-    
-    #Running AGAT premature stop codons
-    premature_stop_outfile = outdir / "{}.01_agat_premature_stop.txt".format(config["ID"])
-    cmd = "agat_sp_flag_premature_stop_codons.pl --gff {} --fasta {} -o {}".format(annot, 
-                                                                                   assembly,
-                                                                                   premature_stop_outfile)
-    
-    if premature_stop_outfile.is_file():
-        msg = "AGAT premature stop codons analysis already done"
-
-    else:
-        run_ = subprocess.run(cmd, shell=True, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL)
-        #Is process has gone well
-        if run_.returncode == 0:
-            msg = "AGAT premature stop codons analysis run successfully"
-        #But if not
-        else:
-            msg = "AGAT premature stop codons analysis Failed: \n {}".format(run_.stdout)
-    
-    report["AGAT stop codons"] = {"command": cmd, "status": msg, 
-                                  "outfile": premature_stop_outfile}
+            start_step(config, stats_outfile, cmd)
+            run_ = run_atomic(cmd, stats_outfile, config, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL)
+            #Is process has gone well
+            if run_.returncode == 0:
+                record_step(config, stats_outfile, cmd, inputs)
+                msg = "AGAT stats run successfully"
+            #But if not
+            else:
+                fail_step(config, stats_outfile, cmd)
+                msg = "AGAT stats Failed: \n {}".format(run_.stdout)
     
+        report["AGAT stats"] = {"command": cmd, "status": msg, 
+                                "outfile": stats_outfile}
 
-    #Running AGAT incomplete CDS
-    incomplete_cds_outfile = outdir / "{}.01_agat_incomplete.txt".format(config["ID"])
-    cmd = "agat_sp_filter_incomplete_gene_coding_models.pl --add_flag --gff {} ".format(annot)
-    cmd += "--fasta {} -o {}".format(assembly, incomplete_cds_outfile)
+    if stats_engine == "both" and not native_failed and "Failed" not in report["AGAT stats"]["status"]:
+        report["Stats check"] = compare_stats(report["Annotation stats"], report["AGAT stats"])
     
-    if incomplete_cds_outfile.is_file():
-        msg = "AGAT incomplete CDS analysis already done"
- 
-    else:
-        run_ = subprocess.run(cmd, shell=True, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL)
-        #Is process has gone well
-        if run_.returncode == 0:
-            msg = "AGAT incomplete CDS analysis run successfully"
-        #But if not
-        else:
-            msg = "AGAT incomplete CDS analysis Failed: \n {}".format(run_.stdout)
-    
-    report["AGAT incomplete CDS"] = {"command": cmd, "status": msg, 
-                                     "outfile": incomplete_cds_outfile}
-
-    #Running AGAT add introns (materializes intron features so their
-    #individual lengths can be parsed downstream)
-    introns_outfile = outdir / "{}.01_agat_introns.gff3".format(config["ID"])
-    cmd = "agat_sp_add_introns.pl --gff {} --out {}".format(annot, introns_outfile)
-
-    if introns_outfile.is_file():
-        msg = "AGAT add introns already done"
-
-    else:
-        run_ = subprocess.run(cmd, shell=True, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL)
-        #Is process has gone well
-        if run_.returncode == 0:
-            msg = "AGAT add introns run successfully"
-        #But if not
-        else:
-            msg = "AGAT add introns Failed: \n {}".format(run_.stdout)
-
-    report["AGAT introns"] = {"command": cmd, "status": msg,
-                              "outfile": introns_outfile}
+    #Start, stop and early stop codons are checked in a single pass
+    cds_checks_outfile = outdir / "{}.01_cds_checks.tsv".format(config["ID"])
+    report["CDS checks"] = run_cds_checks(config, cds_checks_outfile)
+
+    #Intron lengths are measured from the exons of each transcript
+    introns_outfile = outdir / "{}.01_intron_lengths.npy".format(config["ID"])
+    histogram_outfile = outdir / "{}.01_intron_lengths_histogram.tsv".format(config["ID"])
+    report["Introns"] = run_intron_stats(config, introns_outfile, histogram_outfile)
     return report
 
 
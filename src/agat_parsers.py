@@ -1,5 +1,40 @@
+import numpy as np
+
 from src.error_check import operation_failed
 
+
+#Labels of the AGAT stats report, also used by the native stats engine
+AGAT_STATS_KEYS = {
+    "Number of gene": "Gene_Models (N)",
+    "Number of mrna": "Transcript_Models (N)",
+    "Number of cds": "CDS_Models (N)",
+    "Number of exon": "Exons (N)",
+    "Number of five_prime_utr": "UTR5' (N)",
+    "Number of three_prime_utr": "UTR3' (N)",
+    "Number of mrnas with utr both sides": "Both sides UTR' (N)", 
+    "Number gene overlapping": "Overlapping_Gene_Models (N)",
+    "Number of single exon gene": "Single Exon Gene Models (N)",
+    "Number of single exon mrna": "Single Exon Transcripts (N)",
+    "Total gene length (bp)": "Total Gene Space (Mb)",
+    "mean gene length (bp)": "Mean Gene Model Length (bp)",
+    "mean cds length (bp)": "Mean CDS Model Length (bp)",
+    "mean exon length (bp)": "Mean Exon Length (bp)",
+    "mean intron in cds length (bp)": "Mean Intron Length (bp)",
+    "Longest gene (bp)": "Longest Gene Model Length (bp)",
+    "Longest cds (bp)": "Longest CDS Model Length (bp)",
+    "Longest intron into cds part (bp)": "Longest Intron Length (bp)",
+    "Shortest gene (bp)": "Shortest Gene Model Length (bp)",
+    "Shortest cds piece (bp)": "Shortest CDS Model Length (bp)",
+    "Shortest intron into cds part (bp)": "Shortest Intron Length (bp)"
+}
+
+
+def get_stats_value(result_key, value):
+    if result_key == "Total Gene Space (Mb)":
+        return round(value / 1_000_000, 2)
+    return value
+
+
 def parse_agat_stats(agat_results):
     results = {
         "Gene_Models (N)": 0,
@@ -24,29 +59,15 @@ def parse_agat_stats(agat_results):
         "Shortest CDS Model Length (bp)": 0,
         "Shortest Intron Length (bp)": 0
     }
-    mapping = {
-        "Number of gene": "Gene_Models (N)",
-        "Number of mrna": "Transcript_Models (N)",
-        "Number of cds": "CDS_Models (N)",
-        "Number of exon": "Exons (N)",
-        "Number of five_prime_utr": "UTR5' (N)",
-        "Number of three_prime_utr": "UTR3' (N)",
-        "Number of mrnas with utr both sides": "Both sides UTR' (N)", 
-        "Number gene overlapping": "Overlapping_Gene_Models (N)",
-        "Number of single exon gene": "Single Exon Gene Models (N)",
-        "Number of single exon mrna": "Single Exon Transcripts (N)",
-        "Total gene length (bp)": "Total Gene Space (Mb)",
-        "mean gene length (bp)": "Mean Gene Model Length (bp)",
-        "mean cds length (bp)": "Mean CDS Model Length (bp)",
-        "mean exon length (bp)": "Mean Exon Length (bp)",
-        "mean intron in cds length (bp)": "Mean Intron Length (bp)",
-        "Longest gene (bp)": "Longest Gene Model Length (bp)",
-        "Longest cds (bp)": "Longest CDS Model Length (bp)",
-        "Longest intron into cds part (bp)": "Longest Intron Length (bp)",
-        "Shortest gene (bp)": "Shortest Gene Model Length (bp)",
-        "Shortest cds piece (bp)": "Shortest CDS Model Length (bp)",
-        "Shortest intron into cds part (bp)": "Shortest Intron Length (bp)"
-    }
+    #Native stats are used unless they failed and AGAT was run as fallback
+    if "Annotation stats" in agat_results and not operation_failed(agat_results["Annotation stats"]):
+        with open(agat_results["Annotation stats"]["outfile"]) as stats_fhand:
+            for line in stats_fhand:
+                key, val = line.rstrip("\n").split("\t")
+                if key in AGAT_STATS_KEYS:
+                    result_key = AGAT_STATS_KEYS[key]
+                    results[result_key] = get_stats_value(result_key, int(val))
+        return results
 
     error = operation_failed(agat_results["AGAT stats"])
     if error:
@@ -68,20 +89,26 @@ def parse_agat_stats(agat_results):
                     key, val = line.rsplit(maxsplit=1)
                     key = key.strip()
                     val = int(val.strip())
-                    if key in mapping:
-                        result_key = mapping[key]
-                        if result_key == "Total Gene Space (Mb)":
-                            results[result_key] = round(val / 1_000_000, 2)
-                        else:
-                            results[result_key] = val
+                    if key in AGAT_STATS_KEYS:
+                        result_key = AGAT_STATS_KEYS[key]
+                        results[result_key] = get_stats_value(result_key, val)
                 except ValueError:
                     continue  # Skip lines that can't be parsed
 
     return results
 
 
+def read_cds_checks(agat_results):
+    #Yields the incomplete flag and the early stop flag of each flagged transcript
+    with open(agat_results["CDS checks"]["outfile"]) as fhand:
+        fhand.readline()
+        for line in fhand:
+            _, incomplete, early_stop = line.rstrip("\n").split("\t")
+            yield int(incomplete), early_stop == "1"
+
+
 def parse_agat_incomplete(agat_results):
-    error = operation_failed(agat_results["AGAT incomplete CDS"])
+    error = operation_failed(agat_results["CDS checks"])
     if error:
         return {"Models START missing": error,
                 "Models STOP missing": error,
@@ -89,62 +116,45 @@ def parse_agat_incomplete(agat_results):
     results = {"Models START missing": 0,
                "Models STOP missing": 0,
                "Models START & STOP missing":0}
-    with open(agat_results["AGAT incomplete CDS"]["outfile"]) as fhand:
-        for line in fhand:
-            if "incomplete=1" in line:
-                results["Models START missing"] += 1
-            if "incomplete=2" in line:
-                results["Models STOP missing"] += 1
-            if "incomplete=3" in line:
-                results["Models START & STOP missing"] += 1
+    keys = {1: "Models START missing", 2: "Models STOP missing",
+            3: "Models START & STOP missing"}
+    for incomplete, _ in read_cds_checks(agat_results):
+        if incomplete in keys:
+            results[keys[incomplete]] += 1
     return results
 
 
 def parse_agat_introns(agat_results, threshold):
-    """Compute intron count and % of introns shorter than `threshold` bp.
+    """Compute intron count and % of introns shorter than each threshold (bp).
 
-    Relies on the GFF3 produced by agat_sp_add_introns.pl (report key
-    "AGAT introns"), which materializes explicit intron features so their
-    individual lengths can be measured directly, rather than only the
-    aggregate mean/longest/shortest values AGAT stats reports.
+    threshold can be a single length or a list of them. Intron lengths
+    are read from the array stored by the "Introns" step.
     """
-    result_key = "% Introns < {}bp".format(threshold)
-    error = operation_failed(agat_results["AGAT introns"])
+    thresholds = threshold if isinstance(threshold, (list, tuple)) else [threshold]
+    result_keys = ["% Introns < {}bp".format(threshold) for threshold in thresholds]
+    error = operation_failed(agat_results["Introns"])
     if error:
-        return {"Introns (N)": error, result_key: error}
-
-    intron_lengths = []
-    with open(agat_results["AGAT introns"]["outfile"]) as fhand:
-        for line in fhand:
-            if line.startswith("#") or not line.strip():
-                continue
-            fields = line.rstrip("\n").split("\t")
-            if len(fields) < 5 or fields[2] != "intron":
-                continue
-            try:
-                start, end = int(fields[3]), int(fields[4])
-            except ValueError:
-                continue
-            intron_lengths.append(abs(end - start) + 1)
+        return dict.fromkeys(["Introns (N)"] + result_keys, error)
 
+    intron_lengths = np.load(agat_results["Introns"]["outfile"])
     total_introns = len(intron_lengths)
-    if total_introns == 0:
-        return {"Introns (N)": 0, result_key: 0.0}
-
-    shorter_count = sum(1 for length in intron_lengths if length < threshold)
-    percentage = round(100 * shorter_count / total_introns, 2)
-    return {"Introns (N)": total_introns, result_key: percentage}
+    results = {"Introns (N)": total_introns}
+    for threshold, result_key in zip(thresholds, result_keys):
+        if total_introns == 0:
+            results[result_key] = 0.0
+        else:
+            shorter_count = int((intron_lengths < threshold).sum())
+            results[result_key] = round(100 * shorter_count / total_introns, 2)
+    return results
 
 
 def parse_agat_premature(agat_results):
-    error = operation_failed(agat_results["AGAT stop codons"])
+    error = operation_failed(agat_results["CDS checks"])
     if error:
         return {"Models with early STOP": error}
     results = {"Models with early STOP": 0}
-    with open(agat_results["AGAT stop codons"]["outfile"]) as fhand:
-        for line in fhand:
-            if "genes have been flagged as pseudogene" in line:
-                results["Models with early STOP"] = int(line.split())
+    for _, early_stop in read_cds_checks(agat_results):
+        results["Models with early STOP"] += early_stop
     return results
 
 
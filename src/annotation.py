@@ -0,0 +1,131 @@
+import re
+import sys
+
+from array import array
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+
+
+ID_ATTRIBUTE = re.compile(r"(?:^|;)\s*ID=([^;]+)")
+PARENT_ATTRIBUTE = re.compile(r"(?:^|;)\s*Parent=([^;]+)")
+STRANDS = {"+": 1, "-": -1}
+
+
+def parse_feature(line):
+    columns = line.rstrip("\n").split("\t")
+    if len(columns) < 9:
+        #Some annotations are separated by spaces instead of tabs
+        columns = line.split(None, 8)
+        if len(columns) < 9:
+            return None
+    columns = columns[:8] + [columns[8].strip()]
+    match = ID_ATTRIBUTE.search(columns[8])
+    feature_id = match.group(1).strip() if match else None
+    match = PARENT_ATTRIBUTE.search(columns[8])
+    parents = [parent.strip() for parent in match.group(1).split(",")] if match else []
+    return {"columns": columns, "id": feature_id, "parents": parents}
+
+
+def iter_features(annot_fhand):
+    for line in annot_fhand:
+        if line.startswith("#"):
+            if line.startswith("##FASTA"):
+                break
+            continue
+        if not line.strip():
+            continue
+        feature = parse_feature(line)
+        if feature is not None:
+            yield feature
+
+
+def intern_code(codes, name):
+    code = codes.get(name)
+    if code is None:
+        code = codes[name] = len(codes)
+    return code
+
+
+def read_annotation(annot_fhand):
+    """Loads an annotation into a columnar model.
+
+    Every feature is a row of numpy columns: seqid, type, start, end,
+    strand, phase, id and parent. seqids, types and IDs are interned and
+    stored as codes, their names are in the "seqids", "types" and "ids"
+    lists. parent is the row of the parent feature, -1 if it has no parent
+    and -2 if its parent is missing. Features with several parents get a
+    row per parent. Rows are filled in compact arrays while reading, so
+    parents can appear after their children.
+    """
+    seqids, types, ids = {}, {}, {}
+    columns = {"seqid": array("i"), "type": array("h"), "start": array("q"),
+               "end": array("q"), "strand": array("b"), "phase": array("b"),
+               "id": array("q"), "parent_id": array("q")}
+    for feature in iter_features(annot_fhand):
+        values = feature["columns"]
+        row = (intern_code(seqids, values[0]), intern_code(types, values[2]),
+               int(values[3]), int(values[4]), STRANDS.get(values[6], 0),
+               int(values[7]) if values[7].isdigit() else -1,
+               intern_code(ids, sys.intern(feature["id"])) if feature["id"] is not None else -1)
+        for parent in feature["parents"] or [None]:
+            for column, value in zip(columns.values(), row):
+                column.append(value)
+            columns["parent_id"].append(intern_code(ids, sys.intern(parent)) if parent is not None else -1)
+
+    model = {name: np.frombuffer(column, dtype=column.typecode) if len(column) else np.array([], dtype=column.typecode)
+             for name, column in columns.items()}
+    #IDs are linked to their rows once the whole file is read
+    id_rows = np.full(len(ids), -1, dtype=np.int64)
+    with_id = np.flatnonzero(model["id"] >= 0)
+    id_rows[model["id"][with_id][::-1]] = with_id[::-1]
+    #Parents not found in the annotation are marked with -2
+    parent_ids = model.pop("parent_id")
+    if len(ids):
+        parents = id_rows[np.maximum(parent_ids, 0)]
+        parents[parents == -1] = -2
+        model["parent"] = np.where(parent_ids >= 0, parents, -1)
+    else:
+        #Annotations without IDs nor parents only have level 1 features
+        model["parent"] = np.full(len(parent_ids), -1, dtype=np.int64)
+    model["seqids"] = list(seqids)
+    model["types"] = list(types)
+    model["ids"] = list(ids)
+    return model
+
+
+#The annotation being analysed and its longest isoforms
+@lru_cache(maxsize=2)
+def load_cached_annotation(fpath, size, mtime):
+    with open(fpath) as annot_fhand:
+        return read_annotation(annot_fhand)
+
+
+def load_annotation(fpath):
+    """Returns the model of an annotation file.
+
+    The last two models loaded are kept in memory, so all the native
+    steps run on the annotation and on its longest isoforms share them.
+    Models must not be modified.
+    """
+    fpath = Path(fpath).resolve()
+    stat = fpath.stat()
+    return load_cached_annotation(fpath, stat.st_size, stat.st_mtime_ns)
+
+
+def get_levels(model):
+    """Returns the level of every row: 1 for genes, 2 for transcripts and 3 for their features.
+
+    Rows whose parent is not in the annotation, or below level 3, get level 0.
+    """
+    parents = model["parent"]
+    levels = np.zeros(len(parents), dtype=np.int8)
+    levels[parents == -1] = 1
+    has_parent = parents >= 0
+    parent_levels = np.zeros(len(parents), dtype=np.int8)
+    parent_levels[has_parent] = levels[parents[has_parent]]
+    levels[has_parent & (parent_levels == 1)] = 2
+    parent_levels[has_parent] = levels[parents[has_parent]]
+    levels[has_parent & (parent_levels == 2)] = 3
+    return levels
@@ -1,39 +1,70 @@
-import os
 import subprocess
+
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+from src.cache import fail_step, record_step, start_step, step_done
+from src.metrics import run_command
+
+
+def split_lineage_threads(threads, num_lineages):
+    #Lineages share the threads evenly, the first ones get the remainder
+    share, remainder = divmod(max(1, int(threads)), max(1, num_lineages))
+    return [max(1, share + (idx < remainder)) for idx in range(num_lineages)]
+
+
+def run_busco_lineage(arguments, proteins_path, analysis, threads, outdir):
+    #check if lineage_analysis is a directory. BUSCO runs in outdir, so
+    #local lineages are given by their absolute path
+    lineage = Path(analysis)
+    if lineage.exists():
+        outname = lineage.name
+        lineage = lineage.resolve()
+        download_option = ""
+    else:
+        outname = analysis
+        #Lineages downloaded by name run at the same time, each one
+        #downloads to its own directory
+        download_option = " --download_path {}".format(outdir / "busco_downloads" / outname)
+    outfile = (outdir / outname / "run_{}".format(outname) / "short_summary.txt").resolve()
+
+    #Forced, so stale results left by a previous run are overwritten
+    cmd = "busco -f --cpu {} -i {} -o {} -m prot -l {} --tar{}".format(threads,
+                                                                    proteins_path,
+                                                                    outname,
+                                                                    lineage,
+                                                                    download_option)
+    inputs = [proteins_path, lineage]
+    if step_done(arguments, outfile, cmd, inputs):
+        msg = "Busco on lineage {} done already".format(lineage)
+    else:
+        start_step(arguments, outfile, cmd)
+        run_ = run_command(cmd, arguments, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL, cwd=outdir)
+        if run_.returncode == 0:
+            record_step(arguments, outfile, cmd, inputs)
+            msg = "BUSCO analysis with lineage {} run successfully".format(lineage)
+        else:
+            fail_step(arguments, outfile, cmd)
+            msg = "BUSCO analysis with lineage {} Failed: \n {}".format(lineage, run_.stderr)
+    return outname, {"command": cmd,
+                     "status": msg,
+                     "outfile": outfile}
+
 
 def run_busco(arguments, protein_sequences):
-    execution_path = os.getcwd()
+    """Runs BUSCO on every lineage at the same time, sharing the threads.
+
+    Each lineage runs in its own directory inside BUSCOCompleteness_run
+    and is a step of its own, so finished lineages are not run again.
+    """
     proteins_path = protein_sequences.resolve()
-    outdir = Path(arguments["Basedir"]) / "BUSCOCompleteness_run"
+    outdir = (Path(arguments["Basedir"]) / "BUSCOCompleteness_run").resolve()
     if not outdir.exists():
         outdir.mkdir()
-    os.chdir(outdir)
-    report = {}
-    for analysis in arguments["BUSCO_lineages"]:
-        #check if lineage_analysis is a directory
-        lineage = Path(analysis)
-        if lineage.exists():
-            outname = lineage.name
-        else:
-            outname = analysis
-        outfile = Path(outname) / "run_{}".format(outname) / "short_summary.txt"
-        
-        cmd = "busco --cpu {} -i {} -o {} -m prot -l {} --tar".format(arguments["Threads"],
-                                                                      proteins_path,
-                                                                      outname,
-                                                                      lineage)
-        if outfile.exists():
-            msg = "Busco on lineage {} done already".format(lineage)
-        else:
-            run_ = subprocess.run(cmd, shell=True, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL)
-            if run_.returncode == 0:
-                msg = "BUSCO analysis with lineage {} run successfully".format(lineage)
-            else:
-                msg = "BUSCO analysis with lineage {} Failed: \n {}".format(lineage, run_.stderr)
-        report[outname] = {"command": cmd,
-                           "status": msg,
-                           "outfile": outfile.resolve()}
-    os.chdir(execution_path)
-    return report
\ No newline at end of file
+    lineages = arguments["BUSCO_lineages"]
+    threads = split_lineage_threads(arguments["Threads"], len(lineages))
+    with ThreadPoolExecutor(max_workers=max(1, len(lineages))) as executor:
+        results = executor.map(run_busco_lineage, [arguments] * len(lineages), [proteins_path] * len(lineages),
+                               lineages, threads, [outdir] * len(lineages))
+        report = dict(results)
+    return report
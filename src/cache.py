@@ -0,0 +1,239 @@
+import fcntl
+import hashlib
+import json
+import os
+import re
+import subprocess
+
+from contextlib import contextmanager
+from functools import lru_cache
+from pathlib import Path
+from shutil import rmtree, which
+
+from src.metrics import run_command
+
+
+MANIFEST_NAME = "GAQET.manifest.json"
+PARTIAL_PREFIX = ".partial."
+#States of steps and analysis stored in the manifest
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+#Threads used don't change results, so they are left out of the step key
+THREADS_OPTIONS = re.compile(r"(--cpu|-cpu|--threads|--nthreads|-p)\s+\d+")
+#Tools that don't report their version with --version
+VERSION_COMMANDS = {"diamond": "diamond version",
+                    "seqtk": "seqtk"}
+CHUNK_SIZE = 1024 * 1024
+#Steps run by GAQET itself, their results change with its code
+INTERNAL_COMMANDS = {"normalize_annotation", "keep_longest_isoform", "annotation_stats", "intron_stats",
+                     "cds_checks", "extract_sequences", "deduplicate", "index_fasta", "filter_fasta",
+                     "split_hits", "merge_psauron", "fan_out", "interpro_cache", "decompress",
+                     "remove_stop_codons", "filter_mrna"}
+
+
+def file_digest(fpath):
+    digest = hashlib.sha256()
+    with open(fpath, "rb") as fhand:
+        for chunk in iter(lambda: fhand.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def directory_digest(dirpath):
+    #Databases directories are big, their listing is enough to detect changes
+    digest = hashlib.sha256()
+    for fpath in sorted(Path(dirpath).rglob("*")):
+        if fpath.is_file():
+            stat = fpath.stat()
+            digest.update("{}\t{}\t{}\n".format(fpath.relative_to(dirpath),
+                                                 stat.st_size, stat.st_mtime_ns).encode())
+    return digest.hexdigest()
+
+
+@lru_cache(maxsize=None)
+def tool_version(binary):
+    if binary.startswith("agat_"):
+        cmd = "agat --version"
+    else:
+        cmd = VERSION_COMMANDS.get(binary, "{} --version".format(binary))
+    if not which(cmd.split()[0]):
+        return ""
+    try:
+        run_ = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                              timeout=120)
+    except subprocess.TimeoutExpired:
+        return ""
+    lines = [line.strip() for line in run_.stdout.decode(errors="replace").splitlines() if line.strip()]
+    for line in lines:
+        if re.search(r"\d+\.\d+", line):
+            return line
+    return lines[0] if lines else ""
+
+
+@lru_cache(maxsize=None)
+def internal_version():
+    #Digest of the GAQET modules, so results of its own steps are not
+    #reused by other versions of the code
+    digest = hashlib.sha256()
+    for fpath in sorted(Path(__file__).parent.glob("*.py")):
+        digest.update(fpath.read_bytes())
+    return "GAQET {}".format(digest.hexdigest())
+
+
+def get_manifest_fpath(config):
+    return Path(config["Basedir"]) / MANIFEST_NAME
+
+
+def read_manifest(config):
+    manifest_fpath = get_manifest_fpath(config)
+    manifest = {"digests": {}, "steps": {}, "analysis": {}}
+    if manifest_fpath.is_file():
+        with open(manifest_fpath) as fhand:
+            manifest.update(json.load(fhand))
+    return manifest
+
+
+@contextmanager
+def update_manifest(config):
+    #Steps run in parallel processes, so the manifest is locked while updated
+    manifest_fpath = get_manifest_fpath(config)
+    manifest_fpath.parent.mkdir(parents=True, exist_ok=True)
+    with open(manifest_fpath.with_suffix(".lock"), "w") as lock_fhand:
+        fcntl.flock(lock_fhand, fcntl.LOCK_EX)
+        manifest = read_manifest(config)
+        yield manifest
+        tmp_fpath = manifest_fpath.with_suffix(".json.tmp")
+        with open(tmp_fpath, "w") as out_fhand:
+            json.dump(manifest, out_fhand, indent=2, sort_keys=True)
+        os.replace(tmp_fpath, manifest_fpath)
+
+
+def get_step_name(config, outfile):
+    outfile = Path(outfile).absolute()
+    basedir = Path(config["Basedir"]).absolute()
+    if basedir in outfile.parents:
+        return str(outfile.relative_to(basedir))
+    return str(outfile)
+
+
+def input_digests(config, inputs):
+    #Digests are stored with size and mtime of the file, so big inputs
+    #are only read again when they change
+    manifest = read_manifest(config)
+    known = manifest["digests"]
+    digests = {}
+    new = {}
+    for input_ in inputs:
+        fpath = Path(input_)
+        if not fpath.exists():
+            digests[str(input_)] = str(input_)
+            continue
+        fpath = fpath.resolve()
+        stat = fpath.stat()
+        stamp = "{}:{}".format(stat.st_size, stat.st_mtime_ns)
+        cached = known.get(str(fpath), {})
+        if cached.get("stamp") == stamp:
+            digest = cached["digest"]
+        else:
+            digest = directory_digest(fpath) if fpath.is_dir() else file_digest(fpath)
+            new[str(fpath)] = {"stamp": stamp, "digest": digest}
+        digests[str(fpath)] = digest
+    if new:
+        with update_manifest(config) as manifest:
+            manifest["digests"].update(new)
+    return digests
+
+
+def get_step_key(config, cmd, inputs):
+    binary = cmd.split()[0] if cmd else ""
+    if binary in INTERNAL_COMMANDS:
+        version = internal_version()
+    else:
+        version = tool_version(binary) if binary else ""
+    signature = {"command": THREADS_OPTIONS.sub(r"\1", cmd),
+                 "version": version,
+                 "inputs": sorted(input_digests(config, inputs).values())}
+    return hashlib.sha256(json.dumps(signature, sort_keys=True).encode()).hexdigest()
+
+
+def step_done(config, outfile, cmd, inputs):
+    """Check if a step was already run with the same inputs, command and tool version.
+
+    The outfile must exist, the step must be marked as done in the manifest
+    and the key stored when it finished must match the current one. Steps
+    left running by an interrupted run are never considered done.
+    """
+    if not Path(outfile).exists():
+        return False
+    step = read_manifest(config)["steps"].get(get_step_name(config, outfile), {})
+    if step.get("state") != DONE:
+        return False
+    return step.get("key") == get_step_key(config, cmd, inputs)
+
+
+def start_step(config, outfile, cmd):
+    #Stale or truncated results are removed before running the step again
+    remove_output(outfile)
+    remove_output(get_partial_fpath(outfile))
+    with update_manifest(config) as manifest:
+        manifest["steps"][get_step_name(config, outfile)] = {"command": cmd, "state": RUNNING}
+
+
+def record_step(config, outfile, cmd, inputs):
+    key = get_step_key(config, cmd, inputs)
+    with update_manifest(config) as manifest:
+        manifest["steps"][get_step_name(config, outfile)] = {"key": key, "command": cmd,
+                                                               "state": DONE}
+
+
+def fail_step(config, outfile, cmd):
+    with update_manifest(config) as manifest:
+        manifest["steps"][get_step_name(config, outfile)] = {"command": cmd, "state": FAILED}
+
+
+def set_analysis_state(config, analysis, state):
+    with update_manifest(config) as manifest:
+        manifest["analysis"][analysis] = state
+
+
+def remove_output(outfile):
+    #Removes stale results so tools don't refuse to overwrite them
+    outfile = Path(outfile)
+    if outfile.is_dir():
+        rmtree(outfile)
+    elif outfile.exists():
+        outfile.unlink()
+
+
+def get_partial_fpath(outfile):
+    outfile = Path(outfile)
+    return outfile.parent / (PARTIAL_PREFIX + outfile.name)
+
+
+@contextmanager
+def atomic_output(outfile):
+    """Yields a temporary path that is renamed to outfile only if the block succeeds."""
+    partial_fpath = get_partial_fpath(outfile)
+    try:
+        yield partial_fpath
+    except BaseException:
+        remove_output(partial_fpath)
+        raise
+    os.replace(partial_fpath, outfile)
+
+
+def run_atomic(cmd, outfile, config, **kwargs):
+    """Run cmd writing outfile to a temporary path, renamed only if the command succeeds.
+
+    cmd must be formatted with outfile, which is replaced by the temporary path.
+    """
+    partial_fpath = get_partial_fpath(outfile)
+    run_ = run_command(cmd.replace(str(outfile), str(partial_fpath)), config,
+                       step=Path(outfile).name, **kwargs)
+    if run_.returncode == 0 and partial_fpath.exists():
+        os.replace(partial_fpath, outfile)
+    else:
+        remove_output(partial_fpath)
+    return run_
@@ -0,0 +1,100 @@
+import re
+
+import numpy as np
+
+from pathlib import Path
+
+from src.cache import atomic_output, fail_step, record_step, start_step, step_done
+from src.fasta import fetch_sequence, open_genome
+from src.annotation import load_annotation
+from src.gff_stats import CDS, get_feature_table
+
+
+#Start codons of the standard code (NCBI table 1), as used by AGAT
+START_CODONS = {b"ATG", b"CTG", b"TTG"}
+STOP_CODONS = {b"TAA", b"TAG", b"TGA"}
+STOP_CODON = re.compile(b"(?=(TAA|TAG|TGA))")
+COMPLEMENT = bytes.maketrans(b"ACGTRYKMBVDHNacgtrykmbvdhn", b"TGCAYRMKVBHDNtgcayrmkvbhdn")
+#Same flags used by agat_sp_filter_incomplete_gene_coding_models.pl
+COMPLETE, START_MISSING, STOP_MISSING, START_STOP_MISSING = range(4)
+
+
+def get_cds_sequences(table, mm, genome_index):
+    """Yields the index of every coding transcript, its CDS and the phase of its first codon.
+
+    CDS pieces are joined in transcription order, reverse complemented
+    in the minus strand.
+    """
+    features = table["features"]
+    transcripts = table["transcripts"]
+    cds = features["type"] == CDS
+    cds_transcripts = features["transcript"][cds]
+    starts, ends, phases = features["start"][cds], features["end"][cds], features["phase"][cds]
+    order = np.lexsort((starts, cds_transcripts))
+    cds_transcripts, starts, ends, phases = cds_transcripts[order], starts[order], ends[order], phases[order]
+    boundaries = np.flatnonzero(np.diff(cds_transcripts)) + 1
+    for first, last in zip(np.r_[0, boundaries], np.r_[boundaries, len(cds_transcripts)]):
+        if first == last:
+            continue
+        transcript = cds_transcripts[first]
+        record = genome_index.get(table["seqids"][transcripts["seqid"][transcript]])
+        if record is None:
+            continue
+        sequence = b"".join(fetch_sequence(mm, record, start - 1, end)
+                            for start, end in zip(starts[first:last], ends[first:last]))
+        if transcripts["strand"][transcript] == -1:
+            sequence = sequence.translate(COMPLEMENT)[::-1]
+            phase = phases[last - 1]
+        else:
+            phase = phases[first]
+        yield transcript, sequence, max(0, int(phase))
+
+
+def check_cds(sequence, phase, start_codons=START_CODONS):
+    """Returns the incomplete flag of a CDS and whether it has early stop codons"""
+    start_missing = phase > 0 or sequence[:3] not in start_codons
+    stop_missing = sequence[-3:] not in STOP_CODONS
+    incomplete = COMPLETE
+    if start_missing and stop_missing:
+        incomplete = START_STOP_MISSING
+    elif start_missing:
+        incomplete = START_MISSING
+    elif stop_missing:
+        incomplete = STOP_MISSING
+    #The last codon of the frame is the regular stop codon
+    last_codon = phase + ((len(sequence) - phase) // 3 - 1) * 3
+    early_stop = any(match.start() < last_codon and (match.start() - phase) % 3 == 0
+                     for match in STOP_CODON.finditer(sequence, phase))
+    return incomplete, early_stop
+
+
+def run_cds_checks(config, outfile):
+    """Flags coding transcripts with missing start or stop codons and early stops.
+
+    Every CDS is read from the memory-mapped assembly and checked in a
+    single pass. Only flagged transcripts are written to outfile.
+    """
+    annotation = config["Annotation"]
+    assembly = config["Assembly"]
+    cmd = "cds_checks {} {}".format(annotation, assembly)
+    inputs = [annotation, assembly]
+    if step_done(config, outfile, cmd, inputs):
+        msg = "CDS checks already done"
+    else:
+        start_step(config, outfile, cmd)
+        try:
+            table = get_feature_table(load_annotation(annotation))
+            with open_genome(assembly, config.get("Assembly_index")) as (mm, genome_index):
+                with atomic_output(outfile) as partial_fpath, open(partial_fpath, "w") as out_fhand:
+                    out_fhand.write("Transcript\tIncomplete\tEarly_stop\n")
+                    for transcript, sequence, phase in get_cds_sequences(table, mm, genome_index):
+                        incomplete, early_stop = check_cds(sequence, phase)
+                        if incomplete != COMPLETE or early_stop:
+                            out_fhand.write("{}\t{}\t{}\n".format(table["transcripts"]["id"][transcript],
+                                                                  incomplete, int(early_stop)))
+            record_step(config, outfile, cmd, inputs)
+            msg = "CDS checks run successfully"
+        except (OSError, ValueError) as error:
+            fail_step(config, outfile, cmd)
+            msg = "CDS checks Failed: \n {}".format(error)
+    return {"command": cmd, "status": msg, "outfile": Path(outfile)}
@@ -0,0 +1,145 @@
+import io
+import struct
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from src.cache import atomic_output, fail_step, record_step, start_step, step_done
+
+
+GZIP_MAGIC = b"\x1f\x8b"
+COMPRESSED_SUFFIXES = (".gz", ".bgz")
+#BGZF blocks are gzip members with a BC extra subfield holding their size
+BGZF_HEADER = struct.Struct("<4s6xH")
+BGZF_FLAGS = b"\x1f\x8b\x08\x04"
+BGZF_SUBFIELD = struct.Struct("<2sHH")
+#BGZF blocks decompressed at once by the threads, up to 64KB each
+BGZF_BATCH = 512
+#gzip header and trailer are checked by zlib
+GZIP_WBITS = 31
+CHUNK_SIZE = 16 * 1024 * 1024
+
+
+def is_compressed(fpath):
+    with open(fpath, "rb") as fhand:
+        return fhand.read(2) == GZIP_MAGIC
+
+
+def is_bgzf(fpath):
+    with open(fpath, "rb") as fhand:
+        header = fhand.read(BGZF_HEADER.size + BGZF_SUBFIELD.size)
+    if len(header) < BGZF_HEADER.size + BGZF_SUBFIELD.size:
+        return False
+    flags, _ = BGZF_HEADER.unpack_from(header)
+    subfield, _, _ = BGZF_SUBFIELD.unpack_from(header, BGZF_HEADER.size)
+    return flags == BGZF_FLAGS and subfield == b"BC"
+
+
+def iter_bgzf_blocks(fhand):
+    while True:
+        header = fhand.read(BGZF_HEADER.size)
+        if not header:
+            return
+        if len(header) < BGZF_HEADER.size:
+            raise ValueError("Truncated BGZF block")
+        _, extra_length = BGZF_HEADER.unpack(header)
+        extra = fhand.read(extra_length)
+        block_size = None
+        position = 0
+        while position + BGZF_SUBFIELD.size <= len(extra):
+            subfield, length, value = BGZF_SUBFIELD.unpack_from(extra, position)
+            if subfield == b"BC":
+                block_size = value + 1
+            position += 4 + length
+        if block_size is None:
+            raise ValueError("Not a BGZF block")
+        rest = fhand.read(block_size - len(header) - len(extra))
+        yield header + extra + rest
+
+
+def decompress_block(block):
+    return zlib.decompress(block, GZIP_WBITS)
+
+
+def iter_chunks(fpath, threads=1):
+    """Yields the content of a plain, gzip or bgzip file by chunks of bytes.
+
+    BGZF blocks are independent, so they are decompressed by batches in
+    threads (zlib releases the GIL). Other gzip files are decompressed
+    as a stream.
+    """
+    if not is_compressed(fpath):
+        with open(fpath, "rb") as fhand:
+            yield from iter(lambda: fhand.read(CHUNK_SIZE), b"")
+    elif is_bgzf(fpath) and threads > 1:
+        with open(fpath, "rb") as fhand, ThreadPoolExecutor(threads) as executor:
+            batch = []
+            for block in iter_bgzf_blocks(fhand):
+                batch.append(block)
+                if len(batch) == BGZF_BATCH:
+                    yield b"".join(executor.map(decompress_block, batch))
+                    batch = []
+            if batch:
+                yield b"".join(executor.map(decompress_block, batch))
+    else:
+        #Concatenated members are decompressed one after the other
+        decompressor = zlib.decompressobj(GZIP_WBITS)
+        with open(fpath, "rb") as fhand:
+            for chunk in iter(lambda: fhand.read(CHUNK_SIZE), b""):
+                while chunk:
+                    yield decompressor.decompress(chunk)
+                    chunk = decompressor.unused_data
+                    if decompressor.eof:
+                        decompressor = zlib.decompressobj(GZIP_WBITS)
+                    else:
+                        chunk = b""
+            yield decompressor.flush()
+
+
+def iter_lines(fpath, threads=1):
+    """Yields the lines of a plain, gzip or bgzip text file"""
+    remainder = b""
+    for chunk in iter_chunks(fpath, threads):
+        chunk = remainder + chunk
+        last_newline = chunk.rfind(b"\n") + 1
+        remainder = chunk[last_newline:]
+        yield from io.StringIO(chunk[:last_newline].decode(), newline=None)
+    if remainder:
+        yield remainder.decode()
+
+
+def get_decompressed_name(fpath):
+    fpath = Path(fpath)
+    return fpath.stem if fpath.suffix in COMPRESSED_SUFFIXES else fpath.name
+
+
+def decompress_input(config, key):
+    """Writes a plain copy of a compressed input in input_sequences.
+
+    Only needed by steps that can't read compressed files: external tools
+    and the memory-mapped assembly. Plain inputs are used as they are.
+    """
+    fpath = Path(config[key])
+    if not is_compressed(fpath):
+        return {"command": "", "status": "{} file is not compressed".format(key), "outfile": fpath}
+    outdir = Path(config["Basedir"]) / "input_sequences"
+    if not outdir.exists():
+        outdir.mkdir(parents=True, exist_ok=True)
+    outfile = outdir / get_decompressed_name(fpath)
+    cmd = "decompress {}".format(fpath)
+    inputs = [fpath]
+    if step_done(config, outfile, cmd, inputs):
+        msg = "{} file decompressed already".format(key)
+    else:
+        start_step(config, outfile, cmd)
+        try:
+            with atomic_output(outfile) as partial_fpath, open(partial_fpath, "wb") as out_fhand:
+                for chunk in iter_chunks(fpath, int(config.get("Threads", 1))):
+                    out_fhand.write(chunk)
+            record_step(config, outfile, cmd, inputs)
+            msg = "{} file decompressed successfully".format(key)
+        except (OSError, ValueError, zlib.error) as error:
+            fail_step(config, outfile, cmd)
+            msg = "{} file decompression Failed: \n {}".format(key, error)
+    return {"command": cmd, "status": msg, "outfile": outfile}
@@ -2,10 +2,10 @@ from os import environ as env
 from os.path import (exists, join)
 from shutil import which
 
+from src.gff import is_gtf
 
-BINARIES = {"AGAT": ["agat_sp_statistics.pl", 
-                     "agat_sp_flag_premature_stop_codons.pl",
-                     "agat_sp_filter_incomplete_gene_coding_models.pl"], 
+
+BINARIES = {"AGAT": [], 
             "BUSCO": ["busco"], 
             "PSAURON": ["psauron"], 
             "DETENGA": ["TEsorter", "interproscan.sh"], 
@@ -15,31 +15,65 @@ BINARIES = {"AGAT": ["agat_sp_statistics.pl",
 HEADER = "-"*5
 BULLET_OK = "\t✓\t"
 BULLET_FIX = "\tERROR!\t"
+BULLET_WARN = "\tWARNING!\t"
+
+#Stats engines which run agat_sp_statistics.pl
+AGAT_STATS_ENGINES = ["agat", "both"]
+
+
+def get_binaries(analysis, config):
+    binaries = list(BINARIES[analysis])
+    #Annotation stats are computed natively unless AGAT is asked for
+    if analysis == "AGAT" and config.get("Stats_engine", "native") in AGAT_STATS_ENGINES:
+        binaries.append("agat_sp_statistics.pl")
+    return binaries
+
+
+def check_binary(binary, report):
+    if which(binary):
+        return BULLET_OK + "Binary {} found".format(binary) + "\n"
+    report["ok"] = False
+    return BULLET_FIX + "Binary {} not found".format(binary) + "\n"
 
 
 def check_dependencies(config):
     report = {"ok": True}
-    msg = HEADER+"Checking binaries for gffread" + HEADER+ "\n"
-    if which("gffread"):
-        msg += BULLET_OK + "Binary gffread found" + "\n"
-    else:
-        msg += BULLET_FIX + "Binary gffread not found" + "\n"
-        report["ok"] = False
-    report["gffread"] = msg       
+    #GTF annotations are split by AGAT, which builds their GFF3 IDs and parents
+    try:
+        gtf = is_gtf(config["Annotation"])
+    except OSError:
+        gtf = False
+    if gtf:
+        msg = HEADER+"Checking binaries for GTF annotations" + HEADER+ "\n"
+        msg += check_binary("agat_sp_separate_by_record_type.pl", report)
+        report["GTF"] = msg
+    #AGAT longest isoforms are only a reference for the native selection
+    if config.get("Longest_isoform_check", False):
+        msg = HEADER+"Checking binaries for Longest_isoform_check" + HEADER+ "\n"
+        msg += check_binary("agat_sp_keep_longest_isoform.pl", report)
+        report["Longest_isoform_check"] = msg
+    #Sequences are extracted natively unless gffread is asked for
+    if config.get("Sequence_extractor", "native") == "gffread":
+        msg = HEADER+"Checking binaries for gffread" + HEADER+ "\n"
+        if which("gffread"):
+            msg += BULLET_OK + "Binary gffread found" + "\n"
+        else:
+            msg += BULLET_FIX + "Binary gffread not found" + "\n"
+            report["ok"] = False
+        report["gffread"] = msg       
+    #seqtk only rewrites assemblies that can not be indexed, so it is optional
     msg = HEADER+"Checking binaries for seqtk" + HEADER+ "\n"
     if which("seqtk"):
         msg += BULLET_OK + "Binary seqtk found" + "\n"
     else:
-        msg += BULLET_FIX + "Binary seqtk not found" + "\n"
-        report["ok"] = False
+        msg += BULLET_WARN + "Binary seqtk not found, assemblies with lines of different lengths can not be reformatted" + "\n"
     report["seqtk"] = msg
     for analysis in config["Analysis"]:
         msg = HEADER+"Checking binaries for {}".format(analysis) + HEADER  + "\n"
-        for binary in BINARIES[analysis]:
-            if which(binary):
-                msg += BULLET_OK + "Binary {} found".format(binary) + "\n"
-            else:
-                msg += BULLET_FIX + "Binary {} not found".format(binary) + "\n"
-                report["ok"] = False
+        binaries = get_binaries(analysis, config)
+        if not binaries:
+            msg += BULLET_OK + "No binaries needed" + "\n"
+        for binary in binaries:
+            msg += check_binary(binary, report)
         report[analysis] = msg    
     return report
\ No newline at end of file
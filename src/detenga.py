@@ -1,10 +1,16 @@
 import argparse
-import os
+import sqlite3
 import sys
 
-from Bio import SeqIO
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 
+from src.fasta import iter_record_chunks, read_fasta_records, split_by_residues
+from src.cache import atomic_output, fail_step, record_step, run_atomic, start_step, step_done, tool_version
+from src.interpro_cache import (DEFAULT_INTERPRO_CACHE, get_interpro_signature, get_protein_md5,
+                                get_scanned, store_results, write_cached_tsv)
+from src.metrics import run_command
 from src.detenga_parsers import (get_pfams_from_interpro_query, parse_TEsort_output, 
                          classify_pfams, create_summary, write_summary, get_pfams_from_db)
 
@@ -24,6 +30,208 @@ EXCLUDE = ["AntiFam", "CDD", "Coils", "FunFam",
                "ProSiteProfiles", "SFLD", "SMART", 
                "SUPERFAMILY"]
 
+#mRNAs with Ns or this long are left out of TEsorter analysis
+MAX_MRNA_LENGTH = 100000
+WITH_NS = "Ns"
+TOO_LONG = "length"
+INTERPRO_OPTIONS = "-exclappl {} --disable-precalc".format(",".join(EXCLUDE))
+#Threads used by each InterProScan shard, unless set in the YAML
+INTERPRO_SHARD_THREADS = 4
+
+
+def filter_mrna_chunk(chunk):
+    """Returns the records of a FASTA chunk without Ns and shorter than MAX_MRNA_LENGTH.
+
+    Also returns the IDs of the removed ones, with the reason.
+    """
+    kept = []
+    removed = []
+    for record in chunk.split(b"\n>"):
+        header, _, sequence = record.lstrip(b">").partition(b"\n")
+        if not header:
+            continue
+        bases = sequence.translate(None, b"\r\n")
+        name = header.split(None, 1)[0].decode() if header.strip() else ""
+        if bases.find(b"N") != -1 or bases.find(b"n") != -1:
+            removed.append((name, WITH_NS))
+        elif len(bases) >= MAX_MRNA_LENGTH:
+            removed.append((name, TOO_LONG))
+        else:
+            kept.append(b">" + header + b"\n" + sequence.rstrip(b"\n") + b"\n")
+    return b"".join(kept), removed
+
+
+def write_filtered_chunk(result, out_fhand, removed_fhand, counts):
+    kept, removed = result
+    out_fhand.write(kept)
+    for name, reason in removed:
+        removed_fhand.write("{}\t{}\n".format(name, reason))
+        counts[reason] += 1
+
+
+def filter_mrna_sequences(mrna_sequences, outfile, removed_outfile, threads=1):
+    """Writes the mRNAs without Ns and shorter than MAX_MRNA_LENGTH to outfile.
+
+    Records are filtered as bytes by chunks, in several processes if
+    threads > 1. The IDs of the removed mRNAs are written, with the
+    reason, to removed_outfile. Returns the number removed by reason.
+    """
+    counts = {WITH_NS: 0, TOO_LONG: 0}
+    with open(mrna_sequences, "rb") as in_fhand, open(outfile, "wb") as out_fhand, \
+         open(removed_outfile, "w") as removed_fhand:
+        removed_fhand.write("ID\tReason\n")
+        if threads < 2:
+            for chunk in iter_record_chunks(in_fhand):
+                write_filtered_chunk(filter_mrna_chunk(chunk), out_fhand, removed_fhand, counts)
+            return counts
+        with ProcessPoolExecutor(max_workers=threads) as executor:
+            #Chunks are written in file order, only a few are kept in memory
+            pending = deque()
+            for chunk in iter_record_chunks(in_fhand):
+                pending.append(executor.submit(filter_mrna_chunk, chunk))
+                if len(pending) > threads * 2:
+                    write_filtered_chunk(pending.popleft().result(), out_fhand, removed_fhand, counts)
+            while pending:
+                write_filtered_chunk(pending.popleft().result(), out_fhand, removed_fhand, counts)
+    return counts
+
+
+def count_removed_mrnas(removed_outfile):
+    #Number of mRNAs removed by reason, read from the list of a previous run
+    counts = {WITH_NS: 0, TOO_LONG: 0}
+    with open(removed_outfile) as fhand:
+        next(fhand, None)
+        for line in fhand:
+            counts[line.rstrip("\n").split("\t")[1]] += 1
+    return counts
+
+
+def get_interpro_shards(config):
+    #Number of shards and threads used by each InterProScan run
+    threads = max(1, int(config["Threads"]))
+    shard_threads = min(threads, max(1, int(config.get("Interpro_shard_threads", INTERPRO_SHARD_THREADS))))
+    num_shards = config.get("Interpro_shards")
+    num_shards = max(1, int(num_shards)) if num_shards else max(1, threads // shard_threads)
+    return num_shards, shard_threads, max(1, threads // shard_threads)
+
+
+def run_interpro_shard(config, shard_fpath, shard_outfile, shard_threads, cache, signature):
+    """Runs InterProScan on a shard of proteins named by their MD5 and caches its hits"""
+    cmd = "interproscan.sh -i {} -cpu {} {} -f TSV -o {} -T {}".format(shard_fpath, shard_threads, INTERPRO_OPTIONS,
+                                                                       shard_outfile,
+                                                                       shard_fpath.parent / "temp_{}".format(shard_fpath.stem))
+    inputs = [shard_fpath]
+    if not step_done(config, shard_outfile, cmd, inputs):
+        start_step(config, shard_outfile, cmd)
+        run_ = run_atomic(cmd, shard_outfile, config, stderr=subprocess.PIPE, stdout=subprocess.PIPE,
+                          cwd=shard_fpath.parent)
+        if run_.returncode != 0:
+            fail_step(config, shard_outfile, cmd)
+            return cmd, "{}: {}".format(shard_fpath.name, run_.stderr)
+        record_step(config, shard_outfile, cmd, inputs)
+    try:
+        with open(shard_fpath, "rb") as shard_fhand:
+            md5s = [name for name, _ in read_fasta_records(shard_fhand)]
+        with open(shard_outfile) as tsv_fhand:
+            store_results(cache, md5s, signature, tsv_fhand)
+    except (OSError, ValueError, sqlite3.Error) as error:
+        return cmd, "{}: {}".format(shard_fpath.name, error)
+    return cmd, ""
+
+
+def run_interproscan(config, proteins, interpro_outfile):
+    """Runs InterProScan on the proteins not found in the cache and writes the TSV of all of them.
+
+    Proteins are cached by the MD5 of their sequence, so identical
+    proteins are only scanned once, in this or any other run. New ones
+    are split in shards balanced by residues that run at the same time,
+    each with Interpro_shard_threads threads. Every shard is stored in
+    the cache when it finishes, so an interrupted run only repeats the
+    shards that didn't.
+    """
+    cache = Path(config.get("Interpro_cache") or DEFAULT_INTERPRO_CACHE)
+    signature = get_interpro_signature(tool_version("interproscan.sh"), INTERPRO_OPTIONS)
+    cmd = "interpro_cache {} {}".format(cache, signature)
+    inputs = [proteins]
+    report = {"command": cmd, "outfile": interpro_outfile}
+    if step_done(config, interpro_outfile, cmd, inputs):
+        report["status"] = "DeTEnGA InteproScan analysis step already done"
+        return report
+    start_step(config, interpro_outfile, cmd)
+    try:
+        with open(proteins, "rb") as fhand:
+            records = [(name, get_protein_md5(sequence), sequence) for name, sequence in read_fasta_records(fhand)]
+        scanned = get_scanned(cache, [md5 for _, md5, _ in records], signature)
+    except (OSError, ValueError, sqlite3.Error) as error:
+        fail_step(config, interpro_outfile, cmd)
+        report["status"] = "DeTEnGA InteproScan analysis step Failed: \n {}".format(error)
+        return report
+    misses = {md5: sequence for _, md5, sequence in records if md5 not in scanned}
+
+    errors = []
+    num_shards = 0
+    if misses:
+        num_shards, shard_threads, concurrent = get_interpro_shards(config)
+        num_shards = min(num_shards, len(misses))
+        shards_dir = interpro_outfile.parent / "interpro_shards"
+        if not shards_dir.exists():
+            shards_dir.mkdir(parents=True, exist_ok=True)
+        shard_fpaths = [shards_dir / "shard_{}.fasta".format(shard) for shard in range(num_shards)]
+        shard_outfiles = [shards_dir / "shard_{}.fasta.tsv".format(shard) for shard in range(num_shards)]
+        split_by_residues(list(misses.items()), shard_fpaths)
+        with ThreadPoolExecutor(max_workers=concurrent) as executor:
+            results = list(executor.map(run_interpro_shard, [config] * num_shards, shard_fpaths, shard_outfiles,
+                                        [shard_threads] * num_shards, [cache] * num_shards, [signature] * num_shards))
+        report["command"] = results[0][0]
+        errors = [error for _, error in results if error]
+    if errors:
+        fail_step(config, interpro_outfile, cmd)
+        report["status"] = "DeTEnGA InteproScan analysis step Failed in {} of {} shards: \n {}".format(len(errors), num_shards,
+                                                                                                     "\n".join(errors))
+        return report
+    try:
+        with atomic_output(interpro_outfile) as partial_fpath, open(partial_fpath, "w") as out_fhand:
+            write_cached_tsv(cache, [(name, md5) for name, md5, _ in records], signature, out_fhand)
+    except (OSError, sqlite3.Error) as error:
+        fail_step(config, interpro_outfile, cmd)
+        report["status"] = "DeTEnGA InteproScan analysis step Failed: \n {}".format(error)
+        return report
+    record_step(config, interpro_outfile, cmd, inputs)
+    unique = len({md5 for _, md5, _ in records})
+    report["status"] = "DeTEnGA InteproScan analysis step run successfully, {} of {} unique proteins found in the cache, {} scanned in {} shards".format(unique - len(misses), unique,
+                                                                                                                                                 len(misses), num_shards)
+    return report
+
+
+def split_threads(threads):
+    #InterProScan is the heaviest, TEsorter gets a quarter of the threads.
+    #With a single thread nothing is left for InterProScan, both steps
+    #run one after the other
+    if threads < 2:
+        return 1, 0
+    tesorter_threads = max(1, threads // 4)
+    return tesorter_threads, threads - tesorter_threads
+
+
+def run_tesorter(config, filtered_mRNA_outfile, outdir):
+    tesorter_outfile = outdir / "{}.{}.cls.tsv".format(filtered_mRNA_outfile.name, config["DETENGA_db"])
+    cmd = "TEsorter {} -db {} -p {}".format(filtered_mRNA_outfile.absolute(), config["DETENGA_db"], str(config["Threads"]))
+    inputs = [filtered_mRNA_outfile]
+    if step_done(config, tesorter_outfile, cmd, inputs):
+        msg = "DeTEnGA TEsorter step already done"
+    else:
+        start_step(config, tesorter_outfile, cmd)
+        run_ = run_command(cmd, config, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL, cwd=outdir)
+        if run_.returncode == 0:
+            record_step(config, tesorter_outfile, cmd, inputs)
+            msg = "DeTEnGA TEsorter step run successfully"
+        else:
+            fail_step(config, tesorter_outfile, cmd)
+            msg = "DeTEnGA TEsorter step Failed: \n {}".format(run_.stderr)
+    return {"command": cmd,
+            "status": msg,
+            "outfile": tesorter_outfile}
+
 
 def run_detenga(config, protein_sequences, mrna_sequences):
     report = {"TEsorter": {}, "Stop codons removed": {},
@@ -34,59 +242,48 @@ def run_detenga(config, protein_sequences, mrna_sequences):
         outdir.mkdir(parents=True, exist_ok=True)
 
 
-    #Run TEsorter
+    #mRNAs for TEsorter
 
     filtered_mRNA_outfile = outdir / "{}.mRNA.noNs.no100k.fasta".format(Path(config["Assembly"]).stem)
-    sequences_removed_Ns = []
-    sequences_removed_length = []
+    removed_mRNA_outfile = outdir / "{}.mRNA.removed.tsv".format(Path(config["Assembly"]).stem)
+    filter_cmd = "filter_mrna {}".format(mrna_sequences)
+    inputs = [mrna_sequences]
     msg = ""
-    
-    with open(filtered_mRNA_outfile, "w") as filtered_mRNA_outfhand:
-        for record in SeqIO.parse(mrna_sequences.absolute(), "fasta"):
-            if "N" in record.seq.upper():
-                sequences_removed_Ns.append(record.id)
-            elif len(record.seq) >= 100000:
-                sequences_removed_length.append(record.id)
-            else:
-                SeqIO.write(record, filtered_mRNA_outfhand, "fasta")
-            
-
-    if sequences_removed_Ns:
-        msg = "Warning: the following sequences have Ns in the sequence and has been removed from TEsorter analysis:\n {}\n".format("\n".join(sequences_removed_Ns))
-    if sequences_removed_length:
-         msg = "Warning: the following sequences have more than 100k residues has been removed from TEsorter analysis:\n {}\n".format("\n".join(sequences_removed_length))
-
-    base_dir = Path(os.getcwd())
-    tesorter_outfile = outdir / "{}.{}.cls.tsv".format(filtered_mRNA_outfile.name, config["DETENGA_db"])
-    cmd = "TEsorter {} -db {} -p {}".format(filtered_mRNA_outfile.absolute(), config["DETENGA_db"], str(config["Threads"]))
-
-    if tesorter_outfile.is_file():
-        msg += "DeTEnGA TEsorter step already done"
-    else:
-        os.chdir(outdir)
-        run_ = subprocess.run(cmd, shell=True, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL)
-        if run_.returncode == 0:
-            msg += "DeTEnGA TEsorter step run successfully"
+    try:
+        if step_done(config, filtered_mRNA_outfile, filter_cmd, inputs) and removed_mRNA_outfile.exists():
+            removed = count_removed_mrnas(removed_mRNA_outfile)
         else:
-            msg += "DeTEnGA TEsorter step Failed: \n {}".format(run_.stderr)
-        os.chdir(base_dir)
-    report["TEsorter"] = {"command": cmd,
-                          "status": msg,
-                          "outfile": tesorter_outfile}
-    
-    
+            start_step(config, filtered_mRNA_outfile, filter_cmd)
+            try:
+                with atomic_output(removed_mRNA_outfile) as partial_removed_fpath, \
+                     atomic_output(filtered_mRNA_outfile) as partial_fpath:
+                    removed = filter_mrna_sequences(mrna_sequences, partial_fpath, partial_removed_fpath,
+                                                    int(config["Threads"]))
+            except OSError:
+                fail_step(config, filtered_mRNA_outfile, filter_cmd)
+                raise
+            record_step(config, filtered_mRNA_outfile, filter_cmd, inputs)
+        if removed[WITH_NS] or removed[TOO_LONG]:
+            msg = "Warning: {} sequences with Ns and {} sequences with more than {} residues have been removed from TEsorter analysis, listed in {}\n".format(removed[WITH_NS], removed[TOO_LONG],
+                                                                                                                                                        MAX_MRNA_LENGTH, removed_mRNA_outfile)
+    except OSError as error:
+        msg = "Warning: mRNA sequences could not be filtered for TEsorter analysis: \n {}\n".format(error)
+
     #REMOVE stop codons
     stop_codons_outfile = outdir / "{}.pep.nostop.fasta".format(Path(config["Assembly"]).stem)
-    if stop_codons_outfile.is_file():
-        msg = "DeTEnGA Removing stop codons step already done"
+    stop_codons_cmd = "remove_stop_codons {}".format(protein_sequences)
+    inputs = [protein_sequences]
+    if step_done(config, stop_codons_outfile, stop_codons_cmd, inputs):
+        stop_codons_msg = "DeTEnGA Removing stop codons step already done"
     else:
+        start_step(config, stop_codons_outfile, stop_codons_cmd)
         try:
             id = ""
             sequences_log = []
             stop = False
             original_len = 0
             new_len = 0
-            with open(stop_codons_outfile, "w") as out_fhand:
+            with atomic_output(stop_codons_outfile) as partial_fpath, open(partial_fpath, "w") as out_fhand:
                 with open(protein_sequences) as seqs_fhand:
                     for line in seqs_fhand:
                         if line.startswith(">"):
@@ -112,34 +309,33 @@ def run_detenga(config, protein_sequences, mrna_sequences):
                                 if not stop:
                                     out_fhand.write(line)
                                     new_len += len(line.rstrip())
-            msg = "DeTEnGA Removing stop codons step run successfully"
+            record_step(config, stop_codons_outfile, stop_codons_cmd, inputs)
+            stop_codons_msg = "DeTEnGA Removing stop codons step run successfully"
         except Exception as error:
-            msg = "DeTEnGA Removing stop codons step Failed: \n {}".format(error)
+            fail_step(config, stop_codons_outfile, stop_codons_cmd)
+            stop_codons_msg = "DeTEnGA Removing stop codons step Failed: \n {}".format(error)
     report["Stop codons removed"] = {"command": "",
-                            "status": msg,
+                            "status": stop_codons_msg,
                             "outfile": stop_codons_outfile}
     
    
-    #Run interproscan
+    #TEsorter and InterproScan are independent, they run at the same time
+    #sharing the threads of the analysis
+    tesorter_threads, interpro_threads = split_threads(int(config["Threads"]))
     interpro_outfile = outdir / "{}.pep.nostop.fasta.tsv".format(Path(config["Assembly"]).stem)
-    base_dir = Path(os.getcwd())
-
-    cmd = "interproscan.sh -i {} -cpu {} -exclappl {} --disable-precalc".format(stop_codons_outfile.absolute(), 
-                                                                                config["Threads"], 
-                                                                                ",".join(EXCLUDE))
-    if interpro_outfile.is_file():
-        msg = "DeTEnGA InteproScan analysis step already done"
+    if not interpro_threads:
+        report["TEsorter"] = run_tesorter(dict(config, Threads=tesorter_threads), filtered_mRNA_outfile, outdir)
+        report["InterproScan"] = run_interproscan(dict(config, Threads=tesorter_threads),
+                                                  stop_codons_outfile.absolute(), interpro_outfile.absolute())
     else:
-        os.chdir(outdir)
-        run_ = subprocess.run(cmd, shell=True, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-        if run_.returncode == 0:
-            msg = "DeTEnGA InteproScan analysis step run successfully"
-        else:
-            msg = "DeTEnGA InteproScan analysis step Failed: \n {}".format(run_.stderr)
-        os.chdir(base_dir)
-    report["InterproScan"] = {"command": cmd,
-                              "status": msg,
-                              "outfile": interpro_outfile}
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            tesorter = executor.submit(run_tesorter, dict(config, Threads=tesorter_threads),
+                                       filtered_mRNA_outfile, outdir)
+            interpro = executor.submit(run_interproscan, dict(config, Threads=interpro_threads),
+                                       stop_codons_outfile.absolute(), interpro_outfile.absolute())
+            report["TEsorter"] = tesorter.result()
+            report["InterproScan"] = interpro.result()
+    report["TEsorter"]["status"] = msg + report["TEsorter"]["status"]
 
     try:
         with open(report["TEsorter"]["outfile"]) as tesorter_fhand:
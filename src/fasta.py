@@ -0,0 +1,207 @@
+import heapq
+import mmap
+
+import numpy as np
+
+from contextlib import contextmanager
+from pathlib import Path
+
+from src.cache import atomic_output, fail_step, record_step, start_step, step_done
+
+
+#Bytes of a sequence checked at once while validating its lines
+CHUNK_SIZE = 64 * 1024 * 1024
+NEWLINE = ord("\n")
+#Bytes of whole records read at once from sequence files
+RECORDS_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def has_regular_lines(mm, offset, end, linewidth):
+    #Every line but the last one must be linewidth bytes long, as
+    #samtools faidx requires. end is the position after the last base
+    #and the sequence is scanned by chunks
+    bases = np.frombuffer(mm, dtype=np.uint8)
+    previous = offset - 1
+    for chunk_start in range(offset, end, CHUNK_SIZE):
+        chunk_end = min(end, chunk_start + CHUNK_SIZE)
+        newlines = np.flatnonzero(bases[chunk_start:chunk_end] == NEWLINE) + chunk_start
+        if not len(newlines):
+            continue
+        if (np.diff(newlines, prepend=previous) != linewidth).any():
+            return False
+        previous = newlines[-1]
+    #The last line of the sequence can be shorter
+    return end - previous <= linewidth
+
+
+def iter_record_chunks(fhand, chunk_size=RECORDS_CHUNK_SIZE):
+    #Chunks are cut before a header, so they only hold whole records
+    remainder = b""
+    for block in iter(lambda: fhand.read(chunk_size), b""):
+        remainder += block
+        cut = remainder.rfind(b"\n>")
+        if cut != -1:
+            yield remainder[:cut + 1]
+            remainder = remainder[cut + 1:]
+    if remainder:
+        yield remainder
+
+
+def read_fasta_records(fhand):
+    #Yields the name and the sequence, without new lines, of every record
+    for chunk in iter_record_chunks(fhand):
+        for record in chunk.split(b"\n>"):
+            header, _, sequence = record.lstrip(b">").partition(b"\n")
+            if header.strip():
+                yield header.split(None, 1)[0].decode(), sequence.translate(None, b"\r\n")
+
+
+def split_by_residues(records, shard_fpaths):
+    """Splits (name, sequence) records in shards with a similar number of residues.
+
+    Longest sequences are placed first, each in the shard with fewer
+    residues so far. Sequences keep their order inside their shard.
+    """
+    order = sorted(range(len(records)), key=lambda idx: -len(records[idx][1]))
+    shards = [(0, shard) for shard in range(len(shard_fpaths))]
+    assignments = [0] * len(records)
+    for idx in order:
+        residues, shard = heapq.heappop(shards)
+        assignments[idx] = shard
+        heapq.heappush(shards, (residues + len(records[idx][1]), shard))
+    out_fhands = [open(fpath, "wb") for fpath in shard_fpaths]
+    try:
+        for (name, sequence), shard in zip(records, assignments):
+            out_fhands[shard].write(b">" + name.encode() + b"\n" + sequence + b"\n")
+    finally:
+        for out_fhand in out_fhands:
+            out_fhand.close()
+
+
+def index_fasta(mm, validate=False):
+    """Builds a samtools faidx index of a memory-mapped FASTA file.
+
+    Returns a dict {name: {"length", "offset", "linebases", "linewidth"}},
+    where offset is the position of the first base of the sequence. If
+    validate is True, ValueError is raised when sequence names are
+    duplicated or lines of a sequence have different lengths.
+    """
+    index = {}
+    header_start = mm.find(b">")
+    while header_start != -1:
+        header_end = mm.find(b"\n", header_start)
+        if header_end == -1:
+            header_end = len(mm)
+        name = mm[header_start + 1:header_end].split(maxsplit=1)
+        name = name[0].decode() if name else ""
+        offset = min(header_end + 1, len(mm))
+        next_header = mm.find(b"\n>", header_end)
+        end = len(mm) if next_header == -1 else next_header + 1
+        first_line_end = mm.find(b"\n", offset, end)
+        if first_line_end == -1:
+            first_line_end = end
+        linewidth = first_line_end - offset + 1
+        linebases = len(mm[offset:first_line_end].rstrip(b"\r"))
+        #Trailing new lines are not part of the sequence
+        seq_end = end
+        while seq_end > offset and mm[seq_end - 1:seq_end] in (b"\n", b"\r"):
+            seq_end -= 1
+        if validate:
+            if name in index:
+                raise ValueError("Sequence name {} is duplicated".format(name))
+            if not has_regular_lines(mm, offset, seq_end, linewidth):
+                raise ValueError("Sequence {} has lines of different lengths".format(name))
+        size = seq_end - offset
+        if size <= 0:
+            length = 0
+        else:
+            full_lines = (size - 1) // linewidth
+            length = full_lines * linebases + size - full_lines * linewidth
+        index[name] = {"length": length, "offset": offset,
+                       "linebases": linebases, "linewidth": linewidth}
+        header_start = next_header + 1 if next_header != -1 else -1
+    return index
+
+
+def write_fasta_index(index, out_fhand):
+    for name, record in index.items():
+        out_fhand.write("{}\t{}\t{}\t{}\t{}\n".format(name, record["length"], record["offset"],
+                                                      record["linebases"], record["linewidth"]))
+
+
+def read_fasta_index(fpath):
+    index = {}
+    with open(fpath) as fhand:
+        for line in fhand:
+            name, length, offset, linebases, linewidth = line.rstrip("\n").split("\t")[:5]
+            index[name] = {"length": int(length), "offset": int(offset),
+                           "linebases": int(linebases), "linewidth": int(linewidth)}
+    return index
+
+
+@contextmanager
+def open_genome(fpath, index_fpath=None):
+    """Yields the FASTA file memory-mapped and its index.
+
+    The index is read from index_fpath (.fai) if given, built otherwise.
+    """
+    with open(fpath, "rb") as fhand:
+        with mmap.mmap(fhand.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if index_fpath is not None and Path(index_fpath).exists():
+                index = read_fasta_index(index_fpath)
+            else:
+                index = index_fasta(mm)
+            yield mm, index
+
+
+def get_byte_position(record, position):
+    return record["offset"] + (position // record["linebases"]) * record["linewidth"] + position % record["linebases"]
+
+
+def fetch_sequence(mm, record, start, end, upper=True):
+    """Returns the bases of [start, end) (0-based), in upper case unless upper is False"""
+    start = max(0, start)
+    end = min(record["length"], end)
+    if start >= end:
+        return b""
+    sequence = mm[get_byte_position(record, start):get_byte_position(record, end - 1) + 1]
+    sequence = sequence.replace(b"\n", b"").replace(b"\r", b"")
+    return sequence.upper() if upper else sequence
+
+
+def index_assembly(config):
+    """Validates the assembly and writes its faidx index in input_sequences.
+
+    Assemblies that can't be indexed, because their lines have different
+    lengths, are reported as not valid instead of failed, so they can be
+    reformatted for the tools that need an index.
+    """
+    outdir = Path(config["Basedir"]) / "input_sequences"
+    if not outdir.exists():
+        outdir.mkdir(parents=True, exist_ok=True)
+    assembly = Path(config["Assembly"])
+    outfile = outdir / "{}.fai".format(assembly.name)
+    cmd = "index_fasta {}".format(assembly)
+    inputs = [assembly]
+    report = {"command": cmd, "outfile": outfile, "valid": True}
+    if step_done(config, outfile, cmd, inputs):
+        report["status"] = "Assembly file indexed already"
+        return report
+    start_step(config, outfile, cmd)
+    try:
+        with open(assembly, "rb") as fhand:
+            with mmap.mmap(fhand.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                index = index_fasta(mm, validate=True)
+        with atomic_output(outfile) as partial_fpath, open(partial_fpath, "w") as out_fhand:
+            write_fasta_index(index, out_fhand)
+        record_step(config, outfile, cmd, inputs)
+        report["status"] = "Assembly file with {} sequences indexed successfully".format(len(index))
+    except ValueError as error:
+        fail_step(config, outfile, cmd)
+        report["valid"] = False
+        report["status"] = "Assembly file can't be indexed: {}".format(error)
+    except OSError as error:
+        fail_step(config, outfile, cmd)
+        report["valid"] = False
+        report["status"] = "Assembly file indexing Failed: \n {}".format(error)
+    return report
@@ -0,0 +1,364 @@
+import os
+import re
+import subprocess
+import tempfile
+import zlib
+
+import numpy as np
+
+from pathlib import Path
+
+from src.compression import iter_lines
+from src.annotation import PARENT_ATTRIBUTE, iter_features, load_annotation, parse_feature
+from src.gff_stats import CDS, EXON, get_feature_table
+from src.metrics import run_command
+from src.cache import (atomic_output, fail_step, get_partial_fpath, record_step,
+                       remove_output, start_step, step_done)
+
+
+GFF_HEADER = "##gff-version 3\n"
+#Only mRNA features are used by the rest of the analysis
+MRNA_GROUP = "mrna"
+TRANSCRIPTS_LIST = "transcripts_to_mRNA.txt"
+#Marks of the features spilled to disk while splitting
+PENDING = "P\t"
+CHILDLESS = "C\t"
+#GTF attributes are key "value" pairs, GFF3 ones key=value
+GTF_ATTRIBUTE = re.compile(r'^\s*(?:gene_id|transcript_id)\s+"')
+
+
+def get_feature_groups(feature, features, known, resolved):
+    """Returns the level of the feature and the groups (files) it belongs to.
+
+    Level 1 features (genes) have no parent, level 2 features (mRNA, tRNA...)
+    define the group of the feature tree by their type and level 3 features
+    (exons, CDS...) inherit the group of their parents. Parents are looked up
+    in the current block first and then in the features already written.
+    Returns None if no parent is known yet.
+    """
+    if not feature["parents"]:
+        return (1, set())
+    value = None
+    for parent in feature["parents"]:
+        parent_value = resolve_feature(parent, features, known, resolved)
+        if parent_value is None:
+            continue
+        level, groups = parent_value
+        if level == 1:
+            group = feature["columns"][2].lower()
+            groups.add(group)
+            value = (2, {group})
+        elif value is None:
+            value = (level + 1, set(groups))
+        else:
+            value[1].update(groups)
+    return value
+
+
+def resolve_feature(feature_id, features, known, resolved):
+    if feature_id in resolved:
+        return resolved[feature_id]
+    if feature_id in known:
+        return known[feature_id]
+    if feature_id not in features:
+        return None
+    #Guards against features being their own ancestors
+    resolved[feature_id] = None
+    resolved[feature_id] = get_feature_groups(features[feature_id], features, known, resolved)
+    return resolved[feature_id]
+
+
+def write_feature(feature, groups, outdir, out_fhands):
+    line = "\t".join(feature["columns"]) + "\n"
+    for group in sorted(groups):
+        if group not in out_fhands:
+            out_fhands[group] = open(get_partial_fpath(outdir / "{}.gff".format(group)), "w")
+            out_fhands[group].write(GFF_HEADER)
+        out_fhands[group].write(line)
+
+
+def flush_block(block, known, outdir, out_fhands, spill_fhand):
+    features = {feature["id"]: feature for feature in block if feature["id"] is not None}
+    resolved = {}
+    values = []
+    for feature in block:
+        if feature["id"] is not None:
+            values.append(resolve_feature(feature["id"], features, known, resolved))
+        else:
+            values.append(get_feature_groups(feature, features, known, resolved))
+    #Level 1 and 2 features are remembered, so children found later in
+    #the file can still be assigned to their group
+    for feature_id, value in resolved.items():
+        if value is not None and value[0] <= 2:
+            known[feature_id] = value
+    for feature, value in zip(block, values):
+        if value is None:
+            spill_fhand.write(PENDING + "\t".join(feature["columns"]) + "\n")
+        elif value[0] == 1 and not value[1]:
+            spill_fhand.write(CHILDLESS + "\t".join(feature["columns"]) + "\n")
+        else:
+            write_feature(feature, value[1], outdir, out_fhands)
+
+
+def split_features(annot_fhand, outdir, out_fhands, transcripts_to_mrna):
+    """Normalizes and splits an annotation by record type in a single pass.
+
+    transcript features are renamed to mRNA and every feature tree is
+    written to a file named after the type of its level 2 features
+    (mrna.gff, trna.gff...). The file is read gene by gene, so only the
+    features of a gene are kept in memory, besides the IDs of genes and
+    transcripts, which are needed to place children found out of order.
+    Features found before their parents and genes without children yet
+    are spilled to a temporary file and written at the end.
+    Returns the number of features whose parents were not found.
+    """
+    known = {}
+    block = []
+    spill_fhand = tempfile.TemporaryFile("w+", dir=outdir)
+    for line in annot_fhand:
+        if line.startswith("#"):
+            if line.startswith("##FASTA"):
+                break
+            if line.startswith("###"):
+                flush_block(block, known, outdir, out_fhands, spill_fhand)
+                block = []
+            continue
+        if not line.strip():
+            continue
+        feature = parse_feature(line)
+        if feature is None:
+            continue
+        if feature["columns"][2] == "transcript":
+            feature["columns"][2] = "mRNA"
+            transcripts_to_mrna.append(feature["columns"][8])
+        if not feature["parents"] and block:
+            flush_block(block, known, outdir, out_fhands, spill_fhand)
+            block = []
+        block.append(feature)
+    flush_block(block, known, outdir, out_fhands, spill_fhand)
+
+    #Features found before their parents go first, they can give their
+    #group to genes without children
+    orphans = 0
+    resolved = {}
+    with spill_fhand:
+        for kind in (PENDING, CHILDLESS):
+            spill_fhand.seek(0)
+            for line in spill_fhand:
+                if not line.startswith(kind):
+                    continue
+                feature = parse_feature(line[len(kind):])
+                if kind == CHILDLESS:
+                    groups = known.get(feature["id"], (1, set()))[1]
+                    write_feature(feature, groups or {feature["columns"][2].lower()}, outdir, out_fhands)
+                    continue
+                value = get_feature_groups(feature, {}, known, resolved)
+                if value is None:
+                    orphans += 1
+                else:
+                    write_feature(feature, value[1], outdir, out_fhands)
+    return orphans
+
+
+def is_gtf(fpath):
+    #The attributes of the first feature tell GTF from GFF3
+    for line in iter_lines(fpath):
+        if line.startswith("#") or not line.strip():
+            continue
+        feature = parse_feature(line)
+        if feature is not None:
+            return bool(GTF_ATTRIBUTE.match(feature["columns"][8]))
+    return False
+
+
+def separate_gtf(config, outdir, outfile, transcripts_fpath):
+    """Splits a GTF annotation by record type with AGAT, which builds GFF3 IDs and parents.
+
+    transcript features are renamed to mRNA in a plain copy of the
+    annotation first, as done for GFF3 annotations.
+    """
+    annotation = config["Annotation"]
+    reformatted = outdir / "reformatted_annotation.gtf"
+    agat_outdir = outdir / "agat_separate_by_record_type"
+    cmd = "agat_sp_separate_by_record_type.pl --gff {} -o {}".format(reformatted, agat_outdir)
+    inputs = [annotation]
+    report = {"command": cmd, "transcripts_to_mRNA": [], "outfile": outfile}
+    if step_done(config, outfile, cmd, inputs) and transcripts_fpath.exists():
+        with open(transcripts_fpath) as fhand:
+            report["transcripts_to_mRNA"] = [line.rstrip("\n") for line in fhand]
+        report["status"] = "Annotation normalized and split by feature type already"
+        return report
+
+    start_step(config, outfile, cmd)
+    try:
+        with atomic_output(reformatted) as partial_fpath, open(partial_fpath, "w") as out_fhand:
+            for line in iter_lines(annotation, int(config.get("Threads", 1))):
+                columns = line.rstrip("\n").split("\t")
+                if not line.startswith("#") and len(columns) == 9 and columns[2] == "transcript":
+                    columns[2] = "mRNA"
+                    report["transcripts_to_mRNA"].append(columns[8])
+                    line = "\t".join(columns) + "\n"
+                out_fhand.write(line)
+        with atomic_output(transcripts_fpath) as partial_fpath, open(partial_fpath, "w") as out_fhand:
+            for description in report["transcripts_to_mRNA"]:
+                out_fhand.write(description + "\n")
+    except (OSError, ValueError, zlib.error) as error:
+        fail_step(config, outfile, cmd)
+        report["status"] = "Annotation normalization Failed: \n {}".format(error)
+        return report
+    #AGAT doesn't write into existing directories
+    remove_output(agat_outdir)
+    run_ = run_command(cmd, config, step=outfile.name, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL)
+    agat_outfile = agat_outdir / "{}.gff".format(MRNA_GROUP)
+    if run_.returncode == 0 and agat_outfile.exists():
+        os.replace(agat_outfile, outfile)
+        record_step(config, outfile, cmd, inputs)
+        report["status"] = "AGAT separate by type run successfully"
+    else:
+        fail_step(config, outfile, cmd)
+        report["status"] = "AGAT separate by type Failed: \n {}".format(run_.stderr)
+    return report
+
+
+def normalize_annotation(config):
+    outdir = Path(config["Basedir"]) / "input_sequences"
+    if not outdir.exists():
+        outdir.mkdir(parents=True, exist_ok=True)
+    annotation = config["Annotation"]
+    outfile = outdir / "{}.gff".format(MRNA_GROUP)
+    transcripts_fpath = outdir / TRANSCRIPTS_LIST
+    #GTF features are linked by gene_id and transcript_id, AGAT turns
+    #them into GFF3
+    try:
+        gtf = is_gtf(annotation)
+    except (OSError, UnicodeDecodeError, zlib.error):
+        gtf = False
+    if gtf:
+        return separate_gtf(config, outdir, outfile, transcripts_fpath)
+    cmd = "normalize_annotation {}".format(annotation)
+    inputs = [annotation]
+    report = {"command": cmd, "transcripts_to_mRNA": [], "outfile": outfile}
+    if step_done(config, outfile, cmd, inputs) and transcripts_fpath.exists():
+        with open(transcripts_fpath) as fhand:
+            report["transcripts_to_mRNA"] = [line.rstrip("\n") for line in fhand]
+        report["status"] = "Annotation normalized and split by feature type already"
+        return report
+
+    start_step(config, outfile, cmd)
+    out_fhands = {}
+    try:
+        #Compressed annotations are read as they are
+        orphans = split_features(iter_lines(annotation, int(config.get("Threads", 1))), outdir,
+                                 out_fhands, report["transcripts_to_mRNA"])
+        if MRNA_GROUP not in out_fhands:
+            out_fhands[MRNA_GROUP] = open(get_partial_fpath(outfile), "w")
+            out_fhands[MRNA_GROUP].write(GFF_HEADER)
+        for out_fhand in out_fhands.values():
+            out_fhand.close()
+        with atomic_output(transcripts_fpath) as partial_fpath, open(partial_fpath, "w") as out_fhand:
+            for description in report["transcripts_to_mRNA"]:
+                out_fhand.write(description + "\n")
+    except (OSError, ValueError, zlib.error) as error:
+        for group, out_fhand in out_fhands.items():
+            out_fhand.close()
+            remove_output(get_partial_fpath(outdir / "{}.gff".format(group)))
+        fail_step(config, outfile, cmd)
+        report["status"] = "Annotation normalization Failed: \n {}".format(error)
+        return report
+
+    #The mRNA file is renamed last, it marks the step as finished
+    for group in sorted(out_fhands, key=lambda group: group == MRNA_GROUP):
+        group_outfile = outdir / "{}.gff".format(group)
+        os.replace(get_partial_fpath(group_outfile), group_outfile)
+    record_step(config, outfile, cmd, inputs)
+    msg = "Annotation normalized and split by feature type successfully"
+    if orphans:
+        msg += ", {} features without parent were discarded".format(orphans)
+    report["status"] = msg
+    return report
+
+
+def get_isoform_lengths(table):
+    """Returns the IDs of the transcripts, the index of their gene and their CDS and exon lengths"""
+    transcripts = table["transcripts"]
+    features = table["features"]
+    lengths = features["end"] - features["start"] + 1
+    isoform_lengths = {}
+    for feature_type in (CDS, EXON):
+        of_type = features["type"] == feature_type
+        isoform_lengths[feature_type] = np.bincount(features["transcript"][of_type], weights=lengths[of_type],
+                                                    minlength=len(transcripts["id"])).astype(np.int64)
+    return transcripts["id"], transcripts["gene"], isoform_lengths[CDS], isoform_lengths[EXON]
+
+
+def select_longest_isoforms(transcript_genes, cds, exons):
+    """Returns the indexes of the longest transcript of each gene.
+
+    Transcripts are compared by CDS length and then by exon length, as
+    non coding ones have no CDS. Ties are solved keeping the first one
+    found in the file.
+    """
+    if not len(transcript_genes):
+        return np.array([], dtype=np.int64)
+    order = np.arange(len(transcript_genes))
+    #Last key sorts first: by gene, longest CDS, longest exons and file order
+    sorted_idx = np.lexsort((order, -exons, -cds, transcript_genes))
+    sorted_genes = transcript_genes[sorted_idx]
+    first_of_gene = np.ones(len(sorted_genes), dtype=bool)
+    first_of_gene[1:] = sorted_genes[1:] != sorted_genes[:-1]
+    return np.sort(sorted_idx[first_of_gene])
+
+
+def replace_parents(attributes, parents):
+    match = PARENT_ATTRIBUTE.search(attributes)
+    return attributes[:match.start(1)] + ",".join(parents) + attributes[match.end(1):]
+
+
+def write_longest_isoforms(annot_fhand, out_fhand, selected, transcripts):
+    #Children of several transcripts only keep the selected ones as parents
+    out_fhand.write(GFF_HEADER)
+    for feature in iter_features(annot_fhand):
+        if feature["id"] in transcripts and feature["id"] not in selected:
+            continue
+        parents = [parent for parent in feature["parents"]
+                   if parent not in transcripts or parent in selected]
+        if feature["parents"] and not parents:
+            continue
+        if parents != feature["parents"]:
+            feature["columns"][8] = replace_parents(feature["columns"][8], parents)
+        out_fhand.write("\t".join(feature["columns"]) + "\n")
+
+
+def get_gff_transcript_ids(fpath):
+    #Loaded through the model cache, so the longest isoform annotation is
+    #parsed once for all the sequence kinds
+    return set(get_feature_table(load_annotation(fpath))["transcripts"]["id"])
+
+
+def get_longest_isoform(config):
+    outdir = Path(config["Basedir"]) / "input_sequences"
+    if not outdir.exists():
+        outdir.mkdir(parents=True, exist_ok=True)
+    annotation = Path(config["Annotation"])
+    outfile = outdir / "{}.longest_isoform.gff3".format(Path(config["Assembly"]).stem)
+    cmd = "keep_longest_isoform {}".format(annotation)
+    inputs = [annotation]
+    if step_done(config, outfile, cmd, inputs):
+        msg = "Longest isoform from annotation file selected already"
+    else:
+        start_step(config, outfile, cmd)
+        try:
+            transcript_ids, transcript_genes, cds, exons = get_isoform_lengths(get_feature_table(load_annotation(annotation)))
+            selected_idx = select_longest_isoforms(transcript_genes, cds, exons)
+            selected = {transcript_ids[idx] for idx in selected_idx}
+            with atomic_output(outfile) as partial_fpath:
+                with open(annotation) as annot_fhand, open(partial_fpath, "w") as out_fhand:
+                    write_longest_isoforms(annot_fhand, out_fhand, selected, set(transcript_ids))
+            record_step(config, outfile, cmd, inputs)
+            msg = "Longest isoform selected for {} genes successfully".format(len(selected))
+        except (OSError, ValueError) as error:
+            fail_step(config, outfile, cmd)
+            msg = "Longest isoform selection Failed: \n {}".format(error)
+    report = {"command": cmd, "status": msg,
+              "outfile": outfile}
+    return report
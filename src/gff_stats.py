@@ -0,0 +1,247 @@
+import numpy as np
+
+from pathlib import Path
+
+from src.cache import atomic_output, fail_step, record_step, start_step, step_done
+from src.annotation import get_levels, load_annotation
+
+
+#Level 3 features used by the statistics, with the names used by AGAT
+FEATURE_TYPES = {"exon": 0, "CDS": 1, "five_prime_UTR": 2, "three_prime_UTR": 3}
+EXON, CDS, UTR5, UTR3 = range(4)
+#Edges (bp) of the intron length histogram, the last bin has no upper limit
+INTRON_HISTOGRAM_BINS = [1, 20, 40, 60, 80, 100, 150, 200, 300, 500, 1000, 2000, 5000, 10000, 50000]
+
+
+def get_first_rows(model, rows):
+    #Rows of features with several parents are repeated, only the first is kept
+    _, first = np.unique(model["id"][rows], return_index=True)
+    return rows[np.sort(first)]
+
+
+def add_missing_exons(features, num_transcripts):
+    """Adds exons, made from their CDS and UTRs, to the transcripts without them.
+
+    Pieces that overlap or touch are merged in a single exon, as AGAT
+    does when it completes the annotation.
+    """
+    transcripts = features["transcript"]
+    with_exons = np.zeros(num_transcripts + 1, dtype=bool)
+    with_exons[transcripts[(features["type"] == EXON) & (transcripts >= 0)]] = True
+    pieces = np.flatnonzero((features["type"] != EXON) & (transcripts >= 0) & ~with_exons[transcripts])
+    if not len(pieces):
+        return features
+    order = np.lexsort((features["start"][pieces], transcripts[pieces]))
+    pieces = pieces[order]
+    piece_transcripts, starts, ends = transcripts[pieces], features["start"][pieces], features["end"][pieces]
+    #Transcripts are shifted, so pieces of different ones are never merged
+    offset = int(ends.max()) + 2
+    shifted_starts = starts + piece_transcripts * offset
+    furthest_end = np.maximum.accumulate(ends + piece_transcripts * offset)
+    new_exon = np.ones(len(pieces), dtype=bool)
+    new_exon[1:] = shifted_starts[1:] > furthest_end[:-1] + 1
+    firsts = np.flatnonzero(new_exon)
+    exons = {"transcript": piece_transcripts[firsts],
+             "type": np.full(len(firsts), EXON, dtype=features["type"].dtype),
+             "start": starts[firsts],
+             "end": np.maximum.reduceat(ends, firsts),
+             "phase": np.full(len(firsts), -1, dtype=features["phase"].dtype),
+             "cds_id": np.full(len(firsts), -1, dtype=features["cds_id"].dtype)}
+    return {column: np.concatenate([values, exons[column]]) for column, values in features.items()}
+
+
+def get_feature_table(model):
+    """Arranges an annotation model as genes, transcripts and their exons, CDS and UTRs.
+
+    Genes and transcripts are numbered in file order and features refer
+    to their transcript by that number. Transcripts without exons get
+    them from their CDS and UTRs.
+    """
+    levels = get_levels(model)
+    has_id = model["id"] >= 0
+    gene_rows = get_first_rows(model, np.flatnonzero((levels == 1) & has_id))
+    transcript_rows = get_first_rows(model, np.flatnonzero((levels == 2) & has_id))
+    #Numbers of genes and transcripts by ID code
+    gene_numbers = np.full(len(model["ids"]), -1, dtype=np.int64)
+    gene_numbers[model["id"][gene_rows]] = np.arange(len(gene_rows))
+    transcript_numbers = np.full(len(model["ids"]), -1, dtype=np.int64)
+    transcript_numbers[model["id"][transcript_rows]] = np.arange(len(transcript_rows))
+
+    type_codes = np.full(len(model["types"]), -1, dtype=np.int8)
+    for feature_type, code in FEATURE_TYPES.items():
+        if feature_type in model["types"]:
+            type_codes[model["types"].index(feature_type)] = code
+    feature_rows = np.flatnonzero((levels == 3) & (type_codes[model["type"]] >= 0))
+    features = {"transcript": transcript_numbers[model["id"][model["parent"][feature_rows]]],
+                "type": type_codes[model["type"][feature_rows]],
+                "start": model["start"][feature_rows],
+                "end": model["end"][feature_rows],
+                "phase": model["phase"][feature_rows],
+                "cds_id": model["id"][feature_rows]}
+    features = add_missing_exons(features, len(transcript_rows))
+    return {"genes": {"seqid_strand": model["seqid"][gene_rows].astype(np.int64) * 3 + model["strand"][gene_rows] + 1,
+                      "start": model["start"][gene_rows],
+                      "end": model["end"][gene_rows]},
+            "transcripts": {"id": [model["ids"][code] for code in model["id"][transcript_rows]],
+                            "gene": gene_numbers[model["id"][model["parent"][transcript_rows]]],
+                            "seqid": model["seqid"][transcript_rows].astype(np.int64),
+                            "strand": model["strand"][transcript_rows],
+                            "start": model["start"][transcript_rows]},
+            "features": features,
+            "seqids": model["seqids"]}
+
+
+def count_overlapping_genes(seqid_strands, starts, ends):
+    #Genes are swept by position in every sequence and strand, a gene
+    #overlaps the previous ones if it starts before the furthest end seen.
+    #Sequences are shifted so genes of different ones never overlap
+    if len(starts) < 2:
+        return 0
+    offset = int(ends.max()) + 1
+    starts = starts + seqid_strands * offset
+    ends = ends + seqid_strands * offset
+    order = np.argsort(starts, kind="stable")
+    starts, ends = starts[order], ends[order]
+    furthest_end = np.maximum.accumulate(ends)
+    overlaps_previous = np.zeros(len(starts), dtype=bool)
+    overlaps_previous[1:] = starts[1:] <= furthest_end[:-1]
+    clusters = np.cumsum(~overlaps_previous)
+    sizes = np.bincount(clusters)
+    return int(sizes[sizes > 1].sum())
+
+
+def get_introns(features, feature_type=EXON):
+    #Introns are the gaps between consecutive pieces of each transcript
+    pieces = features["type"] == feature_type
+    transcripts, starts, ends = features["transcript"][pieces], features["start"][pieces], features["end"][pieces]
+    order = np.lexsort((starts, transcripts))
+    transcripts, starts, ends = transcripts[order], starts[order], ends[order]
+    same_transcript = transcripts[1:] == transcripts[:-1]
+    introns = starts[1:][same_transcript] - ends[:-1][same_transcript] - 1
+    return introns[introns > 0]
+
+
+def mean_length(lengths):
+    return int(round(lengths.mean())) if len(lengths) else 0
+
+
+def max_length(lengths):
+    return int(lengths.max()) if len(lengths) else 0
+
+
+def min_length(lengths):
+    return int(lengths.min()) if len(lengths) else 0
+
+
+def compute_annotation_stats(table):
+    """Computes the mRNA statistics reported by agat_sp_statistics.pl.
+
+    Keys are the labels used in the AGAT report, so both can be parsed
+    the same way.
+    """
+    genes = table["genes"]
+    transcript_genes = table["transcripts"]["gene"]
+    features = table["features"]
+    num_transcripts = len(transcript_genes)
+    lengths = features["end"] - features["start"] + 1
+
+    counts = {}
+    for feature_type in (EXON, UTR5, UTR3):
+        counts[feature_type] = np.bincount(features["transcript"][features["type"] == feature_type],
+                                           minlength=num_transcripts)
+    single_exon_transcripts = counts[EXON] == 1
+    #A gene is single exon if all its transcripts are
+    multi_exon_genes = np.zeros(len(genes["start"]), dtype=bool)
+    multi_exon_genes[transcript_genes[~single_exon_transcripts]] = True
+    genes_with_transcripts = np.zeros(len(genes["start"]), dtype=bool)
+    genes_with_transcripts[transcript_genes] = True
+
+    cds = features["type"] == CDS
+    cds_lengths = np.bincount(features["transcript"][cds], weights=lengths[cds],
+                              minlength=num_transcripts)
+    cds_lengths = cds_lengths[cds_lengths > 0]
+    num_cds = np.unique(np.stack([features["transcript"][cds], features["cds_id"][cds]]), axis=1).shape[1]
+    gene_lengths = genes["end"] - genes["start"] + 1
+    introns = get_introns(features, CDS)
+
+    return {"Number of gene": len(gene_lengths),
+            "Number of mrna": num_transcripts,
+            "Number of cds": num_cds,
+            "Number of exon": int(counts[EXON].sum()),
+            "Number of five_prime_utr": int(counts[UTR5].sum()),
+            "Number of three_prime_utr": int(counts[UTR3].sum()),
+            "Number of mrnas with utr both sides": int(((counts[UTR5] > 0) & (counts[UTR3] > 0)).sum()),
+            "Number gene overlapping": count_overlapping_genes(genes["seqid_strand"], genes["start"], genes["end"]),
+            "Number of single exon gene": int((genes_with_transcripts & ~multi_exon_genes).sum()),
+            "Number of single exon mrna": int(single_exon_transcripts.sum()),
+            "Total gene length (bp)": int(gene_lengths.sum()),
+            "mean gene length (bp)": mean_length(gene_lengths),
+            "mean cds length (bp)": mean_length(cds_lengths),
+            "mean exon length (bp)": mean_length(lengths[features["type"] == EXON]),
+            "mean intron in cds length (bp)": mean_length(introns),
+            "Longest gene (bp)": max_length(gene_lengths),
+            "Longest cds (bp)": max_length(cds_lengths),
+            "Longest intron into cds part (bp)": max_length(introns),
+            "Shortest gene (bp)": min_length(gene_lengths),
+            "Shortest cds piece (bp)": min_length(lengths[cds]),
+            "Shortest intron into cds part (bp)": min_length(introns)}
+
+
+def run_annotation_stats(config, outfile):
+    annotation = config["Annotation"]
+    cmd = "annotation_stats {}".format(annotation)
+    inputs = [annotation]
+    if step_done(config, outfile, cmd, inputs):
+        msg = "Annotation stats already done"
+    else:
+        start_step(config, outfile, cmd)
+        try:
+            stats = compute_annotation_stats(get_feature_table(load_annotation(annotation)))
+            with atomic_output(outfile) as partial_fpath, open(partial_fpath, "w") as out_fhand:
+                for key, value in stats.items():
+                    out_fhand.write("{}\t{}\n".format(key, value))
+            record_step(config, outfile, cmd, inputs)
+            msg = "Annotation stats run successfully"
+        except (OSError, ValueError) as error:
+            fail_step(config, outfile, cmd)
+            msg = "Annotation stats Failed: \n {}".format(error)
+    return {"command": cmd, "status": msg, "outfile": Path(outfile)}
+
+
+def write_intron_histogram(intron_lengths, out_fhand):
+    #The last bin is open, so its end is written as "-" whatever the longest intron
+    edges = INTRON_HISTOGRAM_BINS + [max(INTRON_HISTOGRAM_BINS[-1], max_length(intron_lengths)) + 1]
+    counts, _ = np.histogram(intron_lengths, bins=edges)
+    ends = [str(end - 1) for end in edges[1:-1]] + ["-"]
+    out_fhand.write("From (bp)\tTo (bp)\tIntrons (N)\n")
+    for start, end, count in zip(edges[:-1], ends, counts):
+        out_fhand.write("{}\t{}\t{}\n".format(start, end, count))
+
+
+def run_intron_stats(config, outfile, histogram_outfile):
+    """Measures introns between the exons of every transcript.
+
+    Exons are those of the stats table, so transcripts with only CDS
+    and UTR rows get their introns from the merged pieces. Intron lengths are stored as a numpy array in outfile and their
+    histogram as a tsv in histogram_outfile.
+    """
+    annotation = config["Annotation"]
+    cmd = "intron_stats {}".format(annotation)
+    inputs = [annotation]
+    if step_done(config, outfile, cmd, inputs) and Path(histogram_outfile).exists():
+        msg = "Intron stats already done"
+    else:
+        start_step(config, outfile, cmd)
+        try:
+            intron_lengths = get_introns(get_feature_table(load_annotation(annotation))["features"])
+            with atomic_output(histogram_outfile) as partial_fpath, open(partial_fpath, "w") as out_fhand:
+                write_intron_histogram(intron_lengths, out_fhand)
+            with atomic_output(outfile) as partial_fpath, open(partial_fpath, "wb") as out_fhand:
+                np.save(out_fhand, intron_lengths)
+            record_step(config, outfile, cmd, inputs)
+            msg = "Intron stats run successfully"
+        except (OSError, ValueError) as error:
+            fail_step(config, outfile, cmd)
+            msg = "Intron stats Failed: \n {}".format(error)
+    return {"command": cmd, "status": msg, "outfile": Path(outfile),
+            "histogram": Path(histogram_outfile)}
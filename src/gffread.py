@@ -3,29 +3,44 @@ import subprocess
 from collections import defaultdict
 from pathlib import Path
 
+from src.cache import atomic_output, fail_step, record_step, run_atomic, start_step, step_done
+from src.gff import get_gff_transcript_ids
 
 
-def reformat_annotation(config):
-    outdir = Path(config["Basedir"]) / "reformatted_annotation"
-    annotation = config["Annotation"]
-    outfile = outdir / "reformatted_annotation.gff3"
-    report = {"transcripts_to_mRNA": [], "outfile": outfile}
-    if not outdir.exists():
-        outdir.mkdir(parents=True, exist_ok=True)
-    with open(outfile, "w") as out_fhand:
-        with open(annotation) as annot_fhand:
-            for line in annot_fhand:
-                if line.startswith("#"):
-                    out_fhand.write(line)
-                else:
-                    line = line.rstrip().split()
-                    description = " ".join(line[8:])
-                    if line[2] == "transcript":
-                        line[2] = "mRNA"
-                        report["transcripts_to_mRNA"].append(description)
-                    line = "\t".join(line[0:8]) + "\t" + description + "\n"
-                    out_fhand.write(line)
-    return report
+def filter_fasta_by_ids(in_fhand, out_fhand, ids):
+    #Sequences are copied as they are, only their headers are parsed
+    keep = False
+    for line in in_fhand:
+        if line.startswith(b">"):
+            name = line[1:].split(None, 1)
+            keep = bool(name) and name[0].decode() in ids
+        if keep:
+            out_fhand.write(line)
+
+
+def filter_longest_isoform(config, kind, full_outfile, outfile):
+    """Keeps the longest isoform sequences of a gffread full set FASTA.
+
+    Transcripts are selected by the IDs found in Annotation_Longest, so
+    the output is the same gffread would extract from that annotation.
+    """
+    annotation = config["Annotation_Longest"]
+    cmd = "filter_fasta {} {}".format(full_outfile, annotation)
+    inputs = [full_outfile, annotation]
+    if step_done(config, outfile, cmd, inputs):
+        return cmd, "{} sequences already extracted".format(kind)
+    start_step(config, outfile, cmd)
+    try:
+        ids = get_gff_transcript_ids(annotation)
+        with atomic_output(outfile) as partial_fpath:
+            with open(full_outfile, "rb") as in_fhand, open(partial_fpath, "wb") as out_fhand:
+                filter_fasta_by_ids(in_fhand, out_fhand, ids)
+    except (OSError, ValueError) as error:
+        fail_step(config, outfile, cmd)
+        return cmd, "Longest isoform filter, mode {} Failed: \n {}".format(kind, error)
+    record_step(config, outfile, cmd, inputs)
+    return cmd, "Longest isoform filter, mode {} run successfully".format(kind)
+
 
 def run_gffread(config):
     report = {"cds": {"mode": "x", "command": "", "status": "", "outfile": ""}, 
@@ -44,6 +59,22 @@ def run_gffread(config):
 
     for kind, values in report.items():
         outfile = outdir / "{}.{}.fasta".format(Path(config["Assembly"]).stem, kind)
+        outfile_renamed = outdir / "{}.{}.renamed.fasta".format(Path(config["Assembly"]).stem, kind)
+        #BUSCO sequences are renamed after extraction, that's the final file
+        final_outfile = outfile_renamed if "busco" in kind else outfile
+        #Longest isoforms with complete CDS are already in the full set files
+        if "longest_isoform" in kind:
+            full_kind = kind.replace("_longest_isoform", "")
+            full_outfile = report[full_kind]["outfile"]
+            if "Failed" in report[full_kind]["status"]:
+                cmd = report[full_kind]["command"]
+                msg = "Longest isoform filter, mode {} Failed: \n {} sequences not extracted".format(kind, full_kind)
+            else:
+                cmd, msg = filter_longest_isoform(config, kind, full_outfile, outfile)
+            report[kind]["command"] = cmd
+            report[kind]["status"] = msg
+            report[kind]["outfile"] = final_outfile
+            continue
         if "longest" in kind:
             annotation = config["Annotation_Longest"]
         else:
@@ -58,15 +89,16 @@ def run_gffread(config):
                                                       outfile,
                                                       config["Assembly"],
                                                       annotation)
-        if outfile.exists():
+        inputs = [config["Assembly"], annotation]
+        if step_done(config, final_outfile, cmd, inputs):
             msg = "{} sequences already extracted".format(kind)
         else:
-            run_ = subprocess.run(cmd, shell=True, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL)
+            start_step(config, final_outfile, cmd)
+            run_ = run_atomic(cmd, outfile, config, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL)
             if run_.returncode == 0:
                 if "busco" in kind:
-                    outfile_renamed = outdir / "{}.{}.renamed.fasta".format(Path(config["Assembly"]).stem, kind)
                     with open(outfile) as fhand:
-                        with open(outfile_renamed, "w") as out_fhand:
+                        with atomic_output(outfile_renamed) as partial_fpath, open(partial_fpath, "w") as out_fhand:
                             seen = defaultdict(int)
                             for line in fhand:
                                 if line.startswith(">"):
@@ -76,11 +108,12 @@ def run_gffread(config):
                                     out_fhand.write(f">{base_id}_{seen[base_id]}\n")
                                 else:
                                     out_fhand.write(line)
-                    outfile = outfile_renamed
+                record_step(config, final_outfile, cmd, inputs)
                 msg = "GFFread, mode {} run successfully".format(kind)
             else:
+                fail_step(config, final_outfile, cmd)
                 msg = "GFFread, mode {} Failed: \n {}".format(kind, run_.stderr)
         report[kind]["command"] = cmd
         report[kind]["status"] = msg
-        report[kind]["outfile"] = outfile
+        report[kind]["outfile"] = final_outfile
     return report
@@ -1,28 +1,359 @@
+import fcntl
+import gzip
+import hashlib
+import json
+import re
 import subprocess
 
+from contextlib import ExitStack
 from pathlib import Path
 
-def run_protein_homology(config, protein_sequences):
+from src.cache import (atomic_output, fail_step, file_digest, record_step, run_atomic, start_step,
+                       step_done)
+from src.compression import is_compressed, iter_chunks
+
+
+#Shared by all the runs of the user, so each FASTA database is built once
+DEFAULT_DIAMOND_CACHE = Path.home() / ".cache" / "GAQET" / "diamond"
+#Digests of the databases by path, size and mtime, so they are hashed once
+DIGESTS_MEMO = "digests.json"
+#Bytes read to tell FASTA files from DIAMOND databases
+FASTA_PEEK = 1024
+#Proteins count as having homologs if they have a hit below this e-value
+HIT_EVALUE = 1e-20
+#presence only asks DIAMOND for the best hit below HIT_EVALUE,
+#full keeps DIAMOND defaults and its whole tabular output
+HOMOLOGY_MODES = ["presence", "full"]
+PRESENCE_OPTIONS = "--outfmt 6 qseqid sseqid evalue"
+#Column of the e-value in the output of each mode
+EVALUE_COLUMNS = {"presence": 2, "full": 10}
+#E-values reported by each mode, 0.001 is DIAMOND default
+EVALUE_CUTOFFS = {"presence": HIT_EVALUE, "full": 0.001}
+DIAMOND_SENSITIVITIES = ["faster", "fast", "mid-sensitive", "sensitive", "more-sensitive",
+                         "very-sensitive", "ultra-sensitive"]
+#Hits kept for each protein and database, 25 is DIAMOND default
+MAX_TARGETS = {"presence": 1, "full": 25}
+#Hits asked to the combined search for each database. DIAMOND can't
+#limit them by database, so proteins with more hits than these in other
+#databases could miss the hits of a database
+COMBINED_TARGETS = 25
+#Subject IDs of the combined database are prefixed with their tag
+TAG_SEPARATOR = "|"
+HEADER_LINE = re.compile(rb"^>[^\r\n]*", re.M)
+
+
+def get_search_options(config, max_targets=None, evalue=None):
+    #Modes set the hits and e-value reported, unless they are given
+    mode = config.get("Homology_mode", "presence")
+    if mode == "presence":
+        max_targets = max_targets or MAX_TARGETS[mode]
+        evalue = evalue or EVALUE_CUTOFFS[mode]
+    options = []
+    if max_targets:
+        options.append("--max-target-seqs {}".format(max_targets))
+    if evalue:
+        options.append("--evalue {:g}".format(evalue))
+    if mode == "presence":
+        options.append(PRESENCE_OPTIONS)
+    if config.get("Homology_sensitivity"):
+        options.append("--{}".format(config["Homology_sensitivity"]))
+    return " ".join(options)
+
+
+def is_fasta_db(db_fpath):
+    #DIAMOND databases are binary, FASTA files (maybe compressed) start with >
+    opener = gzip.open if is_compressed(db_fpath) else open
+    with opener(db_fpath, "rb") as fhand:
+        return fhand.read(FASTA_PEEK).lstrip().startswith(b">")
+
+
+def get_diamond_cache(config):
+    cache = Path(config.get("Diamond_cache") or DEFAULT_DIAMOND_CACHE)
+    cache.mkdir(parents=True, exist_ok=True)
+    return cache
+
+
+def get_db_digest(config, db_fpath):
+    """Returns the content digest of a database file.
+
+    Digests are kept in the shared cache by path, size and mtime, so every
+    run directory doesn't hash the same database again. The memo is
+    locked, so runs needing the same digest at the same time hash it once.
+    """
+    cache = get_diamond_cache(config)
+    fpath = Path(db_fpath).resolve()
+    stat = fpath.stat()
+    key = "{}\t{}\t{}".format(fpath, stat.st_size, stat.st_mtime_ns)
+    memo_fpath = cache / DIGESTS_MEMO
+    with open(cache / "{}.lock".format(DIGESTS_MEMO), "w") as lock_fhand:
+        fcntl.flock(lock_fhand, fcntl.LOCK_EX)
+        memo = {}
+        if memo_fpath.exists():
+            with open(memo_fpath) as fhand:
+                memo = json.load(fhand)
+        if key not in memo:
+            memo[key] = file_digest(fpath)
+            with atomic_output(memo_fpath) as partial_fpath, open(partial_fpath, "w") as out_fhand:
+                json.dump(memo, out_fhand, indent=2)
+        return memo[key]
+
+
+def build_diamond_db(config, digest, fasta_fpath, label, write_fasta=None):
+    """Builds a FASTA file with diamond makedb into the cache, named by digest.
+
+    Builds are locked, so runs needing the same database at the same time
+    build it only once. If write_fasta is given, it writes the FASTA file
+    to build to the handle it gets, and the file is removed once built.
+    The dict it returns is kept next to the database ({digest}.json).
+    Returns the database path and a message, None if the build failed.
+    """
+    cache = get_diamond_cache(config)
+    dmnd_fpath = cache / "{}.dmnd".format(digest)
+    info_fpath = cache / "{}.json".format(digest)
+    with open(cache / "{}.lock".format(digest), "w") as lock_fhand:
+        fcntl.flock(lock_fhand, fcntl.LOCK_EX)
+        if dmnd_fpath.exists() and (write_fasta is None or info_fpath.exists()):
+            return dmnd_fpath, "DIAMOND database of {} found in cache. ".format(label)
+        if write_fasta is not None:
+            with atomic_output(fasta_fpath) as partial_fpath, open(partial_fpath, "wb") as out_fhand:
+                info = write_fasta(out_fhand)
+            with atomic_output(info_fpath) as partial_fpath, open(partial_fpath, "w") as out_fhand:
+                json.dump(info, out_fhand, indent=2)
+        cmd = "diamond makedb --threads {} --in {} --db {}".format(config["Threads"], fasta_fpath, dmnd_fpath)
+        run_ = run_atomic(cmd, dmnd_fpath, config, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL)
+        if write_fasta is not None:
+            Path(fasta_fpath).unlink()
+    if run_.returncode != 0:
+        return None, "DIAMOND database of {} Failed to build: \n {}".format(label, run_.stderr)
+    return dmnd_fpath, "DIAMOND database of {} built and cached. ".format(label)
+
+
+def get_diamond_db(config, db_fpath):
+    """Returns the DIAMOND database to search for a PROTHOMOLOGY_tags path.
+
+    FASTA files are built into a cache shared by all runs, named after
+    their content digest.
+    """
+    if not is_fasta_db(db_fpath):
+        return Path(db_fpath), ""
+    digest = get_db_digest(config, db_fpath)
+    return build_diamond_db(config, digest, db_fpath, db_fpath)
+
+
+def count_residues(lines):
+    #lines are whole FASTA lines
+    headers = sum(len(match.group()) for match in HEADER_LINE.finditer(lines))
+    return len(lines) - headers - lines.count(b"\n") - lines.count(b"\r")
+
+
+def write_combined_fasta(dbs, out_fhand, threads=1):
+    """Writes the FASTA databases of the (tag, path) pairs in a single file.
+
+    Every sequence ID gets the tag of its database as prefix. Returns the
+    number of residues of each database, which sets its e-values.
+    """
+    residues = {}
+    for tag, db_fpath in dbs:
+        prefix = (tag + TAG_SEPARATOR).encode()
+        residues[tag] = 0
+        remainder = b""
+        for chunk in iter_chunks(db_fpath, threads):
+            chunk = remainder + chunk
+            last_newline = chunk.rfind(b"\n") + 1
+            chunk, remainder = chunk[:last_newline], chunk[last_newline:]
+            residues[tag] += count_residues(chunk)
+            out_fhand.write((b"\n" + chunk).replace(b"\n>", b"\n>" + prefix)[1:])
+        if remainder:
+            residues[tag] += count_residues(remainder)
+            out_fhand.write((b"\n" + remainder).replace(b"\n>", b"\n>" + prefix)[1:] + b"\n")
+    return {"residues": residues}
+
+
+def get_combined_db(config, dbs):
+    """Returns the DIAMOND database merging the FASTA databases of the (tag, path) pairs.
+
+    It is cached by the tags and the digests of their databases. Returns
+    the database path, a message and the residues of every database.
+    """
+    fpaths = [db_fpath for _, db_fpath in dbs]
+    digest = hashlib.sha256("".join("{}\t{}\n".format(tag, get_db_digest(config, db_fpath))
+                                    for tag, db_fpath in dbs).encode()).hexdigest()
+    cache = get_diamond_cache(config)
+    diamond_db, msg = build_diamond_db(config, digest, cache / "{}.fasta".format(digest),
+                                       " ".join(fpaths),
+                                       lambda out_fhand: write_combined_fasta(dbs, out_fhand, int(config["Threads"])))
+    if diamond_db is None:
+        return None, msg, {}
+    with open(cache / "{}.json".format(digest)) as fhand:
+        return diamond_db, msg, json.load(fhand)["residues"]
+
+
+def split_hits(in_fhand, out_fhands, max_targets, scales, evalue_column, cutoff):
+    """Writes the hits of a combined search to the handle of their tag, without the prefix.
+
+    E-values grow with the size of the database, so they are scaled to
+    the size of the database of the tag and hits above cutoff dropped.
+    Hits of each protein come sorted by score, so the first max_targets of
+    every tag are the ones a search of its database alone would report.
+    """
+    query = None
+    counts = {}
+    for line in in_fhand:
+        fields = line.rstrip("\n").split("\t")
+        if len(fields) <= evalue_column:
+            continue
+        tag, _, subject = fields[1].partition(TAG_SEPARATOR)
+        if tag not in out_fhands:
+            continue
+        evalue = float(fields[evalue_column]) * scales[tag]
+        if evalue > cutoff:
+            continue
+        if fields[0] != query:
+            query = fields[0]
+            counts = {}
+        counts[tag] = counts.get(tag, 0) + 1
+        if counts[tag] > max_targets:
+            continue
+        fields[1] = subject
+        fields[evalue_column] = "{:.2e}".format(evalue)
+        out_fhands[tag].write("\t".join(fields) + "\n")
+
+
+def get_homology_report(config, cmd, msg, outfile, representatives):
+    return {"command": cmd, "status": msg, "outfile": outfile,
+            "mode": config.get("Homology_mode", "presence"),
+            "representatives": representatives}
+
+
+def get_homology_outfile(config, outdir, tag):
+    return outdir / "{}.proteins.dmd.{}.o6.txt".format(config["ID"], tag)
+
+
+def run_homology_search(config, tag, db_fpath, protein_sequences, representatives, outdir):
+    outfile = get_homology_outfile(config, outdir, tag)
+    try:
+        diamond_db, db_msg = get_diamond_db(config, db_fpath)
+    except OSError as error:
+        diamond_db, db_msg = None, "DIAMOND database of {} Failed: \n {}".format(db_fpath, error)
+    if diamond_db is None:
+        msg = "Protein homology analysis with {} Failed: \n {}".format(tag, db_msg)
+        return get_homology_report(config, "", msg, outfile, representatives)
+    cmd = "diamond blastp --threads {} --db {} --query {} --out {} {}".format(config["Threads"],
+                                                                           str(diamond_db),
+                                                                           str(protein_sequences),
+                                                                           str(outfile),
+                                                                           get_search_options(config)).rstrip()
+    #Cached databases are named by their digest, which is in cmd, so the
+    #FASTA file isn't hashed again in every run directory
+    inputs = [protein_sequences] if Path(diamond_db) != Path(db_fpath) else [protein_sequences, db_fpath]
+    if step_done(config, outfile, cmd, inputs):
+        msg = db_msg + "Protein homology analysis with {} already done".format(tag)
+    else:
+        start_step(config, outfile, cmd)
+        run_ = run_atomic(cmd, outfile, config, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL)
+    #Is process has gone well
+        if run_.returncode == 0:
+            record_step(config, outfile, cmd, inputs)
+            msg = db_msg + "Protein homology analysis with {} run successfully".format(tag)
+    #But if not
+        else:
+            fail_step(config, outfile, cmd)
+            msg = "Protein homology analysis with {} Failed: \n {}".format(tag, run_.stderr)
+    return get_homology_report(config, cmd, msg, outfile, representatives)
+
+
+def run_combined_search(config, dbs, protein_sequences, representatives, outdir):
+    """Searches the proteins once against the FASTA databases of the (tag, path) pairs merged.
+
+    Hits are split by tag into the files each database would have had
+    searched alone, with their e-values scaled to it, so they are parsed
+    the same way.
+    """
+    tags = [tag for tag, _ in dbs]
+    outfiles = {tag: get_homology_outfile(config, outdir, tag) for tag in tags}
+    combined_outfile = outdir / "{}.proteins.dmd.combined.o6.txt".format(config["ID"])
+    try:
+        diamond_db, db_msg, residues = get_combined_db(config, dbs)
+    except (OSError, ValueError, KeyError) as error:
+        diamond_db, db_msg = None, "Combined DIAMOND database Failed: \n {}".format(error)
+    if diamond_db is None:
+        return {tag: get_homology_report(config, "", "Protein homology analysis with {} Failed: \n {}".format(tag, db_msg),
+                                         outfiles[tag], representatives) for tag in tags}
+    #The combined database is bigger than any of its databases, so it is
+    #searched with the e-value that the smallest one would have at the cutoff
+    mode = config.get("Homology_mode", "presence")
+    total_residues = sum(residues.values())
+    scales = {tag: max(1, tag_residues) / max(1, total_residues) for tag, tag_residues in residues.items()}
+    evalue = EVALUE_CUTOFFS[mode] / min(scales.values())
+    max_targets = COMBINED_TARGETS * len(dbs)
+    cmd = "diamond blastp --threads {} --db {} --query {} --out {} {}".format(config["Threads"],
+                                                                           str(diamond_db),
+                                                                           str(protein_sequences),
+                                                                           str(combined_outfile),
+                                                                           get_search_options(config, max_targets, evalue)).rstrip()
+    inputs = [protein_sequences]
+    if step_done(config, combined_outfile, cmd, inputs):
+        msg = db_msg + "Combined protein homology analysis already done. "
+    else:
+        start_step(config, combined_outfile, cmd)
+        run_ = run_atomic(cmd, combined_outfile, config, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL)
+        if run_.returncode != 0:
+            fail_step(config, combined_outfile, cmd)
+            return {tag: get_homology_report(config, cmd, "Protein homology analysis with {} Failed: \n {}".format(tag, run_.stderr),
+                                             outfiles[tag], representatives) for tag in tags}
+        record_step(config, combined_outfile, cmd, inputs)
+        msg = db_msg + "Combined protein homology analysis run successfully. "
+
+    split_cmd = "split_hits {}".format(combined_outfile)
+    split_inputs = [combined_outfile]
+    if all(step_done(config, outfile, split_cmd, split_inputs) for outfile in outfiles.values()):
+        return {tag: get_homology_report(config, cmd, msg + "Hits of {} split already".format(tag),
+                                         outfiles[tag], representatives) for tag in tags}
+    for outfile in outfiles.values():
+        start_step(config, outfile, split_cmd)
+    try:
+        with ExitStack() as stack:
+            out_fhands = {tag: stack.enter_context(open(stack.enter_context(atomic_output(outfile)), "w"))
+                          for tag, outfile in outfiles.items()}
+            with open(combined_outfile) as in_fhand:
+                split_hits(in_fhand, out_fhands, MAX_TARGETS[mode], scales, EVALUE_COLUMNS[mode],
+                           EVALUE_CUTOFFS[mode])
+    except (OSError, ValueError) as error:
+        for outfile in outfiles.values():
+            fail_step(config, outfile, split_cmd)
+        return {tag: get_homology_report(config, cmd, "Protein homology analysis with {} Failed: \n {}".format(tag, error),
+                                         outfiles[tag], representatives) for tag in tags}
+    for outfile in outfiles.values():
+        record_step(config, outfile, split_cmd, split_inputs)
+    return {tag: get_homology_report(config, cmd, msg + "Hits of {} split successfully".format(tag),
+                                     outfiles[tag], representatives) for tag in tags}
+
+
+def get_combinable_dbs(dbs):
+    #Only FASTA files can be merged, with tags that can be told from the IDs
+    combinable = []
+    for tag, db_fpath in dbs:
+        try:
+            if TAG_SEPARATOR not in tag and is_fasta_db(db_fpath):
+                combinable.append((tag, db_fpath))
+        except OSError:
+            continue
+    return combinable
+
+
+def run_protein_homology(config, protein_sequences, representatives=None):
+    #If representatives are given, protein_sequences are unique and hits
+    #are counted for every protein they represent
     outdir = Path(config["Basedir"]) / "DIAMOND_run"
     results = {}
     if not outdir.exists():
         outdir.mkdir(parents=True, exist_ok=True)
-    for db in config["PROTHOMOLOGY_tags"]:
-        for tag, db_fpath in db.items():
-            outfile = outdir / "{}.proteins.dmd.{}.o6.txt".format(config["ID"], tag)
-            cmd = "diamond blastp --threads {} --db {} --query {} --out {}".format(config["Threads"],
-                                                                                str(db_fpath),
-                                                                                str(protein_sequences),
-                                                                                str(outfile))
-            if outfile.is_file():
-                msg = "Protein homology analysis with {} already done".format(tag)
-            else:
-                run_ = subprocess.run(cmd, shell=True, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL)
-            #Is process has gone well
-                if run_.returncode == 0:
-                    msg = "Protein homology analysis with {} run successfully".format(tag)
-            #But if not
-                else:
-                    msg = "Protein homology analysis with {} Failed: \n {}".format(tag, run_.stderr)
-        results[tag] = {"command": cmd, "status": msg, "outfile": outfile}
-    return results
\ No newline at end of file
+    dbs = [(tag, db_fpath) for db in config["PROTHOMOLOGY_tags"] for tag, db_fpath in db.items()]
+    if config.get("Homology_combined"):
+        combinable = get_combinable_dbs(dbs)
+        if len(combinable) > 1:
+            results.update(run_combined_search(config, combinable, protein_sequences, representatives, outdir))
+    for tag, db_fpath in dbs:
+        if tag not in results:
+            results[tag] = run_homology_search(config, tag, db_fpath, protein_sequences, representatives, outdir)
+    return results
@@ -1,4 +1,6 @@
 from src.error_check import operation_failed
+from src.homology import EVALUE_COLUMNS, HIT_EVALUE
+from src.sequences import read_representatives
 
 def protein_homology_stats(homology, num_transcripts):
     results = {}
@@ -8,17 +10,26 @@ def protein_homology_stats(homology, num_transcripts):
         if error:
             results[f"ProteinsWith{tag}Hits (%)"] = error
         else:
+            #presence mode writes qseqid, sseqid and evalue, full mode the 12
+            #default columns
+            evalue_column = EVALUE_COLUMNS[values.get("mode", "full")]
             with open(values["outfile"]) as results_fhand:
                 for line in results_fhand:
                     parts = line.rstrip().split()
-                    if len(parts) > 10:  # para evitar errores por líneas mal formateadas
+                    if len(parts) > evalue_column:  # para evitar errores por líneas mal formateadas
                         try:
-                            evalue = float(parts[10])
+                            evalue = float(parts[evalue_column])
                             prot_id = parts[0]
-                            if evalue < 1e-20:
+                            if evalue < HIT_EVALUE:
                                 prots.add(prot_id)
                         except ValueError:
                             continue  # en caso de que evalue no sea convertible
-            percentage = round((len(prots) / num_transcripts) * 100, 2)
+            #Hits of unique proteins count for all the proteins they represent
+            if values.get("representatives"):
+                members = read_representatives(values["representatives"])
+                num_prots = sum(len(members.get(prot, [prot])) for prot in prots)
+            else:
+                num_prots = len(prots)
+            percentage = round((num_prots / num_transcripts) * 100, 2)
             results[f"ProteinsWith{tag}Hits (%)"] = percentage
     return results
\ No newline at end of file
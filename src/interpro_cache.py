@@ -0,0 +1,95 @@
+import hashlib
+import sqlite3
+
+from pathlib import Path
+
+
+#Shared by all the runs of the user, so proteins found in other
+#annotations or species are not scanned again
+DEFAULT_INTERPRO_CACHE = Path.home() / ".cache" / "GAQET" / "interpro_cache.sqlite"
+#Seconds waited for other runs writing to the cache
+CACHE_TIMEOUT = 600
+CACHE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS scanned (md5 TEXT NOT NULL, signature TEXT NOT NULL,
+                                    PRIMARY KEY (md5, signature));
+CREATE TABLE IF NOT EXISTS hits (md5 TEXT NOT NULL, signature TEXT NOT NULL, row TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS hits_md5 ON hits (md5, signature);
+"""
+
+
+def get_protein_md5(sequence):
+    #Same MD5 InterProScan reports for every protein
+    return hashlib.md5(sequence.upper()).hexdigest()
+
+
+def get_interpro_signature(version, options):
+    #Results are only reused if InterProScan and its options didn't change
+    return hashlib.sha256("{}\t{}".format(version, options).encode()).hexdigest()
+
+
+def open_cache(fpath):
+    fpath = Path(fpath)
+    if not fpath.parent.exists():
+        fpath.parent.mkdir(parents=True, exist_ok=True)
+    connection = sqlite3.connect(str(fpath), timeout=CACHE_TIMEOUT)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.executescript(CACHE_SCHEMA)
+    return connection
+
+
+def select_md5s(connection, md5s):
+    #Queried proteins are joined from a temporary table, as they can be
+    #too many for a single IN clause
+    connection.execute("CREATE TEMP TABLE IF NOT EXISTS query (md5 TEXT PRIMARY KEY)")
+    connection.execute("DELETE FROM query")
+    connection.executemany("INSERT OR IGNORE INTO query VALUES (?)", ((md5,) for md5 in md5s))
+
+
+def get_scanned(fpath, md5s, signature):
+    """Returns the MD5s of the proteins already scanned with the same signature"""
+    connection = open_cache(fpath)
+    try:
+        with connection:
+            select_md5s(connection, md5s)
+            rows = connection.execute("SELECT scanned.md5 FROM query JOIN scanned ON query.md5 = scanned.md5 "
+                                      "WHERE scanned.signature = ?", (signature,))
+            return {md5 for md5, in rows}
+    finally:
+        connection.close()
+
+
+def store_results(fpath, md5s, signature, tsv_fhand):
+    """Stores the hits of an InterProScan TSV whose proteins are named by their MD5.
+
+    Every protein in md5s is marked as scanned, with hits or without them.
+    """
+    connection = open_cache(fpath)
+    try:
+        with connection:
+            connection.executemany("DELETE FROM hits WHERE md5 = ? AND signature = ?",
+                                   ((md5, signature) for md5 in md5s))
+            hits = (line.rstrip("\n").split("\t", 1) for line in tsv_fhand if line.strip())
+            connection.executemany("INSERT INTO hits VALUES (?, ?, ?)",
+                                   ((md5, signature, row) for md5, row in hits))
+            connection.executemany("INSERT OR IGNORE INTO scanned VALUES (?, ?)",
+                                   ((md5, signature) for md5 in md5s))
+    finally:
+        connection.close()
+
+
+def write_cached_tsv(fpath, proteins, signature, out_fhand):
+    """Writes the InterProScan TSV of the proteins, a list of (ID, MD5), from the cache"""
+    connection = open_cache(fpath)
+    try:
+        with connection:
+            select_md5s(connection, [md5 for _, md5 in proteins])
+            rows = connection.execute("SELECT hits.md5, hits.row FROM query JOIN hits ON query.md5 = hits.md5 "
+                                      "WHERE hits.signature = ? ORDER BY hits.rowid", (signature,))
+            hits = {}
+            for md5, row in rows:
+                hits.setdefault(md5, []).append(row)
+    finally:
+        connection.close()
+    for name, md5 in proteins:
+        for row in hits.get(md5, []):
+            out_fhand.write("{}\t{}\n".format(name, row))
@@ -0,0 +1,122 @@
+import fcntl
+import json
+import os
+import subprocess
+import threading
+import time
+
+from datetime import datetime
+from pathlib import Path
+
+
+RECORDS_NAME = ".GAQET.metrics.jsonl"
+REPORT_NAME = "GAQET.metrics.json"
+
+
+def get_records_fpath(config):
+    return Path(config["Basedir"]) / RECORDS_NAME
+
+
+def read_stream(stream, outputs, name):
+    outputs[name] = stream.read()
+    stream.close()
+
+
+def read_proc_io(pid):
+    #Only available on Linux. Once the child has exited, its counters
+    #include the I/O of the descendants it has waited for
+    io = {}
+    try:
+        with open("/proc/{}/io".format(pid)) as fhand:
+            for line in fhand:
+                key, value = line.split(":")
+                io[key.strip()] = int(value)
+    except (OSError, ValueError):
+        return {}
+    return io
+
+
+def append_record(config, record):
+    records_fpath = get_records_fpath(config)
+    records_fpath.parent.mkdir(parents=True, exist_ok=True)
+    #Steps running in parallel processes write to the same file
+    with open(records_fpath, "a") as out_fhand:
+        fcntl.flock(out_fhand, fcntl.LOCK_EX)
+        out_fhand.write(json.dumps(record) + "\n")
+        out_fhand.flush()
+        fcntl.flock(out_fhand, fcntl.LOCK_UN)
+
+
+def run_command(cmd, config, step=None, **kwargs):
+    """Run cmd like subprocess.run(cmd, shell=True) measuring its resources.
+
+    Wall time, user and system CPU time, peak RSS and bytes read and
+    written by the command (and the processes it waited for) are appended
+    to the metrics records of the run. Returns a CompletedProcess.
+    """
+    kwargs.setdefault("shell", True)
+    started = datetime.now().isoformat(timespec="seconds")
+    start_time = time.time()
+    process = subprocess.Popen(cmd, **kwargs)
+    outputs = {}
+    readers = []
+    for name in ("stdout", "stderr"):
+        stream = getattr(process, name)
+        if stream is not None:
+            reader = threading.Thread(target=read_stream, args=(stream, outputs, name))
+            reader.start()
+            readers.append(reader)
+    for reader in readers:
+        reader.join()
+    io = {}
+    try:
+        #Waits for the child to exit without reaping it, so /proc is still there
+        os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+        io = read_proc_io(process.pid)
+    except (AttributeError, OSError):
+        pass
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    wall_time = time.time() - start_time
+
+    record = {"step": step if step is not None else cmd.split()[0],
+              "command": cmd,
+              "start": started,
+              "threads": config.get("Threads"),
+              "returncode": process.returncode,
+              "wall_time_s": round(wall_time, 3),
+              "user_time_s": round(usage.ru_utime, 3),
+              "sys_time_s": round(usage.ru_stime, 3),
+              #ru_maxrss is given in KB on Linux
+              "peak_rss_mb": round(usage.ru_maxrss / 1024, 2),
+              "read_bytes": io.get("rchar", usage.ru_inblock * 512),
+              "write_bytes": io.get("wchar", usage.ru_oublock * 512),
+              "disk_read_bytes": io.get("read_bytes", usage.ru_inblock * 512),
+              "disk_write_bytes": io.get("write_bytes", usage.ru_oublock * 512)}
+    append_record(config, record)
+    return subprocess.CompletedProcess(cmd, process.returncode,
+                                       outputs.get("stdout"), outputs.get("stderr"))
+
+
+def clear_metrics(config):
+    records_fpath = get_records_fpath(config)
+    if records_fpath.exists():
+        records_fpath.unlink()
+
+
+def write_metrics_report(config, version, analysis_times):
+    records = []
+    records_fpath = get_records_fpath(config)
+    if records_fpath.exists():
+        with open(records_fpath) as fhand:
+            records = [json.loads(line) for line in fhand if line.strip()]
+    report = {"GAQET_version": version,
+              "ID": config["ID"],
+              "analysis_wall_time_s": {analysis: round(elapsed, 3) for analysis, elapsed in analysis_times.items()},
+              "total_cpu_time_s": round(sum(record["user_time_s"] + record["sys_time_s"] for record in records), 3),
+              "commands": records}
+    outfile = Path(config["Basedir"]) / REPORT_NAME
+    with open(outfile, "w") as out_fhand:
+        json.dump(report, out_fhand, indent=2)
+    clear_metrics(config)
+    return outfile
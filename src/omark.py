@@ -2,27 +2,61 @@ import subprocess
 
 from pathlib import Path
 
+from src.cache import (atomic_output, fail_step, record_step, remove_output, run_atomic,
+                       start_step, step_done)
+from src.metrics import run_command
+from src.sequences import fan_out_rows, read_representatives
 
-def run_omark(arguments, protein_sequences):
+
+def fan_out_omamer(arguments, search_outfile, representatives, omamer_outfile):
+    #Placements of unique proteins are copied to every protein they represent
+    cmd = "fan_out {} {}".format(search_outfile, representatives)
+    inputs = [search_outfile, representatives]
+    if step_done(arguments, omamer_outfile, cmd, inputs):
+        return "OMAMER search analysis done already"
+    start_step(arguments, omamer_outfile, cmd)
+    try:
+        members = read_representatives(representatives)
+        with atomic_output(omamer_outfile) as partial_fpath:
+            with open(search_outfile) as in_fhand, open(partial_fpath, "w") as out_fhand:
+                fan_out_rows(in_fhand, out_fhand, members)
+    except (OSError, ValueError) as error:
+        fail_step(arguments, omamer_outfile, cmd)
+        return "OMAMER search analysis Failed: \n {}".format(error)
+    record_step(arguments, omamer_outfile, cmd, inputs)
+    return "OMAMER search analysis run successfully on unique proteins"
+
+
+def run_omark(arguments, protein_sequences, representatives=None):
     report = {"OMAMER": {}, "OMARK": {}}
     outdir = Path(arguments["Basedir"]) / "OMARK_run"
     if not outdir.exists():
         outdir.mkdir(parents=True, exist_ok=True)
-    #Run OMAMER
+    #Run OMAMER, on unique proteins if their representatives are given
     omamer_outfile = outdir / "{}_proteins.omamer".format(arguments["ID"])
+    if representatives:
+        search_outfile = outdir / "{}_proteins.unique.omamer".format(arguments["ID"])
+    else:
+        search_outfile = omamer_outfile
 
     cmd = "omamer search --db {} --query {} --out {} --nthreads {}".format(arguments["OMARK_db"],
                                                                            protein_sequences,
-                                                                           omamer_outfile,
+                                                                           search_outfile,
                                                                            arguments["Threads"])
-    if omamer_outfile.exists():
+    inputs = [protein_sequences, arguments["OMARK_db"]]
+    if step_done(arguments, search_outfile, cmd, inputs):
         msg = "OMAMER search analysis done already"
     else:
-        run_ = subprocess.run(cmd, shell=True, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL)
+        start_step(arguments, search_outfile, cmd)
+        run_ = run_atomic(cmd, search_outfile, arguments, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL)
         if run_.returncode == 0:
+            record_step(arguments, search_outfile, cmd, inputs)
             msg = "OMAMER search analysis run successfully"
         else:
+            fail_step(arguments, search_outfile, cmd)
             msg = "OMAMER search analysis Failed: \n {}".format(run_.stderr)
+    if representatives and "Failed" not in msg:
+        msg = fan_out_omamer(arguments, search_outfile, representatives, omamer_outfile)
     report["OMAMER"] = {"command": cmd,
                         "status": msg,
                         "outfile": omamer_outfile}
@@ -34,13 +68,18 @@ def run_omark(arguments, protein_sequences):
                                                   arguments["OMARK_db"],
                                                   arguments["OMARK_taxid"],
                                                   omark_outdir)
-    if omark_outfile.is_file():
+    inputs = [omamer_outfile, arguments["OMARK_db"]]
+    if step_done(arguments, omark_outfile, cmd, inputs):
         msg = "OMARK analysis done already"
     else:
-        run_ = subprocess.run(cmd, shell=True, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL)
+        start_step(arguments, omark_outfile, cmd)
+        remove_output(omark_outdir)
+        run_ = run_command(cmd, arguments, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL)
         if run_.returncode == 0:
+            record_step(arguments, omark_outfile, cmd, inputs)
             msg = "OMARK analysis run successfully"
         else:
+            fail_step(arguments, omark_outfile, cmd)
             msg = "OMARK analysis Failed: \n {}".format(run_.stderr)
     report["OMARK"] = {"command": cmd,
                         "status": msg,
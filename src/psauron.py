@@ -1,35 +1,132 @@
+import csv
+import os
 import subprocess
 
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+from src.cache import atomic_output, fail_step, record_step, run_atomic, start_step, step_done
+from src.fasta import read_fasta_records, split_by_residues
+
+
+SCORE_LABEL = "psauron score"
+IS_PROTEIN_COLUMN = "psauron_is_protein"
+#Every shard is a PSAURON process loading its own model, of about this
+#memory (GB). Shards run at the same time, up to PSAURON_SHARDS
+SHARD_MEMORY = 4
+PSAURON_SHARDS = 4
+
+
+def get_max_psauron_shards(arguments):
+    #Limited by the YAML PSAURON_shards and by the Memory given to PSAURON
+    max_shards = max(1, int(arguments.get("PSAURON_shards") or PSAURON_SHARDS))
+    memory = (arguments.get("Memory") or {}).get("PSAURON")
+    if memory:
+        max_shards = min(max_shards, max(1, int(memory // SHARD_MEMORY)))
+    return max_shards
+
 
 def succes(outfile):
     if outfile.is_file():
         with open(outfile) as fhand:
              for line in fhand:
-                if "psauron score" in line:
+                if SCORE_LABEL in line:
                     return True
     return False
 
 
+def run_psauron_shard(arguments, cds_sequences, outfile, env=None):
+    cmd = "psauron -i {} -o {}".format(cds_sequences, outfile)
+    inputs = [cds_sequences]
+    if step_done(arguments, outfile, cmd, inputs):
+        return cmd, "PSAURON analysis done already"
+    start_step(arguments, outfile, cmd)
+    run_ = run_atomic(cmd, outfile, arguments, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL, env=env)
+    if succes(outfile):
+        record_step(arguments, outfile, cmd, inputs)
+        return cmd, "PSAURON analysis run successfully"
+    fail_step(arguments, outfile, cmd)
+    return cmd, "PSAURON analysis Failed: \n {}".format(run_.stderr)
+
+
+def merge_psauron_results(shard_outfiles, out_fhand):
+    """Merges the per sequence scores of PSAURON shards and recomputes the psauron score.
+
+    The score is the % of sequences predicted as proteins, written with
+    the same number of decimals PSAURON uses.
+    """
+    score_line = None
+    header = None
+    rows = []
+    for shard_outfile in shard_outfiles:
+        with open(shard_outfile) as fhand:
+            for line in fhand:
+                if SCORE_LABEL in line:
+                    score_line = line
+                elif header is None:
+                    header = line
+                elif line != header and line.strip():
+                    rows.append(line)
+    if score_line is None or header is None:
+        raise ValueError("PSAURON results without score")
+    is_protein = next(csv.reader([header])).index(IS_PROTEIN_COLUMN)
+    proteins = sum(1 for row in csv.reader(rows) if row[is_protein] == "True")
+    score = 100 * proteins / len(rows) if rows else 0
+    shard_score = score_line.rstrip().split()[-1]
+    decimals = len(shard_score.split(".")[1]) if "." in shard_score else 0
+    out_fhand.write("{}{:.{}f}\n".format(score_line.rstrip()[:-len(shard_score)], score, decimals))
+    out_fhand.write(header)
+    out_fhand.writelines(rows)
+
 
 def run_psauron(arguments, cds_sequences):
-    report = {}
+    """Runs PSAURON on shards of the CDS, balanced by length, sharing the threads.
+
+    The per sequence scores of all shards are merged in a single csv.
+    Every shard is a step of its own, so only unfinished shards are run
+    again.
+    """
     outdir = Path(arguments["Basedir"]) / "PSAURON_run"
     if not outdir.exists():
         outdir.mkdir(parents=True, exist_ok=True)
     outfile = outdir / "{}.cds.psauron.csv".format(arguments["ID"])
-    cmd = "psauron -i {} -o {}".format(cds_sequences, outfile)
+    threads = max(1, int(arguments.get("Threads", 1)))
+    num_shards = min(threads, get_max_psauron_shards(arguments))
+    if num_shards == 1:
+        cmd, msg = run_psauron_shard(arguments, cds_sequences, outfile)
+        return {"command": cmd, "status": msg, "outfile": outfile}
 
-    if outfile.is_file():
-        msg = "PSAURON analysis done already"
-    else:
-        run_ = subprocess.run(cmd, shell=True, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL)
-        if succes(outfile):
-            msg = "PSAURON analysis run successfully"
-        else:
-            msg = "PSAURON analysis Failed: \n {}".format(run_.stderr)
-    report = {"command": cmd,
-              "status": msg,
-              "outfile": outfile}
-    return report
\ No newline at end of file
+    shards_dir = outdir / "shards"
+    if not shards_dir.exists():
+        shards_dir.mkdir(parents=True, exist_ok=True)
+    with open(cds_sequences, "rb") as fhand:
+        records = list(read_fasta_records(fhand))
+    num_shards = max(1, min(num_shards, len(records)))
+    shard_fpaths = [shards_dir / "shard_{}.fasta".format(shard) for shard in range(num_shards)]
+    shard_outfiles = [shards_dir / "shard_{}.psauron.csv".format(shard) for shard in range(num_shards)]
+    cmd = "merge_psauron {}".format(" ".join(str(fpath) for fpath in shard_outfiles))
+    if step_done(arguments, outfile, cmd, [cds_sequences] + shard_outfiles):
+        return {"command": cmd, "status": "PSAURON analysis done already", "outfile": outfile}
+    split_by_residues(records, shard_fpaths)
+    #Processes share the threads, so shards don't compete for cores
+    shard_threads = str(max(1, threads // num_shards))
+    env = dict(os.environ, OMP_NUM_THREADS=shard_threads, MKL_NUM_THREADS=shard_threads)
+    with ThreadPoolExecutor(max_workers=num_shards) as executor:
+        results = list(executor.map(run_psauron_shard, [arguments] * num_shards, shard_fpaths,
+                                    shard_outfiles, [env] * num_shards))
+    errors = [msg for _, msg in results if "Failed" in msg]
+    if errors:
+        fail_step(arguments, outfile, cmd)
+        msg = "PSAURON analysis Failed in {} of {} shards: \n {}".format(len(errors), num_shards, "\n".join(errors))
+        return {"command": results[0][0], "status": msg, "outfile": outfile}
+    start_step(arguments, outfile, cmd)
+    try:
+        with atomic_output(outfile) as partial_fpath, open(partial_fpath, "w") as out_fhand:
+            merge_psauron_results(shard_outfiles, out_fhand)
+    except (OSError, ValueError) as error:
+        fail_step(arguments, outfile, cmd)
+        return {"command": cmd, "status": "PSAURON analysis Failed: \n {}".format(error), "outfile": outfile}
+    record_step(arguments, outfile, cmd, [cds_sequences] + shard_outfiles)
+    return {"command": results[0][0],
+            "status": "PSAURON analysis run successfully in {} shards".format(num_shards),
+            "outfile": outfile}
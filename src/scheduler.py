@@ -0,0 +1,138 @@
+import time
+
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+
+def run_step(function, config, args, threads):
+    #Each step gets its own copy of the config with its share of threads
+    config = dict(config)
+    config["Threads"] = threads
+    start_time = time.time()
+    report = function(config, *args)
+    return report, time.time() - start_time
+
+
+def assign_resources(ready, steps, free_threads, free_memory=None, idle=False, min_threads=1):
+    """Assign threads to the ready steps that fit into the free budget.
+
+    Single threaded steps get one thread each and are launched first, the
+    remaining threads are split evenly between the multithreaded ones,
+    giving each of them at least min_threads. If free_memory is given,
+    steps are only launched while their memory (GB) fits into it. A step
+    asking for more memory than the whole budget runs when nothing else does.
+    """
+    assigned = {}
+    singles = [name for name in ready if not steps[name].get("multithread", False)]
+    multis = [name for name in ready if steps[name].get("multithread", False)]
+
+    def fits(name, chosen):
+        nonlocal free_memory
+        if free_memory is None:
+            return True
+        memory = steps[name].get("memory", 0)
+        if memory > free_memory and not (idle and not chosen):
+            return False
+        free_memory -= memory
+        return True
+
+    for name in singles:
+        if free_threads < 1:
+            return assigned
+        if fits(name, assigned):
+            assigned[name] = 1
+            free_threads -= 1
+    launchable = []
+    max_multis = free_threads // max(1, min_threads)
+    if idle and not assigned and free_threads > 0:
+        max_multis = max(max_multis, 1)
+    for name in multis:
+        if len(launchable) >= max_multis:
+            break
+        if fits(name, list(assigned) + launchable):
+            launchable.append(name)
+    if launchable:
+        share, remainder = divmod(free_threads, len(launchable))
+        for index, name in enumerate(launchable):
+            assigned[name] = share + (1 if index < remainder else 0)
+    return assigned
+
+
+def get_dependents(name, steps):
+    #Steps depending on name, directly or through other steps
+    dependents = []
+    for other, step in steps.items():
+        if name in step.get("depends", []):
+            dependents.append(other)
+            dependents += [dependent for dependent in get_dependents(other, steps)
+                           if dependent not in dependents]
+    return dependents
+
+
+def run_dag(steps, config, threads, on_launch=None, on_finish=None,
+            memory=None, min_threads=1, on_error=None):
+    """Run a DAG of analysis steps in parallel, honouring a global threads budget.
+
+    steps is a dict {name: {"function": callable, "args": list,
+    "depends": [names], "multithread": bool, "memory": GB}}. Each function
+    is called as function(config, *args) with config["Threads"] set to the
+    threads assigned to that step. A step can also have its own "config"
+    or a "prepare" callable, which receives the reports of the finished
+    steps and returns the "function", "config" and "args" to use. Steps run in separate
+    processes, so tools that change the working directory don't interfere
+    with each other. If on_error is given, a step raising an exception
+    doesn't stop the others: the steps depending on it are skipped and
+    on_error is called with its name, the exception and the skipped steps.
+    Otherwise the exception is raised. Returns a dict {name: report} of
+    the steps that finished.
+    """
+    threads = max(1, int(threads))
+    for name, step in steps.items():
+        for dependency in step.get("depends", []):
+            if dependency not in steps:
+                raise ValueError("Step {} depends on unknown step {}".format(name, dependency))
+    reports = {}
+    running = {}
+    pending = list(steps)
+    used_threads = 0
+    used_memory = 0
+    #Every running step uses at least one thread, so that bounds the pool
+    with ProcessPoolExecutor(max_workers=max(1, min(len(steps), threads))) as executor:
+        while pending or running:
+            ready = [name for name in pending
+                     if all(dependency in reports for dependency in steps[name].get("depends", []))]
+            free_memory = None if memory is None else memory - used_memory
+            assigned = assign_resources(ready, steps, threads - used_threads, free_memory=free_memory,
+                                        idle=not running, min_threads=min_threads)
+            for name, step_threads in assigned.items():
+                step = steps[name]
+                if "prepare" in step:
+                    step = dict(step, **step["prepare"](reports))
+                future = executor.submit(run_step, step["function"], step.get("config", config),
+                                         step.get("args", []), step_threads)
+                running[future] = (name, step_threads)
+                pending.remove(name)
+                used_threads += step_threads
+                used_memory += step.get("memory", 0)
+                if on_launch is not None:
+                    on_launch(name, step_threads)
+            if not running:
+                raise ValueError("Steps {} have circular dependencies".format(", ".join(pending)))
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name, step_threads = running.pop(future)
+                used_threads -= step_threads
+                used_memory -= steps[name].get("memory", 0)
+                try:
+                    report, elapsed = future.result()
+                except Exception as error:
+                    if on_error is None:
+                        raise
+                    skipped = [dependent for dependent in get_dependents(name, steps) if dependent in pending]
+                    for dependent in skipped:
+                        pending.remove(dependent)
+                    on_error(name, error, skipped)
+                    continue
+                reports[name] = report
+                if on_finish is not None:
+                    on_finish(name, report, elapsed)
+    return reports
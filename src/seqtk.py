@@ -1,5 +1,8 @@
 import subprocess
 from pathlib import Path
+from shutil import which
+
+from src.cache import fail_step, record_step, run_atomic, start_step, step_done
 
 
 def reformat_fasta_file(config):
@@ -9,13 +12,20 @@ def reformat_fasta_file(config):
         outdir.mkdir(parents=True, exist_ok=True)
     outfile = outdir / "{}.reformatted.fasta".format(Path(config["Assembly"]).stem)
     cmd = "seqtk seq -l 80 {} > {}".format(Path(config["Assembly"]), outfile)
-    if outfile.exists():
+    inputs = [config["Assembly"]]
+    if step_done(config, outfile, cmd, inputs):
         msg = "Assembly file reformatted already"
+    #seqtk is optional, so it is only looked for when it is needed
+    elif not which("seqtk"):
+        msg = "Assembly file reformating Failed: \n Binary seqtk not found"
     else:
-        run_ = subprocess.run(cmd, shell=True, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL)   
+        start_step(config, outfile, cmd)
+        run_ = run_atomic(cmd, outfile, config, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL)   
         if run_.returncode == 0:
+            record_step(config, outfile, cmd, inputs)
             msg = "Assembly file reformatted successfully"
         else:
+            fail_step(config, outfile, cmd)
             msg = "Assembly file reformating Failed: \n {}".format(run_.stdout)
     report = {"command": cmd, "status": msg, 
               "outfile": outfile}
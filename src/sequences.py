@@ -0,0 +1,259 @@
+import numpy as np
+
+from collections import defaultdict
+from contextlib import ExitStack
+from itertools import product
+from pathlib import Path
+
+from src.cache import atomic_output, fail_step, record_step, start_step, step_done
+from src.annotation import load_annotation
+from src.cds_checks import COMPLEMENT, COMPLETE, check_cds
+from src.fasta import fetch_sequence, open_genome, read_fasta_records
+from src.gff import get_gff_transcript_ids
+from src.gff_stats import CDS, EXON, get_feature_table
+
+
+SEQUENCE_EXTRACTORS = ["native", "gffread"]
+#Same products and modes as gffread (-x CDS, -y proteins, -w spliced exons)
+SEQUENCE_KINDS = {"cds": "x", "proteins": "y", "mrna": "w",
+                  "cds_longest_isoform": "x", "proteins_longest_isoform": "y",
+                  "mrna_longest_isoform": "w", "proteins_longest_busco": "y"}
+#gffread writes sequences in lines of 70 characters
+LINE_WIDTH = 70
+#gffread -J only accepts ATG as start codon
+GFFREAD_START_CODONS = {b"ATG"}
+BASES = "TCAG"
+#Standard code (NCBI table 1), gffread writes stop codons as "."
+AMINOACIDS = "FFLLSSSSYY..CC.WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG"
+CODONS = {"".join(codon).encode(): aminoacid.encode()
+          for codon, aminoacid in zip(product(BASES, repeat=3), AMINOACIDS)}
+
+
+def translate(sequence):
+    #Codons with ambiguous bases are translated as X
+    sequence = sequence.upper()
+    return b"".join(CODONS.get(sequence[idx:idx + 3], b"X")
+                    for idx in range(0, len(sequence) - 2, 3))
+
+
+def write_fasta(out_fhand, name, sequence):
+    out_fhand.write(b">" + name + b"\n")
+    for idx in range(0, len(sequence), LINE_WIDTH):
+        out_fhand.write(sequence[idx:idx + LINE_WIDTH] + b"\n")
+
+
+def get_transcript_position(starts, ends, position, strand):
+    #1-based position of a genomic coordinate in the spliced transcript
+    lengths = ends - starts + 1
+    if strand == -1:
+        return int(np.clip(ends - position, 0, lengths).sum()) + 1
+    return int(np.clip(position - starts, 0, lengths).sum()) + 1
+
+
+def get_pieces_sequence(mm, record, starts, ends, strand):
+    sequence = b"".join(fetch_sequence(mm, record, start - 1, end, upper=False)
+                        for start, end in zip(starts, ends))
+    if strand == -1:
+        sequence = sequence.translate(COMPLEMENT)[::-1]
+    return sequence
+
+
+def iter_transcript_sequences(table, mm, genome_index):
+    """Yields the ID of every transcript, its mRNA header, spliced exons, CDS, phase and protein.
+
+    Transcripts are sorted as gffread does, by sequence in the order found
+    in the annotation and by start. Exons are made from the CDS and UTRs
+    of transcripts without exons. CDS is None for non coding transcripts.
+    """
+    transcripts = table["transcripts"]
+    features = table["features"]
+    order = np.lexsort((features["start"], features["transcript"]))
+    feature_transcripts = features["transcript"][order]
+    types, starts, ends, phases = (features[column][order] for column in ("type", "start", "end", "phase"))
+    transcript_numbers = np.arange(len(transcripts["id"]))
+    firsts = np.searchsorted(feature_transcripts, transcript_numbers, side="left")
+    lasts = np.searchsorted(feature_transcripts, transcript_numbers, side="right")
+
+    for transcript in np.lexsort((transcript_numbers, transcripts["start"], transcripts["seqid"])):
+        record = genome_index.get(table["seqids"][transcripts["seqid"][transcript]])
+        if record is None:
+            continue
+        strand = transcripts["strand"][transcript]
+        pieces = slice(firsts[transcript], lasts[transcript])
+        piece_types, piece_starts, piece_ends = types[pieces], starts[pieces], ends[pieces]
+        exons = piece_types == EXON
+        if not exons.any():
+            exons = np.ones(len(piece_types), dtype=bool)
+        exon_starts, exon_ends = piece_starts[exons], piece_ends[exons]
+        cds = piece_types == CDS
+        name = transcripts["id"][transcript].encode()
+        header = name
+        cds_sequence = protein = None
+        if cds.any():
+            cds_starts, cds_ends = piece_starts[cds], piece_ends[cds]
+            cds_sequence = get_pieces_sequence(mm, record, cds_starts, cds_ends, strand)
+            phase = phases[pieces][cds][-1 if strand == -1 else 0]
+            phase = max(0, int(phase))
+            protein = translate(cds_sequence[phase:])
+            cds_limits = sorted(get_transcript_position(exon_starts, exon_ends, position, strand)
+                                for position in (cds_starts.min(), cds_ends.max()))
+            header = b"%s CDS=%d-%d" % (name, cds_limits[0], cds_limits[1])
+        else:
+            phase = 0
+        mrna = get_pieces_sequence(mm, record, exon_starts, exon_ends, strand)
+        yield name, header, mrna, cds_sequence, phase, protein
+
+
+def has_complete_cds(cds_sequence, phase):
+    #Same filter as gffread -J: start and stop codons and no early stops
+    if cds_sequence is None:
+        return False
+    incomplete, early_stop = check_cds(cds_sequence.upper(), phase, GFFREAD_START_CODONS)
+    return incomplete == COMPLETE and not early_stop
+
+
+def get_sequence_outfiles(config):
+    outdir = Path(config["Basedir"]) / "input_sequences"
+    outfiles = {}
+    for kind in SEQUENCE_KINDS:
+        #BUSCO sequences are renamed, so every protein has a unique name
+        suffix = "renamed.fasta" if "busco" in kind else "fasta"
+        outfiles[kind] = outdir / "{}.{}.{}".format(Path(config["Assembly"]).stem, kind, suffix)
+    return outfiles
+
+
+def write_sequences(config, outfiles):
+    """Writes the seven gffread products reading every transcript once.
+
+    Longest isoforms are taken from the full annotation, by the IDs of
+    the transcripts in the longest isoform annotation. Returns the number
+    of sequences written to each file.
+    """
+    table = get_feature_table(load_annotation(config["Annotation"]))
+    longest = get_gff_transcript_ids(config["Annotation_Longest"])
+    counts = defaultdict(int)
+    busco_names = defaultdict(int)
+    with open_genome(config["Assembly"], config.get("Assembly_index")) as (mm, genome_index), ExitStack() as stack:
+        out_fhands = {}
+        for kind, outfile in outfiles.items():
+            partial_fpath = stack.enter_context(atomic_output(outfile))
+            out_fhands[kind] = stack.enter_context(open(partial_fpath, "wb"))
+        for name, header, mrna, cds_sequence, phase, protein in iter_transcript_sequences(table, mm, genome_index):
+            is_longest = name.decode() in longest
+            if is_longest and protein is not None:
+                busco_names[name] += 1
+                write_fasta(out_fhands["proteins_longest_busco"], b"%s_%d" % (name, busco_names[name]), protein)
+                counts["proteins_longest_busco"] += 1
+            if not has_complete_cds(cds_sequence, phase):
+                continue
+            products = {"cds": (name, cds_sequence), "proteins": (name, protein), "mrna": (header, mrna)}
+            for kind, (sequence_name, sequence) in products.items():
+                kinds = (kind, kind + "_longest_isoform") if is_longest else (kind,)
+                for out_kind in kinds:
+                    write_fasta(out_fhands[out_kind], sequence_name, sequence)
+                    counts[out_kind] += 1
+    return counts
+
+
+def extract_sequences(config):
+    """Extracts CDS, proteins and spliced exons as gffread does, in a single pass.
+
+    Produces the same files as run_gffread: complete coding transcripts
+    (gffread -J) for all and longest isoforms and every longest isoform
+    protein, renamed, for BUSCO.
+    """
+    outdir = Path(config["Basedir"]) / "input_sequences"
+    if not outdir.exists():
+        outdir.mkdir(parents=True, exist_ok=True)
+    outfiles = get_sequence_outfiles(config)
+    cmd = "extract_sequences -g {} {} {}".format(config["Assembly"], config["Annotation"],
+                                                 config["Annotation_Longest"])
+    inputs = [config["Assembly"], config["Annotation"], config["Annotation_Longest"]]
+    report = {kind: {"mode": mode, "command": cmd, "status": "", "outfile": outfiles[kind]}
+              for kind, mode in SEQUENCE_KINDS.items()}
+    if all(step_done(config, outfile, cmd, inputs) for outfile in outfiles.values()):
+        for kind in report:
+            report[kind]["status"] = "{} sequences already extracted".format(kind)
+        return report
+
+    for outfile in outfiles.values():
+        start_step(config, outfile, cmd)
+    try:
+        counts = write_sequences(config, outfiles)
+    except (OSError, ValueError) as error:
+        for kind, outfile in outfiles.items():
+            fail_step(config, outfile, cmd)
+            report[kind]["status"] = "Sequence extraction, mode {} Failed: \n {}".format(kind, error)
+        return report
+    for kind, outfile in outfiles.items():
+        record_step(config, outfile, cmd, inputs)
+        report[kind]["status"] = "{} {} sequences extracted successfully".format(counts[kind], kind)
+    return report
+
+
+def write_unique_sequences(in_fhand, out_fhand, map_fhand):
+    #The first sequence of each group of identical ones represents them
+    representatives = {}
+    map_fhand.write("ID\tRepresentative\n")
+    for name, sequence in read_fasta_records(in_fhand):
+        representative = representatives.get(sequence)
+        if representative is None:
+            representative = representatives[sequence] = name
+            write_fasta(out_fhand, name.encode(), sequence)
+        map_fhand.write("{}\t{}\n".format(name, representative))
+    return len(representatives)
+
+
+def deduplicate_sequences(config, fasta):
+    """Writes the unique sequences of a FASTA file and the representative of every sequence.
+
+    Expensive searches run on the unique sequences and their results are
+    fanned back out to every ID with the map (ID, representative).
+    """
+    fasta = Path(fasta)
+    outfile = fasta.with_suffix(".unique.fasta")
+    map_outfile = fasta.with_suffix(".unique.tsv")
+    cmd = "deduplicate {}".format(fasta)
+    inputs = [fasta]
+    report = {"mode": "unique", "command": cmd, "outfile": outfile, "representatives": map_outfile}
+    if step_done(config, outfile, cmd, inputs) and map_outfile.exists():
+        report["status"] = "Unique sequences of {} selected already".format(fasta.name)
+        return report
+    start_step(config, outfile, cmd)
+    try:
+        with atomic_output(map_outfile) as partial_map_fpath, atomic_output(outfile) as partial_fpath:
+            with open(fasta, "rb") as in_fhand, open(partial_fpath, "wb") as out_fhand, \
+                 open(partial_map_fpath, "w") as map_fhand:
+                num_unique = write_unique_sequences(in_fhand, out_fhand, map_fhand)
+    except (OSError, ValueError) as error:
+        fail_step(config, outfile, cmd)
+        #Analysis fall back to all the sequences
+        report.update({"outfile": fasta, "representatives": None,
+                       "status": "Unique sequences selection Failed: \n {}".format(error)})
+        return report
+    record_step(config, outfile, cmd, inputs)
+    report["status"] = "{} unique sequences of {} selected successfully".format(num_unique, fasta.name)
+    return report
+
+
+def read_representatives(fpath):
+    """Returns the IDs represented by every representative sequence"""
+    members = {}
+    with open(fpath) as fhand:
+        next(fhand, None)
+        for line in fhand:
+            name, representative = line.rstrip("\n").split("\t")
+            members.setdefault(representative, []).append(name)
+    return members
+
+
+def fan_out_rows(in_fhand, out_fhand, members):
+    #Rows of a representative, by its first column, are repeated for every
+    #ID it represents. Other rows, like headers, are kept as they are
+    for line in in_fhand:
+        name = line.split("\t", 1)[0]
+        if name in members:
+            for member in members[name]:
+                out_fhand.write(member + line[len(name):])
+        else:
+            out_fhand.write(line)